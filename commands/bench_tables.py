@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Initialization
+import nlputils.init
+# Local libraries
+from nlputils.smt.trans_models import tables
+
+if __name__ == '__main__':
+    tables.benchmark_main()
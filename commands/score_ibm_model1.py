@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Common Initialization
+import nlputils.init
+# Local libraries
+from nlputils.smt.align import ibm_model1
+
+if __name__ == '__main__':
+    ibm_model1.score_main()
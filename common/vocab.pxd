@@ -1,10 +1,28 @@
 from libcpp cimport bool
+from libc.stdint cimport int64_t
+cimport numpy as np
 
 cdef class StringEnumerator:
-    cdef dict dict_str2id
-    cdef list list_id2str
+    cdef np.ndarray pool_array
+    cdef np.ndarray offsets_array
+    cdef np.ndarray table_array
+    cdef unsigned char *pool
+    cdef int64_t *offsets
+    cdef int64_t *table
+    cdef long count
+    cdef long table_mask
 
-    cpdef bool append(self, str string)
-    cpdef long str2id(self, str string)
+    cdef void refresh(self) except *
+    cdef long find_slot(self, const unsigned char *data, Py_ssize_t length)
+    cdef void rehash(self, long table_size) except *
+    cdef long lookup(self, const unsigned char *data, Py_ssize_t length, bint register, long default) except? -2
+    cpdef bool append(self, str string) except *
+    cpdef long str2id(self, str string) except? -2
+    cpdef long get(self, str string, long default=*) except? -2
     cpdef str id2str(self, long number)
+    cpdef np.ndarray encode(self, str line, bint register=*, long default=*)
+    cpdef tuple encode_lines(self, lines, bint register=*, long default=*)
+    cpdef list decode(self, ids)
+    cpdef str decode_line(self, ids)
+    cpdef void save(self, str path) except *
 
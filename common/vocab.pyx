@@ -5,71 +5,239 @@
 
 # C++ setting
 from libcpp cimport bool
+from libc.stdint cimport int64_t, uint64_t
+from libc.string cimport memcmp, memcpy
 
-# Local libraries
-from nlputils.data_structs.trie import TwoWayIDMap
+# 3rd party library
+import numpy as np
+cimport numpy as np
 
-#wordMap   = TwoWayIDMap()
-#wordMap   = {}
-phraseMap = TwoWayIDMap()
-#phraseMap = {}
+cdef extern from "Python.h":
+    const char* PyUnicode_AsUTF8AndSize(object string, Py_ssize_t *size) except NULL
+    object PyUnicode_DecodeUTF8(const char *data, Py_ssize_t size, const char *errors)
+
+# header of the file saved by StringEnumerator.save() (followed by 4 int64 numbers: count, pool size, table size, 0)
+ENUMERATOR_MAGIC = b'STRENUM1'
+ENUMERATOR_HEADER_SIZE = 8 + 8 * 4
+
+# initial number of slots in the hash table (should be power of 2)
+INITIAL_TABLE_SIZE = 1024
+
+cdef inline uint64_t hash_bytes(const unsigned char *data, Py_ssize_t length) nogil:
+    '''FNV-1a hash of the byte sequence'''
+    cdef uint64_t value = 14695981039346656037ULL
+    cdef Py_ssize_t i
+    for i in range(length):
+        value = (value ^ data[i]) * 1099511628211ULL
+    return value
+
+cdef np.ndarray grown(np.ndarray array, long needed):
+    '''array itself if writable and large enough, otherwise its writable copy with room for needed elements'''
+    cdef np.ndarray new_array
+    if needed <= len(array) and array.flags.writeable:
+        return array
+    new_array = np.empty(max(needed, len(array) * 2, 16), array.dtype)
+    new_array[:len(array)] = array
+    return new_array
 
 cdef class StringEnumerator:
+    '''mapping between strings and sequential IDs, stored in a contiguous UTF-8 string pool with offsets
+    and an open-addressing hash table (all can be saved into a memory-mappable file)'''
     # defined in vocab.pxd
-    # cdef dict dict_str2id
-    # cdef list list_id2str
+    # cdef np.ndarray pool_array
+    # cdef np.ndarray offsets_array
+    # cdef np.ndarray table_array
+    # cdef unsigned char *pool
+    # cdef int64_t *offsets
+    # cdef int64_t *table
+    # cdef long count
+    # cdef long table_mask
 
     def __cinit__(self):
-        self.dict_str2id = {}
-        self.list_id2str = []
+        self.pool_array = np.zeros(0, np.uint8)
+        self.offsets_array = np.zeros(1, np.int64)
+        self.table_array = np.full(INITIAL_TABLE_SIZE, -1, np.int64)
+        self.count = 0
+        self.refresh()
+
+    cdef void refresh(self) except *:
+        '''update the raw pointers to the arrays after reallocation'''
+        self.pool = <unsigned char*> np.PyArray_DATA(self.pool_array)
+        self.offsets = <int64_t*> np.PyArray_DATA(self.offsets_array)
+        self.table = <int64_t*> np.PyArray_DATA(self.table_array)
+        self.table_mask = len(self.table_array) - 1
+
+    cdef long find_slot(self, const unsigned char *data, Py_ssize_t length):
+        '''slot of the hash table holding the ID of given bytes, or the empty slot to put it'''
+        cdef long slot = hash_bytes(data, length) & self.table_mask
+        cdef int64_t str_id, begin
+        while True:
+            str_id = self.table[slot]
+            if str_id < 0:
+                return slot
+            begin = self.offsets[str_id]
+            if self.offsets[str_id+1] - begin == length and memcmp(self.pool + begin, data, length) == 0:
+                return slot
+            slot = (slot + 1) & self.table_mask
+
+    cdef void rehash(self, long table_size) except *:
+        cdef long str_id, slot
+        self.table_array = np.full(table_size, -1, np.int64)
+        self.refresh()
+        for str_id in range(self.count):
+            slot = self.find_slot(self.pool + self.offsets[str_id], self.offsets[str_id+1] - self.offsets[str_id])
+            self.table[slot] = str_id
 
-    cpdef bool append(self, str string):
+    cdef long lookup(self, const unsigned char *data, Py_ssize_t length, bint register, long default) except? -2:
+        '''ID of given UTF-8 bytes, registering it if not found and register is set (default otherwise)'''
+        cdef long slot = self.find_slot(data, length)
+        cdef long pool_size
+        if self.table[slot] >= 0:
+            return self.table[slot]
+        if not register:
+            return default
+        pool_size = self.offsets[self.count]
+        self.pool_array = grown(self.pool_array, pool_size + length)
+        self.offsets_array = grown(self.offsets_array, self.count + 2)
+        self.refresh()
+        if (self.count + 1) * 2 > len(self.table_array):
+            # keeping the load factor not more than 1/2
+            self.rehash(len(self.table_array) * 2)
+            slot = self.find_slot(data, length)
+        elif not self.table_array.flags.writeable:
+            self.table_array = np.array(self.table_array)
+            self.refresh()
+        memcpy(self.pool + pool_size, data, length)
+        self.offsets[self.count+1] = pool_size + length
+        self.table[slot] = self.count
+        self.count += 1
+        return self.count - 1
+
+    cpdef bool append(self, str string) except *:
         self.str2id(string)
         return True
 
-    cpdef long str2id(self, str string):
-        cdef long new_id
-        if string in self.dict_str2id:
-            return self.dict_str2id[string]
-        else:
-            new_id = len(self.list_id2str)
-            self.list_id2str.append(string)
-            self.dict_str2id[string] = new_id
-            return new_id
+    cpdef long str2id(self, str string) except? -2:
+        cdef Py_ssize_t length
+        cdef const char *data = PyUnicode_AsUTF8AndSize(string, &length)
+        return self.lookup(<const unsigned char*> data, length, True, -1)
+
+    cpdef long get(self, str string, long default=-1) except? -2:
+        '''id of registered string, or default if not registered (without registering)'''
+        cdef Py_ssize_t length
+        cdef const char *data = PyUnicode_AsUTF8AndSize(string, &length)
+        return self.lookup(<const unsigned char*> data, length, False, default)
 
     cpdef str id2str(self, long number):
-        if 0 <= number and number < len(self.list_id2str):
-            return self.list_id2str[number]
+        if 0 <= number and number < self.count:
+            return PyUnicode_DecodeUTF8(<const char*> self.pool + self.offsets[number],
+                                        self.offsets[number+1] - self.offsets[number], NULL)
         else:
             raise IndexError("id %s is not registered in vocabulary set" % (number,))
 
+    cpdef np.ndarray encode(self, str line, bint register=True, long default=-1):
+        '''IDs of the words in the line separated by single spaces (same as line.split(' ')) as int32 array'''
+        cdef Py_ssize_t length, i, begin = 0
+        cdef const unsigned char *data = <const unsigned char*> PyUnicode_AsUTF8AndSize(line, &length)
+        cdef long num_words = 1, index = 0
+        cdef np.ndarray ids
+        cdef int *id_data
+        for i in range(length):
+            if data[i] == 32:
+                num_words += 1
+        ids = np.empty(num_words, np.int32)
+        id_data = <int*> np.PyArray_DATA(ids)
+        for i in range(length + 1):
+            if i == length or data[i] == 32:
+                id_data[index] = self.lookup(data + begin, i - begin, register, default)
+                index += 1
+                begin = i + 1
+        return ids
+
+    cpdef tuple encode_lines(self, lines, bint register=True, long default=-1):
+        '''IDs of the words in all the lines flattened into int32 array, and int64 offsets of each line (len(lines)+1)'''
+        cdef str line
+        cdef list chunks = []
+        cdef list lengths = [0]
+        cdef np.ndarray ids
+        for line in lines:
+            ids = self.encode(line, register, default)
+            chunks.append(ids)
+            lengths.append(len(ids))
+        if not chunks:
+            return np.zeros(0, np.int32), np.zeros(1, np.int64)
+        return np.concatenate(chunks), np.cumsum(lengths, dtype=np.int64)
+
+    cpdef list decode(self, ids):
+        '''strings of given IDs'''
+        return [self.id2str(number) for number in np.asarray(ids, np.int64).tolist()]
+
+    cpdef str decode_line(self, ids):
+        '''line of the strings of given IDs separated by spaces'''
+        return str.join(' ', self.decode(ids))
+
+    cpdef void save(self, str path) except *:
+        '''store into a file which can be memory-mapped by load()'''
+        cdef long pool_size = self.offsets[self.count]
+        with open(path, 'wb') as fobj:
+            fobj.write(ENUMERATOR_MAGIC)
+            fobj.write(np.array([self.count, pool_size, len(self.table_array), 0], np.int64).tobytes())
+            fobj.write(self.offsets_array[:self.count+1].tobytes())
+            fobj.write(self.table_array.tobytes())
+            fobj.write(self.pool_array[:pool_size].tobytes())
+
+    @staticmethod
+    def load(str path, mmap=True):
+        '''restore the enumerator stored by save() (memory-mapped by default, copied on first registration)'''
+        cdef StringEnumerator enumerator = StringEnumerator()
+        cdef long count, pool_size, table_size, offset
+        with open(path, 'rb') as fobj:
+            if fobj.read(len(ENUMERATOR_MAGIC)) != ENUMERATOR_MAGIC:
+                raise ValueError("not a file saved by StringEnumerator: %s" % path)
+            count, pool_size, table_size, _ = np.frombuffer(fobj.read(8 * 4), np.int64).tolist()
+        offset = ENUMERATOR_HEADER_SIZE
+        enumerator.offsets_array = np.memmap(path, np.int64, 'r', offset, (count+1,))
+        offset += (count + 1) * 8
+        enumerator.table_array = np.memmap(path, np.int64, 'r', offset, (table_size,))
+        offset += table_size * 8
+        if pool_size > 0:
+            enumerator.pool_array = np.memmap(path, np.uint8, 'r', offset, (pool_size,))
+        if not mmap:
+            enumerator.offsets_array = np.array(enumerator.offsets_array)
+            enumerator.table_array = np.array(enumerator.table_array)
+            enumerator.pool_array = np.array(enumerator.pool_array)
+        enumerator.count = count
+        enumerator.refresh()
+        return enumerator
+
     def ids(self):
-        cdef long i = 0, length = len(self.list_id2str)
+        cdef long i = 0, length = self.count
         while i < length:
             yield i
             i += 1
 
     def strings(self):
-        cdef str string
-        for string in self.list_id2str:
-            yield string
+        cdef long i
+        for i in range(self.count):
+            yield self.id2str(i)
 
     def __iter__(self):
         return self.strings()
 
+    def __contains__(self, str string):
+        return self.get(string) >= 0
+
     def __len__(self):
-        return len(self.list_id2str)
+        return self.count
 
 cdef StringEnumerator word_enum   = StringEnumerator()
 cdef StringEnumerator phrase_enum = StringEnumerator()
 
 cpdef long word2id(str word):
     return word_enum.str2id(word)
-    #return wordMap[word]
 
 cpdef str id2word(long number):
     return word_enum.id2str(number)
-    #return wordMap.id2str(number)
 
 cpdef str phrase2idvec(str phrase):
     if not phrase:
@@ -83,11 +251,80 @@ cpdef str idvec2phrase(str idvec):
         return ''
     return str.join(' ', map(id2word, map(int, idvec.split(','))))
 
+cpdef tuple phrases2ids(phrases, bint register=True):
+    '''word IDs of the phrases (list or iterable) packed into int32 array, and int64 offsets of each phrase
+    (unknown words get -1 if not registering)'''
+    cdef str phrase
+    cdef list chunks = []
+    cdef list lengths = [0]
+    cdef np.ndarray ids
+    for phrase in phrases:
+        phrase = phrase.strip()
+        if phrase:
+            ids = word_enum.encode(phrase, register)
+        else:
+            ids = np.zeros(0, np.int32)
+        chunks.append(ids)
+        lengths.append(len(ids))
+    if not chunks:
+        return np.zeros(0, np.int32), np.zeros(1, np.int64)
+    return np.concatenate(chunks), np.cumsum(lengths, dtype=np.int64)
+
+cpdef list ids2phrases(word_ids, offsets):
+    '''phrases of the word IDs packed by phrases2ids()'''
+    cdef list words = word_enum.decode(word_ids)
+    cdef list bounds = np.asarray(offsets, np.int64).tolist()
+    cdef long i
+    return [str.join(' ', words[bounds[i]:bounds[i+1]]) for i in range(len(bounds) - 1)]
+
+cpdef np.ndarray ids2phrase_ids(word_ids, offsets, bint register=True):
+    '''phrase IDs of the word ID sequences packed by phrases2ids() (-1 for unknown phrases if not registering)'''
+    cdef np.ndarray ids = np.ascontiguousarray(word_ids, np.int32)
+    cdef np.ndarray bounds = np.ascontiguousarray(offsets, np.int64)
+    cdef np.ndarray phrase_ids = np.empty(len(bounds) - 1, np.int64)
+    cdef const unsigned char *data = <const unsigned char*> np.PyArray_DATA(ids)
+    cdef int64_t *bound_data = <int64_t*> np.PyArray_DATA(bounds)
+    cdef int64_t *phrase_data = <int64_t*> np.PyArray_DATA(phrase_ids)
+    cdef long i
+    # the bytes of int32 word ID sequence is the key of phrase
+    for i in range(len(phrase_ids)):
+        phrase_data[i] = phrase_enum.lookup(data + bound_data[i] * 4, (bound_data[i+1] - bound_data[i]) * 4, register, -1)
+    return phrase_ids
+
+cpdef tuple phrase_ids2ids(phrase_ids):
+    '''word IDs of the phrases of given phrase IDs packed into int32 array with int64 offsets'''
+    cdef np.ndarray numbers = np.ascontiguousarray(phrase_ids, np.int64)
+    cdef np.ndarray bounds = np.zeros(len(numbers) + 1, np.int64)
+    cdef np.ndarray ids
+    cdef int64_t *number_data = <int64_t*> np.PyArray_DATA(numbers)
+    cdef int64_t *bound_data = <int64_t*> np.PyArray_DATA(bounds)
+    cdef unsigned char *id_data
+    cdef long i, number
+    for i in range(len(numbers)):
+        number = number_data[i]
+        if not (0 <= number < phrase_enum.count):
+            raise IndexError("id %s is not registered in vocabulary set" % (number,))
+        bound_data[i+1] = bound_data[i] + (phrase_enum.offsets[number+1] - phrase_enum.offsets[number]) // 4
+    ids = np.empty(bounds[-1], np.int32)
+    id_data = <unsigned char*> np.PyArray_DATA(ids)
+    for i in range(len(numbers)):
+        number = number_data[i]
+        memcpy(id_data + bound_data[i] * 4, phrase_enum.pool + phrase_enum.offsets[number],
+               phrase_enum.offsets[number+1] - phrase_enum.offsets[number])
+    return ids, bounds
+
+cpdef list phrase_ids2phrases(phrase_ids):
+    '''phrases of given phrase IDs'''
+    return ids2phrases(*phrase_ids2ids(phrase_ids))
+
+cpdef np.ndarray phrases2phrase_ids(phrases, bint register=True):
+    '''phrase IDs of the phrases (list or iterable) as int64 array (-1 for unknown phrases if not registering)'''
+    cdef np.ndarray word_ids, offsets
+    word_ids, offsets = phrases2ids(phrases, register)
+    return ids2phrase_ids(word_ids, offsets, register)
+
 cpdef long phrase2id(str phrase):
-    cdef str idvec = str.join(',', map(str, map(word2id, phrase.split(' '))))
-    return phraseMap[idvec]
+    return phrases2phrase_ids([phrase])[0]
 
 cpdef str id2phrase(long number):
-    cdef str idvec = phraseMap.id2str(number)
-    return str.join(' ', map(id2word, map(int, idvec.split(','))))
-
+    return phrase_ids2phrases([number])[0]
@@ -5,30 +5,245 @@
 #from libcpp cimport bool
 from libcpp.string cimport string
 #from libcpp.vector cimport vector
-from libcpp.deque cimport deque
+#from libcpp.deque cimport deque
 #from libcpp.list cimport list as stl_list
 #ctypedef unsigned char byte
+from libc.stdint cimport int64_t
+from libc.string cimport memcmp, memcpy
+
+# Standard libraries
+import pickle
 
 # 3rd party library
 import cedar
+import numpy as np
+cimport numpy as np
 
 # Local libraries
 from common import compat
 
 '''Dictionaries and ID Maps implemented by Double-Array Trie'''
 
+# header of the file saved by IDMap.save() (followed by 4 int64 numbers: number of IDs, number of keys, pool size, numEmpty)
+IDMAP_MAGIC = b'IDMAP001'
+IDMAP_HEADER_SIZE = 8 + 8 * 4
+
+cdef np.ndarray grown(np.ndarray array, long needed):
+    '''array itself if writable and large enough, otherwise its writable copy with room for needed elements'''
+    cdef np.ndarray new_array
+    if needed <= len(array) and array.flags.writeable:
+        return array
+    new_array = np.empty(max(needed, len(array) * 2, 16), array.dtype)
+    new_array[:len(array)] = array
+    return new_array
+
+cdef class KeyPool:
+    '''keys of IDs stored in contiguous UTF-8 string pool with offsets,
+    and the IDs sorted by their keys for binary search (only while frozen)'''
+    cdef np.ndarray pool_array
+    cdef np.ndarray begins_array
+    cdef np.ndarray ends_array
+    cdef np.ndarray sorted_array
+    cdef unsigned char *pool
+    cdef int64_t *begins
+    cdef int64_t *ends
+    cdef readonly long num_ids
+    cdef long pool_size
+    cdef readonly long end_offset
+
+    def __cinit__(self):
+        self.pool_array = np.zeros(0, np.uint8)
+        self.begins_array = np.zeros(0, np.int64)
+        self.ends_array = np.zeros(0, np.int64)
+        self.sorted_array = None
+        self.num_ids = 0
+        self.pool_size = 0
+        self.end_offset = 0
+        self.refresh()
+
+    cdef void refresh(self) except *:
+        '''update the raw pointers to the arrays after reallocation'''
+        self.pool = <unsigned char*> np.PyArray_DATA(self.pool_array)
+        self.begins = <int64_t*> np.PyArray_DATA(self.begins_array)
+        self.ends = <int64_t*> np.PyArray_DATA(self.ends_array)
+
+    cpdef void set_key(self, long num, str key) except *:
+        cdef bytes data = compat.to_bytes(key)
+        cdef long i
+        self.pool_array = grown(self.pool_array, self.pool_size + len(data))
+        self.begins_array = grown(self.begins_array, max(num + 1, self.num_ids))
+        self.ends_array = grown(self.ends_array, max(num + 1, self.num_ids))
+        self.refresh()
+        for i in range(self.num_ids, num):
+            self.begins[i] = self.ends[i] = -1
+        memcpy(self.pool + self.pool_size, <char*> data, len(data))
+        self.begins[num] = self.pool_size
+        self.ends[num] = self.pool_size + len(data)
+        self.pool_size += len(data)
+        self.num_ids = max(self.num_ids, num + 1)
+        self.sorted_array = None
+
+    cpdef void clear_key(self, long num) except *:
+        if self.has_key(num):
+            self.begins_array = grown(self.begins_array, self.num_ids)
+            self.ends_array = grown(self.ends_array, self.num_ids)
+            self.refresh()
+            self.begins[num] = self.ends[num] = -1
+            self.sorted_array = None
+
+    cpdef void trim(self) except *:
+        '''drop the trailing IDs without keys'''
+        while self.num_ids > 0 and not self.has_key(self.num_ids - 1):
+            self.num_ids -= 1
+
+    cpdef bint has_key(self, long num):
+        return 0 <= num < self.num_ids and self.begins[num] >= 0
+
+    cpdef str get_key(self, long num):
+        if not self.has_key(num):
+            raise IndexError(num)
+        return compat.to_str(self.pool[self.begins[num]:self.ends[num]])
+
+    cdef int compare(self, long num, const unsigned char *data, long length):
+        '''negative, zero or positive if the key of ID is less than, equal to or greater than given bytes'''
+        cdef long key_length = self.ends[num] - self.begins[num]
+        cdef int result = memcmp(self.pool + self.begins[num], data, min(key_length, length))
+        if result != 0:
+            return result
+        return (key_length > length) - (key_length < length)
+
+    cpdef void freeze(self) except *:
+        '''sort the IDs by their keys to find keys by binary search'''
+        cdef list pairs = []
+        cdef long num
+        for num in range(self.num_ids):
+            if self.has_key(num):
+                pairs.append( (self.pool[self.begins[num]:self.ends[num]], num) )
+        pairs.sort()
+        self.sorted_array = np.array([num for key, num in pairs], np.int64)
+
+    cpdef long find(self, str key) except? -2:
+        '''ID of given key, or -1 if not found (available only while frozen)'''
+        cdef bytes data = compat.to_bytes(key)
+        cdef int64_t *sorted_ids = <int64_t*> np.PyArray_DATA(self.sorted_array)
+        cdef long low = 0, high = len(self.sorted_array), middle
+        cdef int result
+        while low < high:
+            middle = (low + high) // 2
+            result = self.compare(sorted_ids[middle], <unsigned char*> data, len(data))
+            if result == 0:
+                return sorted_ids[middle]
+            elif result < 0:
+                low = middle + 1
+            else:
+                high = middle
+        return -1
+
+    def sorted_ids(self):
+        '''IDs in order of their keys (available only while frozen)'''
+        return iter(self.sorted_array.tolist())
+
+    def __len__(self):
+        return len(self.sorted_array)
+
+    cpdef void save(self, object fobj, long num_empty) except *:
+        '''write the keys in the format loaded by load() (the pool is compacted in order of IDs)'''
+        cdef list chunks = []
+        cdef np.ndarray begins = np.full(self.num_ids, -1, np.int64)
+        cdef np.ndarray ends = np.full(self.num_ids, -1, np.int64)
+        cdef long num, pool_size = 0
+        if self.sorted_array is None:
+            self.freeze()
+        for num in range(self.num_ids):
+            if self.has_key(num):
+                chunks.append(self.pool_array[self.begins[num]:self.ends[num]].tobytes())
+                begins[num] = pool_size
+                pool_size += len(chunks[-1])
+                ends[num] = pool_size
+        fobj.write(IDMAP_MAGIC)
+        fobj.write(np.array([self.num_ids, len(self.sorted_array), pool_size, num_empty], np.int64).tobytes())
+        fobj.write(begins.tobytes())
+        fobj.write(ends.tobytes())
+        fobj.write(self.sorted_array.tobytes())
+        fobj.write(b''.join(chunks))
+
+    @staticmethod
+    def load(str path, mmap=True):
+        '''read the frozen keys saved by save() (memory-mapped by default), and numEmpty of the saved map'''
+        cdef KeyPool key_pool = KeyPool()
+        cdef long num_ids, num_keys, pool_size, num_empty, offset
+        with open(path, 'rb') as fobj:
+            if fobj.read(len(IDMAP_MAGIC)) != IDMAP_MAGIC:
+                raise ValueError("not a file saved by IDMap: %s" % path)
+            num_ids, num_keys, pool_size, num_empty = np.frombuffer(fobj.read(8 * 4), np.int64).tolist()
+        offset = IDMAP_HEADER_SIZE
+        arrays = []
+        for dtype, size in [(np.int64, num_ids), (np.int64, num_ids), (np.int64, num_keys), (np.uint8, pool_size)]:
+            if size == 0:
+                arrays.append(np.zeros(0, dtype))
+            elif mmap:
+                arrays.append(np.memmap(path, dtype, 'r', offset, (size,)))
+            else:
+                arrays.append(np.fromfile(path, dtype, size, offset=offset))
+            offset += size * np.dtype(dtype).itemsize
+        key_pool.begins_array, key_pool.ends_array, key_pool.sorted_array, key_pool.pool_array = arrays
+        key_pool.num_ids = num_ids
+        key_pool.pool_size = pool_size
+        key_pool.end_offset = offset
+        key_pool.refresh()
+        return key_pool, num_empty
+
 cdef class IDMap:
     '''auto mapping class from string to unique int'''
     cdef object trie
     cdef list unusedIDs
     cdef int numEmpty
+    # keys opened from file (used instead of the trie until modified)
+    cdef KeyPool frozen
 
     def __cinit__(self):
         self.trie      = cedar.trie()
         self.unusedIDs = list()
         self.numEmpty   = 0
+        self.frozen    = None
+
+    cpdef void save(self, str path) except *:
+        '''store into a file which can be memory-mapped by open()'''
+        cdef KeyPool key_pool = self.frozen
+        if key_pool is None:
+            key_pool = KeyPool()
+            for key, n in IDMap.items(self):
+                if key:
+                    key_pool.set_key(n, key)
+        with open(path, 'wb') as fobj:
+            key_pool.save(fobj, self.numEmpty)
+
+    @classmethod
+    def open(cls, str path, mmap=True):
+        '''map stored by save() (memory-mapped by default, so processes share the pages until modifying it)'''
+        cdef IDMap idmap = cls()
+        key_pool, num_empty = KeyPool.load(path, mmap)
+        idmap.attach(key_pool, num_empty)
+        return idmap
+
+    cdef void attach(self, KeyPool key_pool, int num_empty):
+        self.frozen = key_pool
+        self.numEmpty = num_empty
+
+    cdef void thaw(self) except *:
+        '''build the trie from the keys opened from file to modify the map'''
+        cdef KeyPool key_pool = self.frozen
+        cdef long n
+        if key_pool is None:
+            return
+        self.frozen = None
+        for n in range(1, key_pool.num_ids):
+            if key_pool.has_key(n):
+                self.trie[key_pool.get_key(n)] = n
+            else:
+                self.unusedIDs.append(n)
 
-    cpdef long append(self, str key):
+    cpdef long append(self, str key) except? -2:
         cdef long n = self.str2id(key)
         if not key:
             self.numEmpty = 1
@@ -36,6 +251,7 @@ cdef class IDMap:
         elif n >= 0:
             return n
         else:
+            self.thaw()
             if len(self.unusedIDs) > 0:
                 n = self.unusedIDs.pop()
             else:
@@ -46,23 +262,36 @@ cdef class IDMap:
     def ids(self):
         if self.numEmpty > 0:
             yield 0
+        if self.frozen is not None:
+            for n in self.frozen.sorted_ids():
+                yield n
+            return
         for r in self.trie.predict(''):
             yield r.value()
 
     def items(self):
         if self.numEmpty > 0:
             yield ('', 0)
+        if self.frozen is not None:
+            for n in self.frozen.sorted_ids():
+                yield (self.frozen.get_key(n), n)
+            return
         for r in self.trie.predict(''):
             yield (r.key(), r.value())
 
     def keys(self):
         if self.numEmpty > 0:
             yield ''
+        if self.frozen is not None:
+            for n in self.frozen.sorted_ids():
+                yield self.frozen.get_key(n)
+            return
         for r in self.trie.predict(''):
             yield r.key()
 
-    cpdef long remove(self, str key):
+    cpdef long remove(self, str key) except? -2:
         cdef long n = self.str2id(key)
+        self.thaw()
         if n == 0:
             self.numEmpty = 0
             return 0
@@ -73,12 +302,14 @@ cdef class IDMap:
         else:
             raise KeyError(key)
 
-    cpdef long str2id(self, str key):
+    cpdef long str2id(self, str key) except? -2:
         if not key:
             if self.numEmpty > 0:
                 return 0
             else:
                 return -1
+        if self.frozen is not None:
+            return self.frozen.find(key)
         try:
             return self.trie[key]
         except:
@@ -93,99 +324,71 @@ cdef class IDMap:
     def __iter__(self):
         return self.keys()
     def __len__(self):
+        if self.frozen is not None:
+            return len(self.frozen) + self.numEmpty
         return self.trie.num_keys() + self.numEmpty
 
 cdef class TwoWayIDMap(IDMap):
     '''auto mapping class from string to unique int and vice versa'''
     #cdef list keyList
-    cdef deque[string] keyList
+    #cdef deque[string] keyList
+    # keys of IDs in string pool (shared with the frozen keys while opened from file)
+    cdef KeyPool keyPool
 
     def __cinit__(self):
         IDMap.__init__(self)
         #self.keyList = [None]
-        self.keyList.clear()
-        self.keyList.push_back(b'')
+        self.keyPool = KeyPool()
+
+    cdef void attach(self, KeyPool key_pool, int num_empty):
+        IDMap.attach(self, key_pool, num_empty)
+        self.keyPool = key_pool
 
-    cpdef long append(self, str key):
+    cpdef long append(self, str key) except? -2:
         cdef long n = IDMap.append(self, key)
-        #if n >= len(self.keyList):
-        if n >= self.keyList.size():
-            #self.keyList.append(key)
-            self.keyList.push_back(compat.to_bytes(key))
-        else:
-            #self.keyList[n] = key
-            self.keyList[n] = compat.to_bytes(key)
+        if key and not self.keyPool.has_key(n):
+            self.keyPool.set_key(n, key)
         return n
 
     cpdef str id2str(self, long num):
-        #cdef object key = self.keyList[num]
-        cdef string key
         if num == 0 and self.numEmpty > 0:
             return ''
-        key = self.keyList[num]
         #if key:
-        if not key.empty():
-            #return key
-            return compat.to_str(key)
+        if self.keyPool.has_key(num):
+            return self.keyPool.get_key(num)
         else:
             #raise IndexError(key)
-            raise IndexError(compat.to_str(key))
+            raise IndexError(num)
 
     def ids(self):
         cdef long i
-        cdef string k
-        #cdef object k
-        #for i, k in enumerate(self.keyList):
-        #    if k is not None:
-        #        yield i
         if self.numEmpty == 1:
             yield 0
-        for i in range(1, self.keyList.size()):
-            k = self.keyList[i]
-            if not k.empty():
-                yield k
+        for i in range(1, self.keyPool.num_ids):
+            if self.keyPool.has_key(i):
+                yield i
 
     def items(self):
         cdef long i
-        cdef object k
-        #for i, k in enumerate(self.keyList):
-        #    if k is not None:
-        #        yield (k, i)
-        for i in range(1, self.keyList.size()):
-            k = self.keyList[i]
-            if not k.empty():
+        for i in range(1, self.keyPool.num_ids):
+            if self.keyPool.has_key(i):
                 #yield (i, k)
-                yield (i, compat.to_str(k))
+                yield (i, self.keyPool.get_key(i))
 
     def keys(self):
         cdef long i
-        cdef object k
-        #for k in self.keyList:
-        #    if k is not None:
-        #        yield k
-        for i in range(1, self.keyList.size()):
-            k = self.keyList[i]
-            if not k.empty():
-                #yield k
-                yield compat.to_str(k)
-
-    cpdef void purge(self):
-        while True:
-            #if len(self.keyList) <= 1:
-            if self.keyList.size() <= 1:
-                break
-            #if self.keyList[-1] is None:
-            if self.keyList.back().empty():
-                #self.keyList.pop()
-                self.keyList.pop_back()
-            else:
-                break
+        for i in range(1, self.keyPool.num_ids):
+            if self.keyPool.has_key(i):
+                yield self.keyPool.get_key(i)
 
-    cpdef long remove(self, str key):
+    cpdef void purge(self) except *:
+        self.keyPool.trim()
+
+    cpdef long remove(self, str key) except? -2:
         cdef long n = IDMap.remove(self, key)
         if n >= 0:
             #self.keyList[n] = None
-            self.keyList[n] = b''
+            self.keyPool.clear_key(n)
         else:
             raise KeyError(key)
 
@@ -205,6 +408,22 @@ cdef class Dict:
         self.idmap = IDMap()
         self.objectList = [None]
 
+    cpdef void save(self, str path) except *:
+        '''store the keys in the format of IDMap.save() followed by the pickled values'''
+        self.idmap.save(path)
+        with open(path, 'ab') as fobj:
+            pickle.dump(self.objectList, fobj, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def open(cls, str path, mmap=True):
+        '''dictionary stored by save() (the keys are memory-mapped by default)'''
+        cdef Dict dictionary = cls()
+        dictionary.idmap = IDMap.open(path, mmap)
+        with open(path, 'rb') as fobj:
+            fobj.seek(dictionary.idmap.frozen.end_offset)
+            dictionary.objectList = pickle.load(fobj)
+        return dictionary
+
     cpdef object get(self, str key, object default=None):
         cdef long n = self.idmap.str2id(key)
         if n >= 0:
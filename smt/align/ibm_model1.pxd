@@ -4,30 +4,86 @@ cimport numpy as np
 from nlputils.common.config cimport Config
 from nlputils.common.vocab  cimport StringEnumerator
 
+cdef class Corpus:
+    cdef readonly np.ndarray src_ids
+    cdef readonly np.ndarray src_offsets
+    cdef readonly np.ndarray trg_ids
+    cdef readonly np.ndarray trg_offsets
+
+    cpdef void save(self, str path) except *
+    cpdef tuple pair_ids(self, long index)
+    cpdef tuple pair_grid(self, long begin, long end)
+
 cdef class Vocab:
     cdef StringEnumerator src
     cdef StringEnumerator trg
+    cdef readonly bint map_unknown
 
     cdef void init(self)
+    cpdef void build(self, str src_path, str trg_path, long min_count=*, long max_vocab=*) except *
     cpdef tuple ids_pair_to_str_pair(self, src_ids, trg_ids)
+    cdef np.ndarray line_to_ids(self, StringEnumerator vocab, str line, bint register=*)
+    cdef Corpus encode_lines(self, src_lines, trg_lines, bint register)
+    cpdef Corpus encode_pairs(self, list src_lines, list trg_lines, bint register=*)
     cpdef list load_sent_pairs(self, str src_path, str trg_path)
+    cpdef Corpus load_corpus(self, str src_path, str trg_path)
+    cpdef void save(self, str path) except *
+    cpdef void load(self, str path) except *
 
 cdef class Model:
     cdef Vocab vocab
-    cdef np.ndarray trans_dist
+    cdef public np.ndarray trans_probs
+    cdef public np.ndarray trans_keys
+    cdef public long src_vocab_size
+    cdef public long trg_vocab_size
+    cdef np.ndarray row_starts
+    cdef object row_keys
+    cdef tuple row_state
 
     cdef void init(self)
+    cpdef void save(self, str path) except *
+    cpdef np.ndarray make_keys(self, np.ndarray src_words, np.ndarray trg_words)
+    cpdef np.ndarray pair_keys(self, src_ids, trg_ids)
+    cdef np.ndarray src_row_starts(self)
+    cpdef np.ndarray find_params(self, np.ndarray keys)
+    cpdef np.ndarray pair_probs(self, np.ndarray keys)
+    cpdef void estimate(self, np.ndarray counts) except *
+    cdef np.ndarray sent_entropies(self, Corpus corpus, long begin, long end, np.ndarray trg_tokens, np.ndarray trg_factor,
+                                   double min_prob=*)
+    cpdef double add_expected_counts(self, Corpus corpus, long begin, long end, np.ndarray counts) except *
+    cpdef np.ndarray calc_entropies(self, Corpus corpus, long begin, long end, double min_prob=*)
+    cpdef np.ndarray score_pairs(self, list src_lines, list trg_lines, double oov_prob=*)
+    cpdef double sum_entropy(self, Corpus corpus, long begin, long end) except *
     cpdef double calc_pair_entropy(self, list src_sent, list trg_sent)
     cpdef double calc_entropy(self, list sent_pairs)
-    cpdef void calc_and_save_scores(self, out_path, list sent_pairs)
-    cpdef void save_align(self, out_path, threshold)
+    cpdef void calc_and_save_scores(self, out_path, Corpus corpus) except *
+    cpdef void save_align(self, out_path, double threshold, long top_k=*, str align_format=*) except *
 
 cdef class Trainer:
     cdef Model model
     cdef str src_path
     cdef str trg_path
-    cdef list sent_pairs
+    cdef str corpus_path
     cdef np.ndarray cooc_src_trg
+    cdef bint sparse
+    cdef Corpus corpus
+    cdef long batch_size
+    cdef int workers
+    cdef object pool
+    cdef str work_dir
+    cdef object shared_probs
+    cdef object shared_counts
+    cdef str checkpoint_path
+    cdef bint resume
+    cdef int iteration
+    cdef list entropy_history
+    cdef double tolerance
+    cdef object dtype
+    cdef long min_count
+    cdef long max_vocab
+    cdef np.ndarray stats
+    cdef long online_steps
+    cdef double online_decay
 
     cdef void init(self)
     #cpdef void init(self)
@@ -35,8 +91,24 @@ cdef class Trainer:
     #    self.model = Model()
 
     cpdef np.ndarray calc_uniform_dist(self)
-    cpdef np.ndarray count_cooccurrence(self, sent_pairs)
-    cpdef void train(self, int iteration_limit)
-    cpdef void train_first(self)
-    cpdef void train_step(self)
+    cpdef np.ndarray count_cooccurrence(self, Corpus corpus)
+    cpdef np.ndarray collect_cooccurrence(self, Corpus corpus)
+    cpdef list split_shards(self)
+    cpdef void start_workers(self) except *
+    cpdef void stop_workers(self) except *
+    cpdef void share_model(self) except *
+    cpdef tuple collect_counts(self)
+    cpdef double calc_entropy(self) except *
+    cpdef void save_checkpoint(self) except *
+    cpdef void load_checkpoint(self) except *
+    cpdef void load_model(self, str path) except *
+    cpdef bint converged(self)
+    cpdef void train(self, int iteration_limit) except *
+    cpdef dict corpus_settings(self)
+    cpdef void check_corpus_settings(self) except *
+    cpdef void load_corpus(self) except *
+    cpdef void train_first(self) except *
+    cpdef double train_step(self) except *
+    cpdef void grow_model(self, Corpus corpus) except *
+    cpdef void train_online(self) except *
 
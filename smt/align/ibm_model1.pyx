@@ -3,10 +3,17 @@
 
 # Standard libraries
 import argparse
+import array
 import itertools
+import json
 import math
+import multiprocessing
+import os.path
+import shutil
 import sys
-from collections import defaultdict
+import tempfile
+import time
+from collections import Counter, defaultdict
 
 # 3-rd party library
 import numpy as np
@@ -26,111 +33,554 @@ ITERATION_LIMIT = 10
 
 NULL_SYMBOL = '__NULL__'
 
+# shared symbol of the words cut off from pruned vocabulary
+UNK_SYMBOL = '__UNK__'
+
+# number of sentence pairs to buffer before merging co-occurring pair keys
+COOC_CHUNK_SIZE = 10000
+
+# number of sentence pairs processed at once in vectorized E-step
+BATCH_SIZE = 5000
+
+# number of parameters examined at once when storing translation probabilities
+ALIGN_CHUNK_SIZE = 1000000
+
+# formats of stored translation probabilities (lexical table text, or sparse model directory loadable by Model.load)
+ALIGN_FORMATS = ['text', 'model']
+
+# probability given to target words not explained by any known source word when scoring new sentence pairs
+OOV_PROB = 1e-7
+
+# default exponent of the step size (k+2)^-decay in stepwise EM (should be in (0.5, 1])
+ONLINE_DECAY = 0.7
+
+# floating point types of translation probabilities and expected counts
+DTYPES = ['float64', 'float32']
+
+# maximum relative difference of the entropies of float32 training from float64 training (checked by compare_dtypes)
+FLOAT32_ENTROPY_TOLERANCE = 1e-5
+
+# default vocabulary size of synthetic corpus for benchmark (the former E-step needs dense matrices of its square)
+BENCHMARK_VOCAB_SIZE = 2000
+
+# arrays of flattened corpus stored in corpus directory
+CORPUS_ARRAYS = ['src_ids', 'src_offsets', 'trg_ids', 'trg_offsets']
+# file in corpus directory recording the parallel text and the vocabulary options the corpus was built from
+CORPUS_SETTINGS = 'corpus.json'
+
 cdef class Vocab:
     # imported from "ibm_model1.pxd"
     #cdef StringEnumerator src
     #cdef StringEnumerator trg
+    #cdef readonly bint map_unknown
 
     def __cinit__(self):
         self.init()
     cdef void init(self):
         self.src = StringEnumerator()
         self.trg = StringEnumerator()
+        self.map_unknown = False
+
+    cpdef void build(self, str src_path, str trg_path, long min_count=1, long max_vocab=0) except *:
+        '''register only the words occurring at least min_count times (and the max_vocab most frequent if given),
+        the other words are mapped into UNK_SYMBOL when loading sentences'''
+        cdef str src_line, trg_line
+        cdef str word
+        cdef long count, total, kept, num_kept
+        src_counts = Counter()
+        trg_counts = Counter()
+        logging.log("counting words: %s %s" % (src_path,trg_path))
+        src_file = progress.view(files.open(src_path), 'counting')
+        trg_file = files.open(trg_path)
+        for src_line, trg_line in zip(src_file, trg_file):
+            src_counts.update(src_line.rstrip("\n").split(' '))
+            trg_counts.update(trg_line.rstrip("\n").split(' '))
+        self.init()
+        self.src.append(NULL_SYMBOL)
+        for side, vocab, counts in [('source', self.src, src_counts), ('target', self.trg, trg_counts)]:
+            total = sum(counts.values())
+            kept_words = [word for word, count in counts.most_common(max_vocab or None) if count >= min_count]
+            # UNK_SYMBOL is registered only if some words are actually mapped into it
+            if len(kept_words) < len(counts):
+                vocab.append(UNK_SYMBOL)
+            kept = num_kept = 0
+            for word in kept_words:
+                vocab.append(word)
+                kept += counts[word]
+                num_kept += 1
+            logging.log("%s vocabulary: kept %s of %s words (covering %.2f%% of tokens)"
+                % (side, num_kept, len(counts), 100.0 * kept / max(total, 1)))
+        self.map_unknown = True
 
     cpdef tuple ids_pair_to_str_pair(self, src_ids, trg_ids):
         cdef src_str = str.join(' ', [self.src.id2str(i) for i in src_ids[:-1]])
         cdef trg_str = str.join(' ', [self.trg.id2str(i) for i in trg_ids])
         return src_str, trg_str
 
-    cpdef list load_sent_pairs(self, str src_path, str trg_path):
+    cdef np.ndarray line_to_ids(self, StringEnumerator vocab, str line, bint register=True):
+        '''IDs of the words in the line, registering new words (or mapping them into UNK_SYMBOL for pruned vocabulary),
+        unknown words get the ID out of the vocabulary (len(vocab)) if not registering'''
+        if self.map_unknown and UNK_SYMBOL in vocab:
+            return vocab.encode(line, False, vocab.get(UNK_SYMBOL))
+        if self.map_unknown:
+            return vocab.encode(line, False, len(vocab))
+        if not register:
+            return vocab.encode(line, False, len(vocab))
+        return vocab.encode(line)
+
+    cdef Corpus encode_lines(self, src_lines, trg_lines, bint register):
+        '''flattened word ID arrays of the sentence pairs given by the lines'''
         cdef str src_line, trg_line
-        cdef list src_words, trg_words
-        cdef list src_ids, trg_ids
-        cdef list sent_pairs
-        cdef str word
+        cdef long null_id = self.src.get(NULL_SYMBOL)
+        cdef Corpus corpus = Corpus()
+        src_ids = array.array('i')
+        trg_ids = array.array('i')
+        src_offsets = array.array('q', [0])
+        trg_offsets = array.array('q', [0])
+        for src_line, trg_line in zip(src_lines, trg_lines):
+            src_ids.frombytes(self.line_to_ids(self.src, src_line.rstrip("\n"), register).tobytes())
+            src_ids.append(null_id)
+            trg_ids.frombytes(self.line_to_ids(self.trg, trg_line.rstrip("\n"), register).tobytes())
+            src_offsets.append(len(src_ids))
+            trg_offsets.append(len(trg_ids))
+        corpus.src_ids = np.frombuffer(src_ids, np.int32)
+        corpus.trg_ids = np.frombuffer(trg_ids, np.int32)
+        corpus.src_offsets = np.frombuffer(src_offsets, np.int64)
+        corpus.trg_offsets = np.frombuffer(trg_offsets, np.int64)
+        return corpus
+
+    cpdef Corpus encode_pairs(self, list src_lines, list trg_lines, bint register=False):
+        '''flattened word ID arrays of the sentence pairs (new words are registered only if register is set)'''
+        return self.encode_lines(src_lines, trg_lines, register)
+
+    cpdef list load_sent_pairs(self, str src_path, str trg_path):
+        cdef Corpus corpus = self.load_corpus(src_path, trg_path)
+        cdef list sent_pairs = []
+        cdef long i
+        for i in range(len(corpus)):
+            src_ids, trg_ids = corpus.pair_ids(i)
+            sent_pairs.append( (src_ids.tolist(), trg_ids.tolist()) )
+        return sent_pairs
+
+    cpdef Corpus load_corpus(self, str src_path, str trg_path):
+        '''tokenize the parallel text directly into flattened word ID arrays'''
         logging.log("loading files: %s %s" % (src_path,trg_path))
         self.src.append(NULL_SYMBOL)
         src_file = progress.view(files.open(src_path), 'loading')
         trg_file = files.open(trg_path)
-        sent_pairs = []
-        for src_line, trg_line in zip(src_file, trg_file):
-            src_words = src_line.rstrip("\n").split(' ')
-            trg_words = trg_line.rstrip("\n").split(' ')
-            src_words.append(NULL_SYMBOL)
-            src_ids = [self.src.str2id(word) for word in src_words]
-            trg_ids = [self.trg.str2id(word) for word in trg_words]
-            sent_pairs.append( (src_ids, trg_ids) )
-        return sent_pairs
+        return self.encode_lines(src_file, trg_file, True)
+
+    cpdef void save(self, str path) except *:
+        '''store the source and target vocabularies into directory (one word per line)'''
+        cdef str word
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name, vocab in [('src.vocab', self.src), ('trg.vocab', self.trg)]:
+            with files.open(os.path.join(path, name), 'wt') as fobj:
+                for word in vocab:
+                    fobj.write(word)
+                    fobj.write("\n")
+
+    cpdef void load(self, str path) except *:
+        '''restore the vocabularies stored by save()'''
+        cdef str line
+        self.init()
+        for name, vocab in [('src.vocab', self.src), ('trg.vocab', self.trg)]:
+            with files.open(os.path.join(path, name), 'rt') as fobj:
+                for line in fobj:
+                    vocab.append(line.rstrip("\n"))
+        self.map_unknown = UNK_SYMBOL in self.src or UNK_SYMBOL in self.trg
+
+cdef class Corpus:
+    '''parallel corpus flattened into concatenated word ID arrays with sentence offsets'''
+    # imported from "ibm_model1.pxd"
+    #cdef readonly np.ndarray src_ids
+    #cdef readonly np.ndarray src_offsets
+    #cdef readonly np.ndarray trg_ids
+    #cdef readonly np.ndarray trg_offsets
+
+    def __cinit__(self, sent_pairs=None):
+        cdef list src_lens, trg_lens
+        if sent_pairs is None:
+            sent_pairs = []
+        src_lens = [len(src_sent) for src_sent, trg_sent in sent_pairs]
+        trg_lens = [len(trg_sent) for src_sent, trg_sent in sent_pairs]
+        self.src_offsets = np.concatenate([[0], np.cumsum(src_lens, dtype=np.int64)])
+        self.trg_offsets = np.concatenate([[0], np.cumsum(trg_lens, dtype=np.int64)])
+        self.src_ids = np.fromiter(itertools.chain.from_iterable(src_sent for src_sent, trg_sent in sent_pairs), np.int32, self.src_offsets[-1])
+        self.trg_ids = np.fromiter(itertools.chain.from_iterable(trg_sent for src_sent, trg_sent in sent_pairs), np.int32, self.trg_offsets[-1])
+
+    cpdef void save(self, str path) except *:
+        '''store the word ID arrays into directory as .npy files'''
+        cdef str name
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        for name in CORPUS_ARRAYS:
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+
+    @staticmethod
+    def load(str path, mmap=True):
+        '''open the word ID arrays stored by save() (memory-mapped by default)'''
+        cdef Corpus corpus = Corpus()
+        mmap_mode = 'r' if mmap else None
+        corpus.src_ids = np.load(os.path.join(path, 'src_ids.npy'), mmap_mode=mmap_mode)
+        corpus.src_offsets = np.load(os.path.join(path, 'src_offsets.npy'), mmap_mode=mmap_mode)
+        corpus.trg_ids = np.load(os.path.join(path, 'trg_ids.npy'), mmap_mode=mmap_mode)
+        corpus.trg_offsets = np.load(os.path.join(path, 'trg_offsets.npy'), mmap_mode=mmap_mode)
+        return corpus
+
+    cpdef tuple pair_ids(self, long index):
+        '''word IDs of source and target sentences of given sentence pair'''
+        return (self.src_ids[self.src_offsets[index]:self.src_offsets[index+1]],
+                self.trg_ids[self.trg_offsets[index]:self.trg_offsets[index+1]])
+
+    cpdef tuple pair_grid(self, long begin, long end):
+        '''all the (source, target) token pairs in the sentence pairs [begin, end)
+
+        return word IDs of source and target tokens of each pair, and index of target token (relative to begin) of each pair'''
+        cdef np.ndarray src_begins, src_lens, trg_lens
+        cdef np.ndarray trg_sents, pair_counts, pair_starts
+        cdef np.ndarray pair_trg, pair_src
+        src_begins = self.src_offsets[begin:end]
+        src_lens = self.src_offsets[begin+1:end+1] - src_begins
+        trg_lens = self.trg_offsets[begin+1:end+1] - self.trg_offsets[begin:end]
+        # sentence of each target token
+        trg_sents = np.repeat(np.arange(end - begin), trg_lens)
+        # each target token is paired with all the source tokens in the same sentence
+        pair_counts = src_lens[trg_sents]
+        pair_starts = np.cumsum(pair_counts) - pair_counts
+        pair_trg = np.repeat(np.arange(len(trg_sents)), pair_counts)
+        pair_src = np.arange(pair_counts.sum())
+        pair_src += np.repeat(src_begins[trg_sents] - pair_starts, pair_counts)
+        return self.src_ids[pair_src], self.trg_ids[self.trg_offsets[begin] + pair_trg], pair_trg
+
+    def __len__(self):
+        return len(self.src_offsets) - 1
 
 cdef tuple grid_indices(list x_indices, list y_indices):
     cdef np.ndarray indices1, indices2
     indices1, indices2 = np.meshgrid(x_indices, y_indices, sparse=True)
     return indices1.T, indices2.T
 
-cdef np.ndarray sub_matrix(np.ndarray matrix, list x_indices, list y_indices):
-    return matrix[grid_indices(x_indices, y_indices)]
-
-cdef void add_sub_matrix(np.ndarray target_matrix, list x_indices, list y_indices, np.ndarray source_matrix):
-    cdef np.ndarray indices1, indices2
-    indices1, indices2 = grid_indices(x_indices, y_indices)
-    np.add.at(target_matrix, (indices1,indices2), source_matrix[indices1,indices2])
-
 cdef class Model:
     # imported from "ibm_model1.pxd"
-    #cdef np.ndarray trans_dist
     #cdef Vocab vocab
+    #cdef public np.ndarray trans_probs
+    #cdef public np.ndarray trans_keys
+    #cdef public long src_vocab_size
+    #cdef public long trg_vocab_size
 
     def __cinit__(self):
         self.init()
     cdef inline void init(self):
         self.vocab = Vocab()
+        self.trans_probs = np.zeros(0, np.float64)
+        self.trans_keys = None
+        self.src_vocab_size = 0
+        self.trg_vocab_size = 0
+
+    cpdef void save(self, str path) except *:
+        '''store the vocabularies and the translation probabilities into directory as memory-mappable files'''
+        self.vocab.save(path)
+        np.save(os.path.join(path, 'trans_probs.npy'), self.trans_probs)
+        if self.trans_keys is not None:
+            np.save(os.path.join(path, 'trans_keys.npy'), self.trans_keys)
+        with files.open(os.path.join(path, 'model.json'), 'wt') as fobj:
+            json.dump({'src_vocab_size': self.src_vocab_size, 'trg_vocab_size': self.trg_vocab_size}, fobj)
+
+    @staticmethod
+    def load(str path, mmap=True):
+        '''restore the model stored by save() (translation probabilities are memory-mapped by default)'''
+        cdef Model model = Model()
+        mmap_mode = 'r' if mmap else None
+        with files.open(os.path.join(path, 'model.json'), 'rt') as fobj:
+            sizes = json.load(fobj)
+        model.vocab.load(path)
+        model.src_vocab_size = sizes['src_vocab_size']
+        model.trg_vocab_size = sizes['trg_vocab_size']
+        model.trans_probs = np.load(os.path.join(path, 'trans_probs.npy'), mmap_mode=mmap_mode)
+        if os.path.exists(os.path.join(path, 'trans_keys.npy')):
+            model.trans_keys = np.load(os.path.join(path, 'trans_keys.npy'), mmap_mode=mmap_mode)
+        return model
+
+    property sparse:
+        def __get__(self): return self.trans_keys is not None
+
+    property trans_dist:
+        '''word translation probabilities as dense matrix (only for dense model)'''
+        def __get__(self):
+            if self.trans_keys is not None:
+                raise TypeError("sparse model does not hold dense translation matrix")
+            return self.trans_probs.reshape([-1, self.trg_vocab_size])
+
+    cpdef np.ndarray make_keys(self, np.ndarray src_words, np.ndarray trg_words):
+        '''keys (src_id * |Vtrg| + trg_id) of the word pairs (-1 for the words out of the model vocabularies)'''
+        cdef np.ndarray keys = src_words.astype(np.int64) * self.trg_vocab_size + trg_words
+        cdef np.ndarray unknown = (src_words >= self.src_vocab_size) | (trg_words >= self.trg_vocab_size)
+        if unknown.any():
+            keys[unknown] = -1
+        return keys
+
+    cpdef np.ndarray pair_keys(self, src_ids, trg_ids):
+        '''keys of all the word pairs in grid of given source and target words'''
+        cdef np.ndarray src_array = np.asarray(src_ids, np.int64).reshape([-1,1])
+        cdef np.ndarray trg_array = np.asarray(trg_ids, np.int64).reshape([1,-1])
+        return self.make_keys(src_array, trg_array)
+
+    cdef np.ndarray src_row_starts(self):
+        '''positions in trans_keys where the keys of each source word begin (rebuilt when the model changes)'''
+        cdef tuple row_state = (self.src_vocab_size, self.trg_vocab_size)
+        if self.row_keys is not self.trans_keys or self.row_state != row_state:
+            self.row_starts = np.searchsorted(self.trans_keys, np.arange(self.src_vocab_size + 1, dtype=np.int64) * self.trg_vocab_size).astype(np.int64)
+            self.row_keys = self.trans_keys
+            self.row_state = row_state
+        return self.row_starts
+
+    cpdef np.ndarray find_params(self, np.ndarray keys):
+        '''indices of trans_probs for given pair keys (-1 for unknown pairs in sparse model)'''
+        cdef np.ndarray indices, flat_keys, trans_keys_array, row_starts_array
+        cdef const np.int64_t *trans_keys
+        cdef const np.int64_t *row_starts
+        cdef const np.int64_t *key_ptr
+        cdef np.int64_t *index_ptr
+        cdef np.int64_t key, row, low, high, middle
+        cdef long src_size = self.src_vocab_size
+        cdef long trg_size = self.trg_vocab_size
+        cdef Py_ssize_t i
+        if self.trans_keys is None:
+            return keys
+        if len(self.trans_keys) == 0:
+            return np.full_like(keys, -1)
+        trans_keys_array = np.ascontiguousarray(self.trans_keys, np.int64)
+        row_starts_array = self.src_row_starts()
+        flat_keys = np.ascontiguousarray(keys, np.int64).reshape(-1)
+        indices = np.empty(len(flat_keys), np.int64)
+        trans_keys = <const np.int64_t*> np.PyArray_DATA(trans_keys_array)
+        row_starts = <const np.int64_t*> np.PyArray_DATA(row_starts_array)
+        key_ptr = <const np.int64_t*> np.PyArray_DATA(flat_keys)
+        index_ptr = <np.int64_t*> np.PyArray_DATA(indices)
+        # search only in the keys of the same source word,
+        # starting from the position the key would take if the target words of the row were spread evenly
+        for i in range(len(flat_keys)):
+            key = key_ptr[i]
+            index_ptr[i] = -1
+            if key < 0:
+                continue
+            row = key // trg_size
+            if row >= src_size:
+                continue
+            low = row_starts[row]
+            high = row_starts[row + 1]
+            middle = low + (key - row * trg_size) * (high - low) // trg_size
+            while low < high:
+                if trans_keys[middle] == key:
+                    low = middle
+                    break
+                elif trans_keys[middle] < key:
+                    low = middle + 1
+                else:
+                    high = middle
+                middle = (low + high) >> 1
+            if low < row_starts[row + 1] and trans_keys[low] == key:
+                index_ptr[i] = low
+        return indices.reshape(np.shape(keys))
+
+    cpdef np.ndarray pair_probs(self, np.ndarray keys):
+        '''translation probabilities for given pair keys (0 for unknown pairs)'''
+        cdef np.ndarray indices = self.find_params(keys)
+        return np.where(indices >= 0, self.trans_probs[indices], 0)
+
+    cpdef void estimate(self, np.ndarray counts) except *:
+        '''estimate translation probabilities from expected co-occurrence counts of the parameters'''
+        cdef np.ndarray count_matrix, src_ids, total_src
+        # source words without any counts (e.g. only in sentence pairs with empty target side) get zero probabilities
+        if self.trans_keys is None:
+            count_matrix = counts.reshape([-1, self.trg_vocab_size])
+            total_src = count_matrix.sum(axis=1).reshape([-1,1])
+            self.trans_probs = np.divide(count_matrix, total_src, out=np.zeros_like(count_matrix), where=total_src > 0).reshape(-1)
+        else:
+            src_ids = self.trans_keys // self.trg_vocab_size
+            total_src = np.bincount(src_ids, weights=counts, minlength=len(self.vocab.src))[src_ids]
+            self.trans_probs = np.divide(counts, total_src, out=np.zeros_like(counts), where=total_src > 0)
+
+    cdef np.ndarray sent_entropies(self, Corpus corpus, long begin, long end, np.ndarray trg_tokens, np.ndarray trg_factor,
+                                   double min_prob=0):
+        '''entropies of each sentence pair in [begin, end) given the sums of the probabilities for each target token
+        (the probability of each target token is floored by min_prob)'''
+        cdef np.ndarray src_lens, trg_lens, trg_sents
+        cdef np.ndarray token_probs, token_entropy
+        src_lens = corpus.src_offsets[begin+1:end+1] - corpus.src_offsets[begin:end]
+        trg_lens = corpus.trg_offsets[begin+1:end+1] - corpus.trg_offsets[begin:end]
+        trg_sents = np.repeat(np.arange(end - begin), trg_lens)
+        token_probs = trg_factor / src_lens[trg_sents]
+        if min_prob > 0:
+            token_probs = np.maximum(token_probs, min_prob)
+        token_entropy = -np.log(token_probs)
+        return np.bincount(trg_sents, weights=token_entropy, minlength=end - begin) / trg_lens
+
+    cpdef double add_expected_counts(self, Corpus corpus, long begin, long end, np.ndarray counts) except *:
+        '''accumulate expected co-occurrence counts of the parameters in the sentence pairs [begin, end) into counts,
+        and return the sum of the entropies of the sentence pairs on the current model'''
+        cdef np.ndarray src_words, trg_words, trg_tokens
+        cdef np.ndarray indices, probs, trg_factor
+        cdef double entropy
+        src_words, trg_words, trg_tokens = corpus.pair_grid(begin, end)
+        if len(trg_tokens) == 0:
+            return 0
+        indices = self.find_params(self.make_keys(src_words, trg_words))
+        probs = self.trans_probs[indices]
+        # normalization for each target token
+        trg_factor = np.bincount(trg_tokens, weights=probs, minlength=corpus.trg_offsets[end] - corpus.trg_offsets[begin])
+        # the normalization factors are the same quantities as the entropy needs
+        entropy = self.sent_entropies(corpus, begin, end, trg_tokens, trg_factor).sum()
+        probs /= trg_factor[trg_tokens]
+        counts += np.bincount(indices, weights=probs, minlength=counts.size)
+        return entropy
 
     cpdef double calc_pair_entropy(self, list src_sent, list trg_sent):
         cdef np.ndarray trans_matrix
-        trans_matrix = sub_matrix(self.trans_dist, src_sent, trg_sent)
+        trans_matrix = self.pair_probs(self.pair_keys(src_sent, trg_sent))
         #return -np.log(trans_matrix.sum(axis=0) / len(src_sent)).sum()
         return (-np.log(trans_matrix.sum(axis=0) / len(src_sent)).sum()) / len(trg_sent)
 
+    cpdef np.ndarray calc_entropies(self, Corpus corpus, long begin, long end, double min_prob=0):
+        '''entropies of each sentence pair in [begin, end) (the probability of each target token is floored by min_prob)'''
+        cdef np.ndarray src_words, trg_words, trg_tokens
+        cdef np.ndarray trg_factor
+        src_words, trg_words, trg_tokens = corpus.pair_grid(begin, end)
+        trg_factor = np.bincount(trg_tokens, weights=self.pair_probs(self.make_keys(src_words, trg_words)),
+            minlength=corpus.trg_offsets[end] - corpus.trg_offsets[begin])
+        return self.sent_entropies(corpus, begin, end, trg_tokens, trg_factor, min_prob)
+
+    cpdef np.ndarray score_pairs(self, list src_lines, list trg_lines, double oov_prob=OOV_PROB):
+        '''entropies of new sentence pairs (target words not explained by known source words get oov_prob)'''
+        cdef Corpus corpus = self.vocab.encode_pairs(src_lines, trg_lines)
+        return self.calc_entropies(corpus, 0, len(corpus), oov_prob)
+
+    cpdef double sum_entropy(self, Corpus corpus, long begin, long end) except *:
+        '''sum of the entropies of the sentence pairs [begin, end)'''
+        return self.calc_entropies(corpus, begin, end).sum()
+
     cpdef double calc_entropy(self, list sent_pairs):
-        cdef float total_entropy = 0
+        cdef Corpus corpus = Corpus(sent_pairs)
+        cdef double total_entropy = 0
+        cdef long begin
         logging.log('calculating entropy')
-        for i, (src_sent, trg_sent) in enumerate(progress.view(sent_pairs, 'progress')):
-            total_entropy += self.calc_pair_entropy(src_sent, trg_sent)
-        return total_entropy / len(sent_pairs)
+        for begin in progress.view(range(0, len(corpus), BATCH_SIZE), 'progress'):
+            total_entropy += self.sum_entropy(corpus, begin, min(begin + BATCH_SIZE, len(corpus)))
+        return total_entropy / len(corpus)
 
-    cpdef void calc_and_save_scores(self, out_path, list sent_pairs):
-        cdef double entropy = 0
+    cpdef void calc_and_save_scores(self, out_path, Corpus corpus) except *:
+        cdef np.ndarray entropies
         cdef str src_string, trg_string
-        cdef list src_ids, trg_ids
         cdef str record
+        cdef long begin, i
         logging.log("calculating and storing into file: %s"  % (out_path))
         with files.open(out_path, 'wt') as fobj:
-            for i, (src_ids, trg_ids) in enumerate(progress.view(sent_pairs, 'progress')):
-                entropy = self.calc_pair_entropy(src_ids, trg_ids)
-                src_string, trg_string = self.vocab.ids_pair_to_str_pair(src_ids, trg_ids)
-                record = "%s\t%s\t%s\n" % (entropy, src_string, trg_string)
-                fobj.write(record)
-
-    cpdef void save_align(self, out_path, threshold):
-        cdef tuple indices
-        cdef int src, trg
-        cdef float prob
-        cdef str record
+            for begin in progress.view(range(0, len(corpus), BATCH_SIZE), 'progress'):
+                entropies = self.calc_entropies(corpus, begin, min(begin + BATCH_SIZE, len(corpus)))
+                for i in range(len(entropies)):
+                    src_string, trg_string = self.vocab.ids_pair_to_str_pair(*corpus.pair_ids(begin + i))
+                    record = "%s\t%s\t%s\n" % (entropies[i], src_string, trg_string)
+                    fobj.write(record)
+
+    def iter_align(self, double threshold, long top_k=0):
+        '''chunks of (keys, probabilities) of the parameters not less than threshold in order of keys,
+        limited to top_k best targets for each source word if given'''
+        cdef long num_trg = self.trg_vocab_size
+        cdef np.ndarray row_starts, row_bounds
+        cdef np.ndarray probs, keys, selected, order, rows, ranks
+        cdef long row_begin, row_end, begin, end
+        if self.trans_keys is None:
+            row_starts = np.arange(self.src_vocab_size + 1) * num_trg
+        else:
+            row_starts = np.searchsorted(self.trans_keys, np.arange(self.src_vocab_size + 1) * num_trg)
+        # splitting source rows into chunks of about ALIGN_CHUNK_SIZE parameters
+        row_bounds = np.searchsorted(row_starts, np.arange(0, row_starts[-1], ALIGN_CHUNK_SIZE), 'right') - 1
+        row_bounds = np.append(np.unique(row_bounds), self.src_vocab_size)
+        for row_begin, row_end in zip(row_bounds[:-1], row_bounds[1:]):
+            begin, end = row_starts[row_begin], row_starts[row_end]
+            probs = self.trans_probs[begin:end]
+            if self.trans_keys is None and 0 < top_k < num_trg:
+                # partial selection of top_k targets in each row of dense matrix
+                selected = np.argpartition(probs.reshape([-1, num_trg]), num_trg - top_k, axis=1)[:, num_trg - top_k:]
+                selected = (selected + np.arange(row_end - row_begin).reshape([-1,1]) * num_trg).reshape(-1)
+                selected.sort()
+                selected = selected[probs[selected] >= threshold]
+            else:
+                selected = np.flatnonzero(probs >= threshold)
+            if self.trans_keys is None:
+                keys = selected + begin
+            else:
+                keys = self.trans_keys[begin:end][selected]
+                if top_k > 0 and len(selected) > 0:
+                    # ranking the candidates in each row of sparse model
+                    rows = keys // num_trg
+                    order = np.lexsort((-probs[selected], rows))
+                    ranks = np.empty(len(order), np.int64)
+                    ranks[order] = np.arange(len(order)) - np.searchsorted(rows, rows[order])
+                    keys = keys[ranks < top_k]
+                    selected = selected[ranks < top_k]
+            yield keys, probs[selected]
+
+    cpdef void save_align(self, out_path, double threshold, long top_k=0, str align_format='text') except *:
+        '''store the translation probabilities not less than threshold (and of top_k targets for each source word if given)
+        as lexical table text, or as sparse model directory (align_format='model')'''
+        cdef Model pruned
+        cdef list src_words, trg_words
+        cdef list key_chunks = []
+        cdef list prob_chunks = []
+        cdef np.ndarray keys, probs
+        logging.log("storing translation probabilities into %s (threshold=%s, top-k=%s): %s"
+            % (align_format, threshold, top_k, out_path))
+        chunks = progress.view(self.iter_align(threshold, top_k), 'storing')
+        if align_format == 'model':
+            for keys, probs in chunks:
+                key_chunks.append(keys.astype(np.int64, copy=False))
+                prob_chunks.append(probs)
+            pruned = Model()
+            pruned.vocab = self.vocab
+            pruned.src_vocab_size = self.src_vocab_size
+            pruned.trg_vocab_size = self.trg_vocab_size
+            pruned.trans_keys = np.concatenate(key_chunks) if key_chunks else np.zeros(0, np.int64)
+            pruned.trans_probs = np.concatenate(prob_chunks) if prob_chunks else np.zeros(0, self.trans_probs.dtype)
+            pruned.save(out_path)
+            return
+        src_words = list(self.vocab.src)
+        trg_words = list(self.vocab.trg)
         with files.open(out_path, 'wt') as fobj:
-            logging.log("storing translation probabilities into file (threshold=%s): %s" % (threshold,out_path))
-            indices = np.where(self.trans_dist>= threshold)
-            for src, trg in progress.view(zip(*indices), 'storing', max_count=len(indices[0])):
-                prob = self.trans_dist[src,trg]
-                record = "%s\t%s\t%s\n" % (self.vocab.src.id2str(src), self.vocab.trg.id2str(trg), prob)
-                fobj.write(record)
+            for keys, probs in chunks:
+                # formatting the chunk at once (probabilities in single precision as before)
+                fobj.write(str.join('', ["%s\t%s\t%s\n" % (src_words[src], trg_words[trg], prob)
+                    for src, trg, prob in zip((keys // self.trg_vocab_size).tolist(), (keys % self.trg_vocab_size).tolist(),
+                                              probs.astype(np.float32).astype(np.float64).tolist())]))
 
 cdef class Trainer:
     # imported from "ibm_model1.pxd"
     #cdef Model model
     #cdef str src_path
     #cdef str trg_path
-    #cdef list sent_pairs
+    #cdef str corpus_path
     #cdef np.ndarray cooc_src_trg
+    #cdef bint sparse
+    #cdef Corpus corpus
+    #cdef long batch_size
+    #cdef int workers
+    #cdef object pool
+    #cdef str work_dir
+    #cdef object shared_probs
+    #cdef object shared_counts
+    #cdef str checkpoint_path
+    #cdef bint resume
+    #cdef int iteration
+    #cdef list entropy_history
+    #cdef double tolerance
+    #cdef object dtype
+    #cdef long min_count
+    #cdef long max_vocab
+    #cdef np.ndarray stats
+    #cdef long online_steps
+    #cdef double online_decay
 
     def __cinit__(self, conf, **others):
         self.init()
@@ -139,8 +589,23 @@ cdef class Trainer:
         if conf.has(['src_path', 'trg_path']):
             self.src_path = conf.data.src_path
             self.trg_path = conf.data.trg_path
+        self.corpus_path = conf.get('corpus_path', None)
+        self.sparse = bool(conf.get('sparse', False))
+        self.batch_size = conf.get('batch_size', None) or BATCH_SIZE
+        self.workers = conf.get('workers', None) or 1
+        self.checkpoint_path = conf.get('checkpoint', None)
+        self.resume = bool(conf.get('resume', False))
+        self.tolerance = conf.get('tolerance', None) or 0
+        self.dtype = np.dtype(conf.get('dtype', None) or 'float64')
+        self.min_count = conf.get('min_count', None) or 1
+        self.max_vocab = conf.get('max_vocab', None) or 0
+        self.online_decay = conf.get('online_decay', None) or ONLINE_DECAY
     cdef void init(self):
         self.model = Model()
+        self.iteration = 0
+        self.entropy_history = []
+        self.stats = None
+        self.online_steps = 0
 
     cpdef np.ndarray calc_uniform_dist(self):
         cdef StringEnumerator vocab_src = self.model.vocab.src
@@ -148,78 +613,508 @@ cdef class Trainer:
         cdef np.ndarray uniform_dist
         cdef int src, trg
         logging.log("calculating uniform distribution for word translation probability")
-        uniform_dist = np.ones([len(vocab_src), len(vocab_trg)], np.float64) / len(vocab_trg)
+        if self.sparse:
+            uniform_dist = np.full(len(self.cooc_src_trg), 1.0 / len(vocab_trg), self.dtype)
+            logging.log("word trans. distribution size: %s [co-occurring pairs] x %s [bytes] = %s [bytes]"
+                % (len(uniform_dist),uniform_dist.itemsize,uniform_dist.nbytes))
+            return uniform_dist
+        uniform_dist = np.full([len(vocab_src), len(vocab_trg)], 1.0 / len(vocab_trg), self.dtype)
         logging.log("word trans. distribution matrix size: %s [src words] x %s [trg words] x %s [bytes] = %s [bytes]"
             % (uniform_dist.shape[0],uniform_dist.shape[1],uniform_dist.itemsize,len(uniform_dist.data)))
         return uniform_dist
 
-    cpdef np.ndarray count_cooccurrence(self, sent_pairs):
+    cpdef np.ndarray count_cooccurrence(self, Corpus corpus):
         cdef StringEnumerator vocab_src = self.model.vocab.src
         cdef StringEnumerator vocab_trg = self.model.vocab.trg
         cdef np.ndarray cooc_src_trg
-        cdef int src, trg
-        cdef np.ndarray src_indices, trg_indices
-        cooc_src_trg = np.zeros([len(vocab_src),len(vocab_trg)], np.int)
-        logging.log('counting co-occurrences of source word and target word')
-        for i, (src_sent, trg_sent) in enumerate(progress.view(sent_pairs, 'processing')):
-            #np.add.at(cooc_src_trg, np.meshgrid(src_sent,trg_sent), 1)
-            np.add.at(cooc_src_trg, grid_indices(src_sent, trg_sent), 1)
-        logging.log("co-occurrence matrix size: %s [src words] x %s [trg words] x %s [bytes]= %s [bytes]"
+        cdef np.ndarray src_words, trg_words, trg_tokens
+        cdef long begin
+        cooc_src_trg = np.zeros([len(vocab_src),len(vocab_trg)], np.bool_)
+        logging.log('marking co-occurrences of source word and target word')
+        for begin in progress.view(range(0, len(corpus), self.batch_size), 'processing'):
+            src_words, trg_words, trg_tokens = corpus.pair_grid(begin, min(begin + self.batch_size, len(corpus)))
+            cooc_src_trg[src_words, trg_words] = True
+        logging.log("co-occurrence mask size: %s [src words] x %s [trg words] x %s [bytes]= %s [bytes]"
             % (cooc_src_trg.shape[0],cooc_src_trg.shape[1],cooc_src_trg.itemsize,cooc_src_trg.size*cooc_src_trg.itemsize))
         return cooc_src_trg
 
-    cpdef void train(self, int iteration_limit):
-        cdef double last_entropy
+    cpdef np.ndarray collect_cooccurrence(self, Corpus corpus):
+        '''sorted keys (src_id * |Vtrg| + trg_id) of the word pairs co-occurring in the same sentence pair'''
+        cdef np.ndarray cooc_keys = np.zeros(0, np.int64)
+        cdef np.ndarray src_words, trg_words, trg_tokens
+        cdef long begin
+        logging.log('collecting co-occurring pairs of source word and target word')
+        for begin in progress.view(range(0, len(corpus), COOC_CHUNK_SIZE), 'processing'):
+            src_words, trg_words, trg_tokens = corpus.pair_grid(begin, min(begin + COOC_CHUNK_SIZE, len(corpus)))
+            cooc_keys = np.union1d(cooc_keys, self.model.make_keys(src_words, trg_words))
+        logging.log("co-occurring pairs: %s [pairs] x %s [bytes] = %s [bytes]"
+            % (len(cooc_keys),cooc_keys.itemsize,cooc_keys.nbytes))
+        return cooc_keys
+
+    cpdef list split_shards(self):
+        '''split the corpus into ranges of sentence pairs for each worker'''
+        cdef list bounds = list(np.linspace(0, len(self.corpus), self.workers + 1).astype(np.int64))
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    cpdef void start_workers(self) except *:
+        '''share the corpus and the model via memory-mapped files, and start the worker processes'''
+        if self.pool is not None:
+            return
+        self.work_dir = tempfile.mkdtemp(prefix='ibm_model1.')
+        logging.log("sharing corpus and model for %s workers in: %s" % (self.workers, self.work_dir))
+        self.corpus.save(self.work_dir)
+        if self.model.trans_keys is not None:
+            np.save(os.path.join(self.work_dir, 'trans_keys.npy'), self.model.trans_keys)
+        self.shared_probs = np.lib.format.open_memmap(os.path.join(self.work_dir, 'trans_probs.npy'), 'w+',
+            self.model.trans_probs.dtype, (len(self.model.trans_probs),))
+        self.shared_counts = np.lib.format.open_memmap(os.path.join(self.work_dir, 'counts.npy'), 'w+',
+            self.model.trans_probs.dtype, (self.workers, len(self.model.trans_probs)))
+        self.pool = multiprocessing.Pool(self.workers, init_worker,
+            (self.work_dir, self.model.src_vocab_size, self.model.trg_vocab_size))
+
+    cpdef void stop_workers(self) except *:
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.shared_probs = None
+            self.shared_counts = None
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    cpdef void share_model(self) except *:
+        '''publish the current translation probabilities to the workers'''
+        self.start_workers()
+        self.shared_probs[:] = self.model.trans_probs
+
+    cpdef tuple collect_counts(self):
+        '''expected co-occurrence counts of the parameters over the whole corpus,
+        and the entropy of the corpus on the current model (computed in the same pass)'''
+        cdef np.ndarray counts
+        cdef double total_entropy = 0
+        cdef long begin
+        cdef list tasks
+        if self.workers > 1:
+            self.share_model()
+            tasks = [(shard, begin, end, self.batch_size) for shard, (begin, end) in enumerate(self.split_shards())]
+            total_entropy = sum(self.pool.starmap(count_shard, tasks))
+            # reducing partial counts of the workers
+            return self.shared_counts.sum(axis=0), total_entropy / len(self.corpus)
+        counts = np.zeros(len(self.model.trans_probs), self.model.trans_probs.dtype)
+        for begin in progress.view(range(0, len(self.corpus), self.batch_size), 'processing'):
+            total_entropy += self.model.add_expected_counts(self.corpus, begin, min(begin + self.batch_size, len(self.corpus)), counts)
+        return counts, total_entropy / len(self.corpus)
+
+    cpdef double calc_entropy(self) except *:
+        '''entropy of the corpus on the current model'''
+        cdef double total_entropy = 0
+        cdef long begin
+        cdef list tasks
+        logging.log('calculating entropy')
+        if self.workers > 1:
+            self.share_model()
+            tasks = [(begin, end, self.batch_size) for begin, end in self.split_shards()]
+            total_entropy = sum(self.pool.starmap(entropy_shard, tasks))
+        else:
+            for begin in progress.view(range(0, len(self.corpus), self.batch_size), 'progress'):
+                total_entropy += self.model.sum_entropy(self.corpus, begin, min(begin + self.batch_size, len(self.corpus)))
+        return total_entropy / len(self.corpus)
+
+    cpdef void save_checkpoint(self) except *:
+        '''store the model and the training state, replacing the previous checkpoint'''
+        cdef str tmp_path = self.checkpoint_path + '.tmp'
+        logging.log("saving checkpoint of iteration %s: %s" % (self.iteration, self.checkpoint_path))
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        self.model.save(tmp_path)
+        if self.stats is not None:
+            np.save(os.path.join(tmp_path, 'stats.npy'), self.stats)
+        with files.open(os.path.join(tmp_path, 'state.json'), 'wt') as fobj:
+            json.dump({'iteration': self.iteration, 'entropy_history': self.entropy_history,
+                       'online_steps': self.online_steps}, fobj)
+        shutil.rmtree(self.checkpoint_path, ignore_errors=True)
+        os.rename(tmp_path, self.checkpoint_path)
+
+    cpdef void load_checkpoint(self) except *:
+        '''restore the model and the training state to continue the training'''
+        logging.log("resuming from checkpoint: %s" % self.checkpoint_path)
+        self.load_model(self.checkpoint_path)
+        with files.open(os.path.join(self.checkpoint_path, 'state.json'), 'rt') as fobj:
+            state = json.load(fobj)
+        self.iteration = state['iteration']
+        self.entropy_history = state['entropy_history']
+        self.load_corpus()
+
+    cpdef void load_model(self, str path) except *:
+        '''use the model stored by Model.save() instead of training from scratch'''
+        logging.log("loading model: %s" % path)
+        self.model = Model.load(path)
+        self.sparse = self.model.trans_keys is not None
+        self.dtype = self.model.trans_probs.dtype
+        if os.path.exists(os.path.join(path, 'stats.npy')):
+            self.stats = np.load(os.path.join(path, 'stats.npy'), mmap_mode='r')
+        if os.path.exists(os.path.join(path, 'state.json')):
+            with files.open(os.path.join(path, 'state.json'), 'rt') as fobj:
+                self.online_steps = json.load(fobj).get('online_steps', 0)
+
+    cpdef bint converged(self):
+        '''whether the relative improvement of the entropy in the last step is within the tolerance'''
+        cdef double last_entropy, entropy
+        if len(self.entropy_history) < 2:
+            return False
+        last_entropy, entropy = self.entropy_history[-2:]
+        return last_entropy - entropy <= self.tolerance * abs(last_entropy)
+
+    cpdef void train(self, int iteration_limit) except *:
+        cdef double started, elapsed
+        cdef long num_word_pairs
         logging.log("start training IBM Model 1")
-        self.train_first()
-        last_entropy = self.model.calc_entropy(self.sent_pairs)
-        logging.log("initial entropy: %s" % last_entropy)
-        for step in range(iteration_limit):
-            logging.log("--")
-            logging.log("step: %s" % (step + 1))
-            # train 1 step
-            self.train_step()
-            # calculate entropy
-            entropy = self.model.calc_entropy(self.sent_pairs)
-            logging.log("entropy: %s" % entropy)
-            if entropy == last_entropy:
-                break
-            else:
-                last_entropy = entropy
+        if self.resume and self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            self.load_checkpoint()
+        else:
+            self.train_first()
+        num_word_pairs = np.dot(np.diff(self.corpus.src_offsets), np.diff(self.corpus.trg_offsets))
+        try:
+            for step in range(self.iteration, iteration_limit):
+                logging.log("--")
+                logging.log("step: %s" % (step + 1))
+                started = time.time()
+                # train 1 step (entropy is of the model before this step)
+                entropy = self.train_step()
+                elapsed = max(time.time() - started, 1e-9)
+                logging.log("entropy: %s (model of step %s)" % (entropy, step))
+                logging.log("elapsed time: %.2f [sec], %.1f [sentence pairs/sec], %.1f [word pairs/sec]"
+                    % (elapsed, len(self.corpus) / elapsed, num_word_pairs / elapsed))
+                self.iteration = step + 1
+                self.entropy_history.append(entropy)
+                if self.checkpoint_path:
+                    self.save_checkpoint()
+                if self.converged():
+                    logging.log("converged: relative improvement of entropy is within %s" % self.tolerance)
+                    break
+        finally:
+            self.stop_workers()
+
+    cpdef dict corpus_settings(self):
+        '''the parallel text and the vocabulary options the corpus is built from'''
+        return {'src_path': os.path.abspath(self.src_path), 'trg_path': os.path.abspath(self.trg_path),
+                'min_count': self.min_count, 'max_vocab': self.max_vocab}
+
+    cpdef void check_corpus_settings(self) except *:
+        '''raise ValueError if the corpus in corpus_path was built from other parallel text or vocabulary options'''
+        cdef str settings_path = os.path.join(self.corpus_path, CORPUS_SETTINGS)
+        cdef dict settings = self.corpus_settings()
+        if not os.path.exists(settings_path):
+            raise ValueError("preprocessed corpus has no record of its settings: %s (remove the directory to rebuild it)"
+                % self.corpus_path)
+        with files.open(settings_path, 'rt') as fobj:
+            stored = json.load(fobj)
+        for key in sorted(settings):
+            if stored.get(key) != settings[key]:
+                raise ValueError("preprocessed corpus was built with %s=%s, but %s is given: %s (remove the directory to rebuild it)"
+                    % (key, stored.get(key), settings[key], self.corpus_path))
+
+    cpdef void load_corpus(self) except *:
+        '''load the corpus preprocessed into corpus_path, or tokenize the parallel text (and store it if corpus_path is given)'''
+        if self.corpus_path and os.path.exists(os.path.join(self.corpus_path, 'src_ids.npy')):
+            self.check_corpus_settings()
+            logging.log("loading preprocessed corpus: %s" % self.corpus_path)
+            self.model.vocab.load(self.corpus_path)
+            self.corpus = Corpus.load(self.corpus_path)
+        else:
+            if self.min_count > 1 or self.max_vocab > 0:
+                self.model.vocab.build(self.src_path, self.trg_path, self.min_count, self.max_vocab)
+            self.corpus = self.model.vocab.load_corpus(self.src_path, self.trg_path)
+            if self.corpus_path:
+                logging.log("storing preprocessed corpus: %s" % self.corpus_path)
+                self.model.vocab.save(self.corpus_path)
+                self.corpus.save(self.corpus_path)
+                with files.open(os.path.join(self.corpus_path, CORPUS_SETTINGS), 'wt') as fobj:
+                    json.dump(self.corpus_settings(), fobj)
 
-    cpdef void train_first(self):
-        self.sent_pairs = self.model.vocab.load_sent_pairs(self.src_path, self.trg_path)
+    cpdef void train_first(self) except *:
+        self.load_corpus()
         logging.log("source vocabulary size: %s" % len(self.model.vocab.src))
         logging.log("target vocabulary size: %s" % len(self.model.vocab.trg))
-        self.cooc_src_trg = self.count_cooccurrence(self.sent_pairs)
-        self.model.trans_dist = self.calc_uniform_dist()
+        self.model.src_vocab_size = len(self.model.vocab.src)
+        self.model.trg_vocab_size = len(self.model.vocab.trg)
+        if self.sparse:
+            self.cooc_src_trg = self.collect_cooccurrence(self.corpus)
+            self.model.trans_keys = self.cooc_src_trg
+        else:
+            self.cooc_src_trg = self.count_cooccurrence(self.corpus)
+        self.model.trans_probs = self.calc_uniform_dist().reshape(-1)
 
-    cpdef void train_step(self):
-        cdef long i
-        cdef list src_sent, trg_sent
-        cdef np.ndarray count_src2trg, total_src
-        cdef np.ndarray trg_factor
-        cdef StringEnumerator vocab_src = self.model.vocab.src
-        cdef StringEnumerator vocab_trg = self.model.vocab.trg
-        cdef tuple grid
+    cpdef double train_step(self) except *:
+        '''run 1 step of EM, and return the entropy of the corpus on the model before the step'''
+        cdef np.ndarray counts
+        cdef double entropy
 
-        if len(self.model.trans_dist) == 0:
+        if len(self.model.trans_probs) == 0:
             self.train_first()
-        else:
-            count_src2trg = np.zeros([len(vocab_src),len(vocab_trg),], np.float64)
-            total_src = np.zeros(len(vocab_src), np.float64)
-            logging.log("estimating expected co-occurrence counts")
-            for i, (src_sent, trg_sent) in enumerate(progress.view(self.sent_pairs, 'processing')):
-                grid = grid_indices(src_sent, trg_sent)
-                # compute normalization
-                trg_factor = np.zeros(len(vocab_trg), np.float64)
-                np.add.at(trg_factor, trg_sent, sub_matrix(self.model.trans_dist,src_sent,trg_sent).sum(axis=0))
-                # collect counts
-                np.add.at(count_src2trg, grid,     self.model.trans_dist[grid] / trg_factor[trg_sent])
-                np.add.at(total_src, src_sent, (self.model.trans_dist[grid] / trg_factor[trg_sent]).sum(axis=1))
-            # estimate probabilities
-            logging.log("estimating word translation probabilities")
-            self.model.trans_dist = count_src2trg / total_src.reshape([-1,1])
+        logging.log("estimating expected co-occurrence counts")
+        counts, entropy = self.collect_counts()
+        # kept as the statistics (average counts per sentence pair) for stepwise EM
+        counts /= len(self.corpus)
+        self.stats = counts
+        # estimate probabilities
+        logging.log("estimating word translation probabilities")
+        self.model.estimate(counts)
+        return entropy
+
+    cpdef void grow_model(self, Corpus corpus) except *:
+        '''extend the sparse model and the statistics for the words and co-occurring pairs newly found in the corpus'''
+        cdef Model model = self.model
+        cdef long old_trg = model.trg_vocab_size
+        cdef long num_trg = len(model.vocab.trg)
+        cdef np.ndarray src_words, trg_words, trg_tokens
+        cdef np.ndarray batch_keys, new_keys, positions
+        if model.trans_keys is None:
+            model.trans_keys = np.zeros(0, np.int64)
+        if num_trg != old_trg and old_trg > 0:
+            # keys are ordered by (source, target), so re-keying keeps the order
+            model.trans_keys = (model.trans_keys // old_trg) * num_trg + model.trans_keys % old_trg
+        model.src_vocab_size = len(model.vocab.src)
+        model.trg_vocab_size = num_trg
+        src_words, trg_words, trg_tokens = corpus.pair_grid(0, len(corpus))
+        batch_keys = np.unique(model.make_keys(src_words, trg_words))
+        new_keys = batch_keys[model.find_params(batch_keys) < 0]
+        if len(new_keys) > 0:
+            # new pairs start from uniform probability without any statistics
+            positions = np.searchsorted(model.trans_keys, new_keys)
+            model.trans_keys = np.insert(model.trans_keys, positions, new_keys)
+            model.trans_probs = np.insert(model.trans_probs, positions, 1.0 / num_trg)
+            self.stats = np.insert(self.stats, positions, 0)
+
+    cpdef void train_online(self) except *:
+        '''update the model by stepwise EM over the mini-batches of the parallel text, growing the vocabularies'''
+        cdef Corpus corpus
+        cdef np.ndarray counts, probs
+        cdef double entropy, eta
+        cdef long num_pairs = 0
+        logging.log("start stepwise EM training of IBM Model 1 (batch size: %s, decay: %s)" % (self.batch_size, self.online_decay))
+        if self.model.trans_keys is None and len(self.model.trans_probs) > 0:
+            logging.log("converting dense model into sparse one for online training")
+            probs = self.model.trans_probs
+            self.model.trans_keys = np.flatnonzero(probs > 0)
+            self.model.trans_probs = probs[self.model.trans_keys]
+            if self.stats is not None:
+                self.stats = self.stats[self.model.trans_keys]
+        if self.stats is None:
+            # model stored without statistics is regarded as 1 count for each source word
+            self.stats = np.array(self.model.trans_probs, self.dtype)
+        self.model.trans_probs = np.asarray(self.model.trans_probs, self.dtype)
+        self.stats = np.asarray(self.stats, self.dtype)
+        self.model.vocab.src.append(NULL_SYMBOL)
+        for src_lines, trg_lines in progress.view(iter_batches(self.src_path, self.trg_path, self.batch_size), 'processing'):
+            corpus = self.model.vocab.encode_pairs(src_lines, trg_lines, True)
+            self.grow_model(corpus)
+            counts = np.zeros(len(self.model.trans_probs), self.dtype)
+            entropy = self.model.add_expected_counts(corpus, 0, len(corpus), counts) / len(corpus)
+            # interpolating the statistics of the mini-batch into the running ones
+            eta = (self.online_steps + 2) ** -self.online_decay
+            self.stats = (1 - eta) * self.stats + (eta / len(corpus)) * counts
+            self.model.estimate(self.stats)
+            self.online_steps += 1
+            num_pairs += len(corpus)
+            logging.debug("mini-batch %s: entropy: %s, step size: %s" % (self.online_steps, entropy, eta))
+        logging.log("processed %s sentence pairs in %s mini-batches so far" % (num_pairs, self.online_steps))
+        logging.log("source vocabulary size: %s" % self.model.src_vocab_size)
+        logging.log("target vocabulary size: %s" % self.model.trg_vocab_size)
+
+# corpus and model shared with the parent process (set in worker processes only)
+cdef Corpus shared_corpus = None
+cdef Model shared_model = None
+cdef str shared_dir = None
+
+def init_worker(str work_dir, long src_vocab_size, long trg_vocab_size):
+    '''open the memory-mapped corpus and model shared by the parent process'''
+    global shared_corpus, shared_model, shared_dir
+    shared_dir = work_dir
+    shared_corpus = Corpus.load(work_dir)
+    shared_model = Model()
+    shared_model.src_vocab_size = src_vocab_size
+    shared_model.trg_vocab_size = trg_vocab_size
+    if os.path.exists(os.path.join(work_dir, 'trans_keys.npy')):
+        shared_model.trans_keys = np.load(os.path.join(work_dir, 'trans_keys.npy'), mmap_mode='r')
+    # updated in place by the parent process before each task
+    shared_model.trans_probs = np.load(os.path.join(work_dir, 'trans_probs.npy'), mmap_mode='r')
+
+def count_shard(long shard, long begin, long end, long batch_size):
+    '''collect expected counts in the sentence pairs [begin, end) into the shared partial counts of the shard,
+    and return the sum of the entropies of the sentence pairs'''
+    cdef np.ndarray counts = np.zeros(len(shared_model.trans_probs), shared_model.trans_probs.dtype)
+    cdef double total_entropy = 0
+    cdef long batch_begin
+    for batch_begin in range(begin, end, batch_size):
+        total_entropy += shared_model.add_expected_counts(shared_corpus, batch_begin, min(batch_begin + batch_size, end), counts)
+    np.load(os.path.join(shared_dir, 'counts.npy'), mmap_mode='r+')[shard] = counts
+    return total_entropy
+
+def entropy_shard(long begin, long end, long batch_size):
+    '''sum of the entropies of the sentence pairs [begin, end)'''
+    cdef double total_entropy = 0
+    cdef long batch_begin
+    for batch_begin in range(begin, end, batch_size):
+        total_entropy += shared_model.sum_entropy(shared_corpus, batch_begin, min(batch_begin + batch_size, end))
+    return total_entropy
+
+# model loaded by each scoring process (memory-mapped, so the pages are shared)
+cdef Model scoring_model = None
+
+def init_scorer(str model_path):
+    global scoring_model
+    scoring_model = Model.load(model_path)
+
+def score_batch(list src_lines, list trg_lines, double oov_prob):
+    return scoring_model.score_pairs(src_lines, trg_lines, oov_prob)
+
+def iter_batches(str src_path, str trg_path, long batch_size):
+    '''batches of (source lines, target lines) read from the parallel text'''
+    cdef list batch
+    pairs = zip(files.open(src_path), files.open(trg_path))
+    while True:
+        batch = list(itertools.islice(pairs, batch_size))
+        if not batch:
+            break
+        yield [pair[0] for pair in batch], [pair[1] for pair in batch]
+
+def score_file(str model_path, str src_path, str trg_path, str out_path,
+               long batch_size=BATCH_SIZE, int workers=1, double oov_prob=OOV_PROB):
+    '''write the entropy of each sentence pair of the parallel text on the saved model, one per line in input order'''
+    cdef np.ndarray entropies
+    logging.log("scoring sentence pairs: %s %s" % (src_path, trg_path))
+    batches = progress.view(iter_batches(src_path, trg_path, batch_size), 'scoring')
+    with files.open(out_path, 'wt') as fobj:
+        if workers <= 1:
+            init_scorer(model_path)
+            for src_lines, trg_lines in batches:
+                entropies = score_batch(src_lines, trg_lines, oov_prob)
+                fobj.write(str.join('', ["%s\n" % entropy for entropy in entropies.tolist()]))
+            return
+        pool = multiprocessing.Pool(workers, init_scorer, (model_path,))
+        try:
+            # keeping only a few batches in flight for each worker to bound the memory
+            pending = []
+            for batch in itertools.chain(batches, [None]):
+                if batch is not None:
+                    pending.append(pool.apply_async(score_batch, batch + (oov_prob,)))
+                while pending and (len(pending) >= workers * 2 or batch is None):
+                    entropies = pending.pop(0).get()
+                    fobj.write(str.join('', ["%s\n" % entropy for entropy in entropies.tolist()]))
+        finally:
+            pool.terminate()
+
+cdef np.ndarray count_by_sentence_loop(np.ndarray trans_dist, list sent_pairs):
+    '''expected co-occurrence counts collected by the per-sentence loop of the former Trainer.train_step
+    on dense translation matrix (reference for benchmark)'''
+    cdef np.ndarray count_src2trg = np.zeros([trans_dist.shape[0], trans_dist.shape[1]], np.float64)
+    cdef np.ndarray total_src = np.zeros(trans_dist.shape[0], np.float64)
+    cdef np.ndarray trg_factor
+    cdef list src_sent, trg_sent
+    cdef tuple grid
+    for src_sent, trg_sent in progress.view(sent_pairs, 'processing'):
+        grid = grid_indices(src_sent, trg_sent)
+        # compute normalization
+        trg_factor = np.zeros(trans_dist.shape[1], np.float64)
+        np.add.at(trg_factor, trg_sent, trans_dist[grid].sum(axis=0))
+        # collect counts
+        np.add.at(count_src2trg, grid,     trans_dist[grid] / trg_factor[trg_sent])
+        np.add.at(total_src, src_sent, (trans_dist[grid] / trg_factor[trg_sent]).sum(axis=1))
+    return count_src2trg
+
+cpdef list make_synthetic_pairs(long num_pairs, long vocab_size=10000, long max_length=40, long seed=0):
+    '''generate random sentence pairs of word IDs with Zipfian word frequencies'''
+    cdef list sent_pairs = []
+    rand = np.random.RandomState(seed)
+    src_lens = rand.randint(1, max_length+1, num_pairs)
+    trg_lens = np.maximum(1, src_lens + rand.randint(-3, 4, num_pairs))
+    for src_len, trg_len in zip(src_lens, trg_lens):
+        src_sent = list((rand.zipf(1.3, src_len) - 1) % (vocab_size - 1))
+        trg_sent = list((rand.zipf(1.3, trg_len) - 1) % vocab_size)
+        # last source word is NULL
+        sent_pairs.append( (src_sent + [vocab_size - 1], trg_sent) )
+    return sent_pairs
+
+cdef Trainer make_synthetic_trainer(list sent_pairs, long vocab_size, long batch_size, bint sparse, dtype):
+    '''trainer initialized with uniform distribution on the synthetic sentence pairs'''
+    cdef Trainer trainer = Trainer({}, sparse=sparse, batch_size=batch_size, dtype=dtype)
+    cdef Model model = trainer.model
+    trainer.corpus = Corpus(sent_pairs)
+    for word_id in range(vocab_size):
+        model.vocab.src.append(str(word_id))
+        model.vocab.trg.append(str(word_id))
+    model.src_vocab_size = vocab_size
+    model.trg_vocab_size = vocab_size
+    if sparse:
+        trainer.cooc_src_trg = trainer.collect_cooccurrence(trainer.corpus)
+        model.trans_keys = trainer.cooc_src_trg
+    model.trans_probs = trainer.calc_uniform_dist().reshape(-1)
+    return trainer
+
+def benchmark(num_pairs=20000, vocab_size=BENCHMARK_VOCAB_SIZE, max_length=40, batch_size=BATCH_SIZE, sparse=True):
+    '''compare the time of the former per-sentence loop and vectorized E-step on synthetic corpus
+
+    the former loop needs dense matrices of vocab_size x vocab_size,
+    and normalizes repeated target words in a sentence together (so the counts of them differ)'''
+    cdef Trainer trainer
+    cdef Model model
+    cdef np.ndarray trans_dist, loop_counts, batch_counts
+    cdef list sent_pairs
+    cdef long begin
+    logging.log("generating %s synthetic sentence pairs" % num_pairs)
+    sent_pairs = make_synthetic_pairs(num_pairs, vocab_size, max_length)
+    sent_pairs = [(list(map(int, src_sent)), list(map(int, trg_sent))) for (src_sent, trg_sent) in sent_pairs]
+    trainer = make_synthetic_trainer(sent_pairs, vocab_size, batch_size, sparse, 'float64')
+    model = trainer.model
+    trans_dist = np.zeros(vocab_size * vocab_size, np.float64)
+    if sparse:
+        trans_dist[model.trans_keys] = model.trans_probs
+    else:
+        trans_dist[:] = model.trans_probs
+    trans_dist = trans_dist.reshape([vocab_size, vocab_size])
+    logging.log("E-step by former per-sentence loop")
+    start = time.time()
+    loop_counts = count_by_sentence_loop(trans_dist, sent_pairs).reshape(-1)
+    loop_time = time.time() - start
+    if sparse:
+        loop_counts = loop_counts[model.trans_keys]
+    logging.log("E-step by vectorized batches (batch size: %s)" % batch_size)
+    start = time.time()
+    batch_counts = np.zeros(len(model.trans_probs), np.float64)
+    for begin in range(0, num_pairs, batch_size):
+        model.add_expected_counts(trainer.corpus, begin, min(begin + batch_size, num_pairs), batch_counts)
+    batch_time = time.time() - start
+    logging.log("per-sentence loop: %.3f [sec], vectorized: %.3f [sec], speed-up: %.1fx"
+        % (loop_time, batch_time, loop_time / batch_time))
+    logging.log("max difference of expected counts (differs where target words repeat in a sentence): %s"
+        % np.abs(loop_counts - batch_counts).max())
+    return loop_time, batch_time
+
+def compare_dtypes(num_pairs=20000, vocab_size=10000, max_length=40, batch_size=BATCH_SIZE, sparse=True,
+                   iteration_limit=ITERATION_LIMIT, tolerance=FLOAT32_ENTROPY_TOLERANCE):
+    '''train on synthetic corpus with float64 and float32, and check the entropy of each iteration stays within the tolerance'''
+    cdef Trainer trainer
+    cdef dict histories = {}
+    cdef dict times = {}
+    cdef list sent_pairs
+    cdef np.ndarray rel_diffs
+    logging.log("generating %s synthetic sentence pairs" % num_pairs)
+    sent_pairs = make_synthetic_pairs(num_pairs, vocab_size, max_length)
+    for dtype in DTYPES:
+        logging.log("training with %s" % dtype)
+        trainer = make_synthetic_trainer(sent_pairs, vocab_size, batch_size, sparse, dtype)
+        start = time.time()
+        histories[dtype] = [trainer.train_step() for step in range(iteration_limit)]
+        times[dtype] = time.time() - start
+    rel_diffs = np.abs(np.subtract(histories['float32'], histories['float64'])) / np.abs(histories['float64'])
+    for step, (entropy64, entropy32) in enumerate(zip(histories['float64'], histories['float32'])):
+        logging.log("step %s: entropy (float64): %s, entropy (float32): %s, relative difference: %.3g"
+            % (step, entropy64, entropy32, rel_diffs[step]))
+    logging.log("float64: %.3f [sec], float32: %.3f [sec]" % (times['float64'], times['float32']))
+    if rel_diffs.max() > tolerance:
+        logging.warn("entropy of float32 training differs from float64 by more than %s" % tolerance)
+        return False
+    logging.log("entropy of float32 training is within %s of float64" % tolerance)
+    return True
 
 def check_config(conf):
     if conf.data.verbose:
@@ -235,17 +1130,32 @@ def train_ibm_model1(conf, **others):
             e.set('QUIET', '1')
         check_config(conf)
         trainer = Trainer(conf, **others)
-        try:
-            #np.seterr(all='raise')
-            #trainer.train(conf.data.iteration_limit)
+        if conf.get('online'):
+            if conf.get('load_model'):
+                trainer.load_model(conf.data.load_model)
             with np.errstate(all='raise'):
-                trainer.train(conf.data.iteration_limit)
-        except KeyboardInterrupt as k:
-            logging.debug(k)
-            logging.log("forcing to dump alignments and scores")
-        trainer.model.save_align(conf.data.save_align_path, conf.data.threshold)
+                trainer.train_online()
+            if conf.get('checkpoint'):
+                trainer.save_checkpoint()
+            if conf.data.save_scores:
+                trainer.load_corpus()
+        elif conf.get('load_model'):
+            trainer.load_model(conf.data.load_model)
+            if conf.data.save_scores:
+                trainer.load_corpus()
+        else:
+            try:
+                #np.seterr(all='raise')
+                #trainer.train(conf.data.iteration_limit)
+                with np.errstate(all='raise'):
+                    trainer.train(conf.data.iteration_limit)
+            except KeyboardInterrupt as k:
+                logging.debug(k)
+                logging.log("forcing to dump alignments and scores")
+        trainer.model.save_align(conf.data.save_align_path, conf.data.threshold, conf.get('top_k', None) or 0,
+                                 conf.get('align_format', None) or 'text')
         if conf.data.save_scores:
-            trainer.model.calc_and_save_scores(conf.data.save_scores, trainer.sent_pairs)
+            trainer.model.calc_and_save_scores(conf.data.save_scores, trainer.corpus)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -255,6 +1165,21 @@ def main():
     parser.add_argument('--save-scores', '-S', help='output file to save entropy of each each alignment', type=str, default=None)
     parser.add_argument('--iteration-limit', '-I', help='maximum iteration number of EM algorithm (default: %(default)s)', type=int, default=ITERATION_LIMIT)
     parser.add_argument('--threshold', '-t', help='threshold of translation probabilities to save', type=float, default=0.01)
+    parser.add_argument('--top-k', '-k', help='save only this number of most probable target words for each source word', type=int, default=0)
+    parser.add_argument('--align-format', help='format to save alignment (default: %(default)s)', choices=ALIGN_FORMATS, default=ALIGN_FORMATS[0])
+    parser.add_argument('--corpus', '-C', dest='corpus_path', help='directory of preprocessed corpus (loaded if exists, otherwise created from the parallel text; the paths and the vocabulary options must be the same as when created)', type=str, default=None)
+    parser.add_argument('--tolerance', help='stop training when relative improvement of entropy is not more than this value (default: %(default)s)', type=float, default=0)
+    parser.add_argument('--checkpoint', help='directory to save the model and the training state after each iteration', type=str, default=None)
+    parser.add_argument('--resume', help='continue the training from the checkpoint', action='store_true')
+    parser.add_argument('--load-model', help='use the model saved in checkpoint directory instead of training', type=str, default=None)
+    parser.add_argument('--online', help='update the model (given by --load-model, or empty) by stepwise EM over mini-batches of the parallel text', action='store_true')
+    parser.add_argument('--online-decay', help='exponent of step size in stepwise EM (default: %(default)s)', type=float, default=ONLINE_DECAY)
+    parser.add_argument('--min-count', help='map the words occurring less than this times into %s' % UNK_SYMBOL, type=int, default=1)
+    parser.add_argument('--max-vocab', help='map the words except this number of most frequent words into %s' % UNK_SYMBOL, type=int, default=0)
+    parser.add_argument('--sparse', help='store translation probabilities only for co-occurring word pairs', action='store_true')
+    parser.add_argument('--batch-size', '-B', help='number of sentence pairs processed at once in E-step (default: %(default)s)', type=int, default=BATCH_SIZE)
+    parser.add_argument('--dtype', help='floating point type of translation probabilities (default: %(default)s)', choices=DTYPES, default=DTYPES[0])
+    parser.add_argument('--workers', '-w', help='number of worker processes for EM training (default: %(default)s)', type=int, default=1)
     #parser.add_argument('--character', '-c', help='chacacter based alignment mode', action='store_true')
     parser.add_argument('--verbose', '-v', help='verbose mode (including debug info)', action='store_true')
     parser.add_argument('--quiet', '-q', help='not showing staging log', action='store_true')
@@ -265,6 +1190,40 @@ def main():
             logging.debug(args)
     train_ibm_model1(conf)
 
+def score_main():
+    parser = argparse.ArgumentParser(description='score sentence pairs by the entropy on the IBM Model 1 saved by --checkpoint')
+    parser.add_argument('model_path', help='directory of the saved model', type=str)
+    parser.add_argument('src_path', help='file containing source-side lines of parallel text', type=str)
+    parser.add_argument('trg_path', help='file containing target-side lines of parallel text', type=str)
+    parser.add_argument('out_path', help='output file to save entropy of each sentence pair (one per line)', type=str)
+    parser.add_argument('--batch-size', '-B', help='number of sentence pairs scored at once (default: %(default)s)', type=int, default=BATCH_SIZE)
+    parser.add_argument('--workers', '-w', help='number of worker processes (default: %(default)s)', type=int, default=1)
+    parser.add_argument('--oov-prob', help='probability of target words not explained by known source words (default: %(default)s)', type=float, default=OOV_PROB)
+    parser.add_argument('--quiet', '-q', help='not showing staging log', action='store_true')
+    args = parser.parse_args()
+    with environ.push() as e:
+        if args.quiet:
+            e.set('QUIET', '1')
+        score_file(args.model_path, args.src_path, args.trg_path, args.out_path, args.batch_size, args.workers, args.oov_prob)
+
+def benchmark_main():
+    parser = argparse.ArgumentParser(description='benchmark the E-step of IBM Model 1 on synthetic corpus')
+    parser.add_argument('--num-pairs', '-n', help='number of synthetic sentence pairs (default: %(default)s)', type=int, default=20000)
+    parser.add_argument('--vocab-size', '-V', help='vocabulary size of each side (default: %(default)s)', type=int, default=BENCHMARK_VOCAB_SIZE)
+    parser.add_argument('--max-length', '-L', help='maximum number of words in sentence (default: %(default)s)', type=int, default=40)
+    parser.add_argument('--batch-size', '-B', help='number of sentence pairs processed at once (default: %(default)s)', type=int, default=BATCH_SIZE)
+    parser.add_argument('--dense', help='benchmark on dense translation matrix', action='store_true')
+    parser.add_argument('--compare-dtypes', help='check entropy of float32 training against float64 instead of benchmarking E-step', action='store_true')
+    parser.add_argument('--iteration-limit', '-I', help='number of EM iterations to compare dtypes (default: %(default)s)', type=int, default=ITERATION_LIMIT)
+    parser.add_argument('--tolerance', help='maximum relative difference of entropy to compare dtypes (default: %(default)s)', type=float, default=FLOAT32_ENTROPY_TOLERANCE)
+    args = parser.parse_args()
+    if args.compare_dtypes:
+        if not compare_dtypes(args.num_pairs, args.vocab_size, args.max_length, args.batch_size, not args.dense,
+                              args.iteration_limit, args.tolerance):
+            sys.exit(1)
+    else:
+        benchmark(args.num_pairs, args.vocab_size, args.max_length, args.batch_size, not args.dense)
+
 if __name__ == '__main__':
     main()
 
@@ -38,9 +38,7 @@ def convertTravatarExtract(srcFile, saveFile, sync=None, flatten=None, reverse=F
                 trgSymbols = records.getFlattenSymbols(trgSymbols, flatten)
             if reverse:
                 srcSymbols, trgSymbols = trgSymbols, srcSymbols
-                aligns = records.getAlignSet(fields[3])
-                aligns = records.getRevAlignSet(aligns)
-                fields[3] = str.join(' ', sorted(aligns))
+                fields[3] = records.AlignSet(fields[3]).reversed().to_str()
             if no_unary:
                 #if len(records.getTravatarTerms(srcSymbols)) == 0:
                 if len(records.TravatarRecord.getTerms(srcSymbols)) == 0:
@@ -59,14 +59,15 @@ def filterTable(srcFile, saveFile, rules, nbest, RecordClass = records.MosesReco
     records = []
     lastSrc = ''
     for line in progress.view(srcFile, 'processing'):
-        rec = RecordClass(line)
+        # features and alignments are parsed only for the matched records
+        rec = RecordClass(line, fields = ('src', 'counts'))
         if rec.src != lastSrc:
             lastSrc = rec.src
             if records:
                 saveRecords(saveFile, records, nbest)
                 records = []
         if matchRules(rec, rules):
-            records.append( rec )
+            records.append( RecordClass(line) )
 #          output.write( rec.to_str() )
     if records:
         saveRecords(saveFile, records, nbest)
@@ -25,7 +25,7 @@ def makeGlueRules(srcRuleTable, saveRules, progress = False):
     if progress:
         srcRuleTable = view(srcRuleTable)
     for line in srcRuleTable:
-        rec = records.TravatarRecord(line)
+        rec = records.TravatarRecord(line, fields = ('src',))
         symbols = rec.src.split(' ')
         if len(symbols) == 3:
             if symbols[0][0] == '"' and symbols[1] == "@":
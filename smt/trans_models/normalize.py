@@ -15,8 +15,8 @@ from nlputils.common import compat
 from nlputils.common import files
 from nlputils.common import logging
 from nlputils.common import progress
-from nlputils.smt.trans_models.records import MosesRecord, TravatarRecord
-from nlputils.smt.trans_models.tables import Table
+from nlputils.smt.trans_models.records import MosesRecord, TravatarRecord, RecordWriter
+from nlputils.smt.trans_models.tables import Table, open_table
 
 from nlputils.data_structs import trees
 
@@ -62,14 +62,14 @@ def calc_trg_factor(table, trg, target_number=None):
             sources.add(rec.src)
     return total
 
-def normalize_table(table_path, save_path):
-    table = Table(table_path, TravatarRecord, trg_key=True)
+def normalize_table(table_path, save_path, index_path=None, cache_memory=0):
+    table = open_table(table_path, TravatarRecord, index_path, trg_key=True, cache_memory=cache_memory)
 
     last_src = ""
     #src_total = 0
     src_total = {}
     dict_trg_total = {}
-    with files.open(save_path, 'wt') as fobj_out:
+    with files.open(save_path, 'wt') as fobj_out, RecordWriter(fobj_out) as writer:
         #for i, rec in enumerate( progress.view(table, 'normalizing', max_count = len(table)) ):
         for i, line in enumerate( progress.view(table_path, 'normalizing', max_count = len(table)) ):
             try:
@@ -82,20 +82,19 @@ def normalize_table(table_path, save_path):
                     for i, field in enumerate(rec.trg.split('|COL|')):
                         targets.append(field.strip())
                         target_numbers.append(i)
-                old = rec.to_str()
+                #old = rec.to_str()
                 if last_src != rec.src:
                     for num in target_numbers:
                         src_total[num] = calc_src_factor(table, rec.src, num)
                     last_src = rec.src
                 for num, target in zip(target_numbers, targets):
                     #logging.log(target)
-                    trg_track = table.field_dict.get_node(target).track()
-                    if (num,trg_track) in dict_trg_total:
-                        trg_total = dict_trg_total[num,trg_track]
+                    if (num,target) in dict_trg_total:
+                        trg_total = dict_trg_total[num,target]
                     else:
                         #trg_total = calc_trg_factor(table, rec.trg, num)
                         trg_total = calc_trg_factor(table, target, num)
-                        dict_trg_total[num, trg_track] = trg_total
+                        dict_trg_total[num, target] = trg_total
                     prefix = ''
                     if isinstance(num,int):
                         prefix=str(num)
@@ -105,8 +104,7 @@ def normalize_table(table_path, save_path):
                 #    logging.log("old: %s" % old)
                 #    logging.log("new: %s" % rec.to_str())
                 #    logging.log("--")
-                fobj_out.write(rec.to_str())
-                fobj_out.write("\n")
+                writer.write(rec)
             except Exception as e:
                 logging.warn("source: %s" % rec.src)
                 logging.warn("target: %s" % rec.trg)
@@ -114,14 +112,18 @@ def normalize_table(table_path, save_path):
                 logging.warn("target: %s" % target)
                 logging.warn(e)
                 raise Exception()
+    if table.cache is not None:
+        logging.log("lookup cache: %s" % table.cache.stats())
 
 def main():
     parser = argparse.ArgumentParser(description = 'load 2 rule tables and pivot into one travatar rule table')
     parser.add_argument('table_path', type=str, help = 'path to phrase/rule table')
     parser.add_argument('save_path', help = 'path to save phrase/rule table')
+    parser.add_argument('--index', help = 'index directory of the table (built if missing or stale)', type=str, default=None)
+    parser.add_argument('--cache-mb', help = 'memory budget in MB for caching records of frequent keys (default: disabled)', type=float, default=0)
     args = parser.parse_args()
 
-    normalize_table(args.table_path, args.save_path)
+    normalize_table(args.table_path, args.save_path, args.index, int(args.cache_mb * 1024 * 1024))
 
 if __name__ == '__main__':
     main()
@@ -5,6 +5,14 @@
 
 # Standard libraries
 import math
+from libc.math cimport fabs, isfinite, log, pow
+from libc.stdio cimport snprintf
+from libc.stdlib cimport free, realloc
+from libc.string cimport memmove
+
+# 3rd party library
+import numpy as np
+cimport numpy as np
 
 # Local libraries
 from common import compat
@@ -13,6 +21,7 @@ from nlputils.common import files
 from nlputils.common import logging
 from nlputils.common import numbers
 from nlputils.common import vocab
+from nlputils.common.vocab cimport StringEnumerator
 
 # Matching Method
 #   tree:    Full Match (Tree Match)
@@ -20,6 +29,470 @@ from nlputils.common import vocab
 #   string:  Symbol String Match (Superficial Match)
 MATCH=['tree', 'tag', 'string', 'ftree']
 
+# names of the fields in the lines of the tables (in order)
+TRAVATAR_FIELDS = ['src', 'trg', 'features', 'counts', 'aligns']
+MOSES_FIELDS = ['src', 'trg', 'features', 'aligns', 'counts']
+
+# formats of the tables parsed by parse_batch()
+TABLE_FORMATS = ['travatar', 'moses']
+# feature names of the score field of moses table (in order)
+MOSES_FEATURES = ['fgep', 'fgel', 'egfp', 'egfl']
+# columns of RecordBatch.counts
+COUNT_COLUMNS = ['cooc', 'src', 'trg']
+# number of records parsed at once by iter_batches()
+BATCH_SIZE = 100000
+# number of characters buffered by RecordWriter before writing into the file
+WRITE_BUFFER = 2 ** 20
+
+cdef class FeatureSchema(object):
+    '''feature names interned into column slots, shared by the records of a table'''
+    cdef readonly list names
+    cdef readonly dict slots
+    cdef list output_order
+    cdef list output_keys
+    cdef list output_logs
+
+    def __init__(self, names = ()):
+        self.names = []
+        self.slots = {}
+        self.output_order = None
+        for name in names:
+            self.slot(name)
+
+    cpdef long slot(self, str name, bint register = True):
+        '''slot of the feature (registered if not found and register is set, -1 otherwise)'''
+        cdef object slot = self.slots.get(name)
+        if slot is None:
+            if not register:
+                return -1
+            slot = len(self.names)
+            self.names.append(intern(name))
+            self.slots[self.names[slot]] = slot
+            self.output_order = None
+        return slot
+
+    cpdef list slots_of(self, names):
+        '''slots of the features (registered if not found)'''
+        return [self.slot(name) for name in names]
+
+    cdef prepare_output(self):
+        cdef list pairs
+        if self.output_order is None:
+            pairs = sorted([(name + '=', slot) for (slot, name) in enumerate(self.names)])
+            self.output_order = [slot for (key, slot) in pairs]
+            self.output_keys = [key for (key, slot) in pairs]
+            self.output_logs = [isLogFeature(key) for (key, slot) in pairs]
+
+    cpdef list sorted_slots(self):
+        '''slots in the order of "key=val" features written in travatar table'''
+        self.prepare_output()
+        return self.output_order
+
+    def __contains__(self, str name):
+        return name in self.slots
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+# shared schema of the features of all the records
+FEATURE_SCHEMA = FeatureSchema()
+
+# kinds of the values in Features slots
+cdef enum:
+    FEATURE_MISSING = 0
+    FEATURE_INT = 1
+    FEATURE_FLOAT = 2
+
+cdef class Features(object):
+    '''feature values of a record stored in a C double array indexed by the slots of the feature schema
+
+    behaves like the dict of feature name and value, keeping ints as ints'''
+    cdef readonly FeatureSchema schema
+    cdef double *values
+    cdef unsigned char *kinds
+    cdef long size
+
+    def __cinit__(self, object features = None, FeatureSchema schema = None):
+        self.schema = FEATURE_SCHEMA if schema is None else schema
+        self.values = NULL
+        self.kinds = NULL
+        self.size = 0
+        self.reserve(len(self.schema))
+        if features:
+            self.update(features)
+
+    def __dealloc__(self):
+        free(self.values)
+        free(self.kinds)
+
+    cdef int reserve(self, long size) except -1:
+        cdef long i
+        cdef double *values
+        cdef unsigned char *kinds
+        if size <= self.size:
+            return 0
+        values = <double*> realloc(self.values, size * sizeof(double))
+        if values == NULL:
+            raise MemoryError()
+        self.values = values
+        kinds = <unsigned char*> realloc(self.kinds, size * sizeof(unsigned char))
+        if kinds == NULL:
+            raise MemoryError()
+        self.kinds = kinds
+        for i in range(self.size, size):
+            self.values[i] = 0
+            self.kinds[i] = FEATURE_MISSING
+        self.size = size
+        return 0
+
+    cdef long find(self, str key):
+        '''slot of the feature if the record has it, -1 otherwise'''
+        cdef long slot = self.schema.slot(key, False)
+        if 0 <= slot < self.size and self.kinds[slot] != FEATURE_MISSING:
+            return slot
+        return -1
+
+    cdef object value(self, long slot):
+        if self.kinds[slot] == FEATURE_INT:
+            return <long long> self.values[slot]
+        return self.values[slot]
+
+    cdef int assign(self, long slot, object val) except -1:
+        if slot >= self.size:
+            self.reserve(max(slot + 1, len(self.schema)))
+        self.values[slot] = val
+        self.kinds[slot] = FEATURE_INT if isinstance(val, int) else FEATURE_FLOAT
+        return 0
+
+    cpdef add_products(self, list slots, Features src, Features trg, object rate = None):
+        '''features[key] += rate * src[key] * trg[key] for the slots (missing features are counted as 0)'''
+        cdef long slot
+        cdef double factor = 1.0 if rate is None else rate
+        cdef bint integral
+        if src.schema is not self.schema or trg.schema is not self.schema:
+            raise ValueError("features of different schemas can not be combined")
+        for slot in slots:
+            if slot >= src.size or src.kinds[slot] == FEATURE_MISSING:
+                raise KeyError(self.schema.names[slot])
+            if slot >= trg.size or trg.kinds[slot] == FEATURE_MISSING:
+                raise KeyError(self.schema.names[slot])
+            if slot >= self.size:
+                self.reserve(max(slot + 1, len(self.schema)))
+            integral = (rate is None and self.kinds[slot] != FEATURE_FLOAT
+                        and src.kinds[slot] == FEATURE_INT and trg.kinds[slot] == FEATURE_INT)
+            self.values[slot] += factor * src.values[slot] * trg.values[slot]
+            self.kinds[slot] = FEATURE_INT if integral else FEATURE_FLOAT
+
+    def __getitem__(self, str key):
+        cdef long slot = self.find(key)
+        if slot < 0:
+            raise KeyError(key)
+        return self.value(slot)
+
+    def __setitem__(self, str key, object val):
+        self.assign(self.schema.slot(key), val)
+
+    def __delitem__(self, str key):
+        cdef long slot = self.find(key)
+        if slot < 0:
+            raise KeyError(key)
+        self.values[slot] = 0
+        self.kinds[slot] = FEATURE_MISSING
+
+    def __contains__(self, str key):
+        return self.find(key) >= 0
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        cdef long slot
+        cdef long count = 0
+        for slot in range(self.size):
+            if self.kinds[slot] != FEATURE_MISSING:
+                count += 1
+        return count
+
+    def __reduce__(self):
+        return (Features, (self.to_dict(), self.schema))
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.to_dict())
+
+    def get(self, str key, object default = None):
+        cdef long slot = self.find(key)
+        if slot < 0:
+            return default
+        return self.value(slot)
+
+    def setdefault(self, str key, object default = None):
+        cdef long slot = self.find(key)
+        if slot < 0:
+            self[key] = default
+            return default
+        return self.value(slot)
+
+    cpdef list keys(self):
+        cdef long slot
+        return [self.schema.names[slot] for slot in range(self.size) if self.kinds[slot] != FEATURE_MISSING]
+
+    cpdef list values(self):
+        cdef long slot
+        return [self.value(slot) for slot in range(self.size) if self.kinds[slot] != FEATURE_MISSING]
+
+    cpdef list items(self):
+        cdef long slot
+        return [(self.schema.names[slot], self.value(slot)) for slot in range(self.size) if self.kinds[slot] != FEATURE_MISSING]
+
+    def update(self, features):
+        if hasattr(features, 'items'):
+            features = features.items()
+        for key, val in features:
+            self[key] = val
+
+    cpdef Features copy(self):
+        return Features(self, self.schema)
+
+    cpdef str to_travatar(self):
+        '''features in the format of travatar table (the same as getStrTravatarFeatures())'''
+        cdef long i, slot
+        cdef double val
+        cdef list parts = []
+        cdef list order, keys, logs
+        self.schema.prepare_output()
+        order = self.schema.output_order
+        keys = self.schema.output_keys
+        logs = self.schema.output_logs
+        for i in range(len(order)):
+            slot = order[i]
+            if slot >= self.size or self.kinds[slot] == FEATURE_MISSING:
+                continue
+            val = self.values[slot]
+            if logs[i]:
+                if val > 0 and isfinite(val):
+                    parts.append(keys[i] + formatRound(log(val)))
+                else:
+                    parts.append(keys[i] + formatLogFeature(self.schema.names[slot], self.value(slot)))
+            elif self.kinds[slot] == FEATURE_INT:
+                parts.append(keys[i] + str(<long long> val))
+            else:
+                parts.append(keys[i] + str(val))
+        return str.join(' ', parts)
+
+    cpdef dict to_dict(self):
+        return dict(self.items())
+
+# upper limit of word positions in packed alignment points
+MAX_ALIGN_POSITION = 0xffff
+
+cdef inline long pack_align(long src, long trg):
+    return (src << 16) | trg
+
+cdef inline str unpack_align(long packed):
+    return "%d-%d" % (packed >> 16, packed & 0xffff)
+
+cdef class AlignSet(object):
+    '''word alignment points packed as (src << 16 | trg) in a sorted C array
+
+    behaves like the set of 'src-trg' strings'''
+    cdef unsigned int *points
+    cdef long size
+    cdef long capacity
+
+    def __cinit__(self, object aligns = None):
+        self.points = NULL
+        self.size = 0
+        self.capacity = 0
+        if isinstance(aligns, str):
+            self.parse(aligns)
+        elif aligns:
+            self.update(aligns)
+
+    def __dealloc__(self):
+        free(self.points)
+
+    cdef int reserve(self, long capacity) except -1:
+        cdef unsigned int *points
+        if capacity <= self.capacity:
+            return 0
+        capacity = max(capacity, self.capacity * 2, 8)
+        points = <unsigned int*> realloc(self.points, capacity * sizeof(unsigned int))
+        if points == NULL:
+            raise MemoryError()
+        self.points = points
+        self.capacity = capacity
+        return 0
+
+    cdef long lower_bound(self, unsigned int packed):
+        cdef long begin = 0
+        cdef long end = self.size
+        cdef long middle
+        while begin < end:
+            middle = (begin + end) // 2
+            if self.points[middle] < packed:
+                begin = middle + 1
+            else:
+                end = middle
+        return begin
+
+    cdef int add_point(self, long src, long trg) except -1:
+        cdef unsigned int packed
+        cdef long index
+        if not (0 <= src <= MAX_ALIGN_POSITION and 0 <= trg <= MAX_ALIGN_POSITION):
+            raise ValueError("alignment point out of range: %d-%d" % (src, trg))
+        packed = pack_align(src, trg)
+        index = self.lower_bound(packed)
+        if index < self.size and self.points[index] == packed:
+            return 0
+        self.reserve(self.size + 1)
+        memmove(&self.points[index+1], &self.points[index], (self.size - index) * sizeof(unsigned int))
+        self.points[index] = packed
+        self.size += 1
+        return 0
+
+    cdef int parse(self, str field) except -1:
+        '''add the points in the field of 'src-trg' separated by white spaces'''
+        cdef bytes data = field.encode('utf-8')
+        cdef const unsigned char *chars = data
+        cdef Py_ssize_t length = len(data)
+        cdef Py_ssize_t i = 0
+        cdef Py_ssize_t start
+        cdef long src, trg
+        while True:
+            while i < length and chars[i] in b' \t\r\n':
+                i += 1
+            if i >= length:
+                break
+            src = 0
+            start = i
+            while i < length and c'0' <= chars[i] <= c'9':
+                src = src * 10 + (chars[i] - c'0')
+                i += 1
+            if i == start or i >= length or chars[i] != c'-':
+                raise ValueError("invalid alignment: %s" % field)
+            i += 1
+            trg = 0
+            start = i
+            while i < length and c'0' <= chars[i] <= c'9':
+                trg = trg * 10 + (chars[i] - c'0')
+                i += 1
+            if i == start or (i < length and chars[i] not in b' \t\r\n'):
+                raise ValueError("invalid alignment: %s" % field)
+            self.add_point(src, trg)
+        return 0
+
+    cpdef add(self, object align):
+        '''add the point given as 'src-trg' or (src, trg)'''
+        if isinstance(align, str):
+            src, trg = align.split('-')
+            self.add_point(int(src), int(trg))
+        else:
+            self.add_point(align[0], align[1])
+
+    def update(self, aligns):
+        cdef long i
+        cdef AlignSet other
+        if isinstance(aligns, AlignSet):
+            other = aligns
+            for i in range(other.size):
+                self.add_point(other.points[i] >> 16, other.points[i] & 0xffff)
+        else:
+            for align in aligns:
+                self.add(align)
+
+    cpdef add_composed(self, AlignSet first, AlignSet second):
+        '''add the points src-trg linked by src-pvt points of first and pvt-trg points of second'''
+        cdef long i, j
+        cdef unsigned int pvt
+        for i in range(first.size):
+            pvt = first.points[i] & 0xffff
+            j = second.lower_bound(pvt << 16)
+            while j < second.size and (second.points[j] >> 16) == pvt:
+                self.add_point(first.points[i] >> 16, second.points[j] & 0xffff)
+                j += 1
+
+    cpdef AlignSet compose(self, AlignSet other):
+        '''alignment composed with the alignment from the target side of this one'''
+        cdef AlignSet composed = AlignSet()
+        composed.add_composed(self, other)
+        return composed
+
+    cpdef AlignSet reversed(self):
+        '''alignment with swapped source and target positions'''
+        cdef AlignSet rev = AlignSet()
+        cdef long i
+        rev.reserve(self.size)
+        for i in range(self.size):
+            rev.points[i] = pack_align(self.points[i] & 0xffff, self.points[i] >> 16)
+            rev.size += 1
+        sort_points(rev.points, rev.size)
+        return rev
+
+    cpdef dict to_map(self, bint reverse = False):
+        '''dict of the aligned positions (target to source ones if reverse)'''
+        cdef dict alignMap = {}
+        cdef long i
+        for i in range(self.size):
+            if reverse:
+                alignMap.setdefault(self.points[i] & 0xffff, []).append(self.points[i] >> 16)
+            else:
+                alignMap.setdefault(self.points[i] >> 16, []).append(self.points[i] & 0xffff)
+        return alignMap
+
+    cpdef list pairs(self):
+        '''list of (src, trg) points'''
+        cdef long i
+        return [(self.points[i] >> 16, self.points[i] & 0xffff) for i in range(self.size)]
+
+    cpdef str to_str(self):
+        '''points in the format of the tables ('src-trg' sorted as strings)'''
+        cdef long i
+        return str.join(' ', sorted([unpack_align(self.points[i]) for i in range(self.size)]))
+
+    cpdef AlignSet copy(self):
+        return AlignSet(self)
+
+    def __contains__(self, object align):
+        cdef unsigned int packed
+        cdef long index, src, trg
+        if isinstance(align, str):
+            src, trg = map(int, align.split('-'))
+        else:
+            src, trg = align
+        if not (0 <= src <= MAX_ALIGN_POSITION and 0 <= trg <= MAX_ALIGN_POSITION):
+            return False
+        packed = pack_align(src, trg)
+        index = self.lower_bound(packed)
+        return index < self.size and self.points[index] == packed
+
+    def __iter__(self):
+        cdef long i
+        return iter([unpack_align(self.points[i]) for i in range(self.size)])
+
+    def __len__(self):
+        return self.size
+
+    def __reduce__(self):
+        return (AlignSet, (self.to_str(),))
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.to_str())
+
+cdef void sort_points(unsigned int *points, long size):
+    '''insertion sort (alignments of phrases are short)'''
+    cdef long i, j
+    cdef unsigned int point
+    for i in range(1, size):
+        point = points[i]
+        j = i
+        while j > 0 and points[j-1] > point:
+            points[j] = points[j-1]
+            j -= 1
+        points[j] = point
+
 cdef class CoOccurrence:
     cdef public float src, trg, cooc
     def __cinit__(self, float src=0.0, float trg=0.0, float cooc=0):
@@ -69,9 +542,9 @@ cdef class CoOccurrence:
 cdef class Record(object):
     cdef public str src, trg
     #cdef public long src, trg
-    cdef public dict features
+    cdef Features feature_values
     cdef public CoOccurrence counts
-    cdef public set aligns
+    cdef AlignSet align_set
     cdef public object data
 
     def __cinit__(self):
@@ -81,14 +554,28 @@ cdef class Record(object):
       #self.trg = ()
       #self.src = 0
       #self.trg = 0
-      self.features = {}
+      self.feature_values = Features()
       self.counts = CoOccurrence()
 #      self.aligns = []
-      self.aligns = set()
+      self.align_set = AlignSet()
 
     cpdef fixOrder(self):
         return False
 
+    property features:
+        def __get__(self): return self.feature_values
+        def __set__(self, features):
+            if not isinstance(features, Features):
+                features = Features(features)
+            self.feature_values = features
+
+    property aligns:
+        def __get__(self): return self.align_set
+        def __set__(self, aligns):
+            if not isinstance(aligns, AlignSet):
+                aligns = AlignSet(aligns)
+            self.align_set = aligns
+
     def getSrcSymbols(self):
         return self.getSymbols(self.src)
     src_symbols = property(getSrcSymbols)
@@ -106,20 +593,20 @@ cdef class Record(object):
     trgTerms = property(getTrgTerms)
 
     cpdef getAlignMap(self):
-        return getAlignMap(self.aligns, reverse = False)
+        return self.align_set.to_map(reverse = False)
     #alignMap = property(getAlignMap)
     property alignMap:
         def __get__(self): return self.getAlignMap()
 
     cpdef getAlignMapRev(self):
-        return getAlignMap(self.aligns, reverse = True)
+        return self.align_set.to_map(reverse = True)
     #alignMapRev = property(getAlignMapRev)
     property alignMapRev:
         def __get__(self): return self.getAlignMapRev()
 
     cpdef Record getReversed(self):
         cdef Record recRev
-        cdef dict revFeatures
+        cdef Features revFeatures
         recRev = self.__class__()
         recRev.src = self.trg
         recRev.trg = self.src
@@ -127,8 +614,8 @@ cdef class Record(object):
 #        debug.log(self.to_str())
 #        debug.log(self.aligns)
 #        recRev.aligns = getRevAligns(self.aligns)
-        recRev.aligns = getRevAlignSet(self.aligns)
-        revFeatures = {}
+        recRev.aligns = self.align_set.reversed()
+        revFeatures = Features()
         if 'egfp' in self.features:
             revFeatures[intern('fgep')] = self.features['egfp']
         if 'egfl' in self.features:
@@ -156,21 +643,28 @@ cdef class Record(object):
         return phrase
 
 class MosesRecord(Record):
-    def __init__(self, line = "", delim = '|||'):
+    def __init__(self, line = "", delim = '|||', fields = None):
         Record.__init__(self)
         self.delim = delim
-        self.loadLine(line, delim)
+        self.loadLine(line, delim, fields)
 
-    def loadLine(self, line, delim = '|||'):
+    def loadLine(self, line, delim = '|||', fields = None):
+        '''parse the line (only the fields of the given names in MOSES_FIELDS if fields is given)'''
+        last = lastField(MOSES_FIELDS, fields)
         if line:
-            fields = line.strip().split(delim)
-            self.src = intern( fields[0].strip() )
-            self.trg = intern( fields[1].strip() )
-            self.features = getMosesFeatures(fields[2])
+            values = line.strip().split(delim, last + 1)
+            if fields is None or 'src' in fields:
+                self.src = intern( values[0].strip() )
+            if fields is None or 'trg' in fields:
+                self.trg = intern( values[1].strip() )
+            if fields is None or 'features' in fields:
+                self.features = getMosesFeatures(values[2])
 #            self.aligns = fields[3].strip().split()
-            self.aligns = getAlignSet( fields[3] )
-            listCounts = getCounts(fields[4])
-            self.counts.setCounts(trg = listCounts[0], src = listCounts[1], co = listCounts[2])
+            if fields is None or 'aligns' in fields:
+                self.aligns = AlignSet( values[3] )
+            if fields is None or 'counts' in fields:
+                listCounts = getCounts(values[4])
+                self.counts.setCounts(trg = listCounts[0], src = listCounts[1], co = listCounts[2])
 
 #    def getSrcSymbols(self):
 #        return self.src.split(' ')
@@ -191,7 +685,7 @@ class MosesRecord(Record):
     def to_str(self, s = ' ||| '):
         strFeatures = getStrMosesFeatures(self.features)
 #        strAligns = str.join(' ', self.aligns)
-        strAligns = str.join(' ', sorted(self.aligns) )
+        strAligns = self.aligns.to_str()
         self.counts.round()
         strCounts   = "%s %s %s" % (self.counts.trg, self.counts.src, self.counts.cooc)
         #buf = str.join(s, [self.src, self.trg, strFeatures, strAligns, strCounts]) + "\n"
@@ -209,6 +703,17 @@ def getAlignMap(aligns, reverse = False):
             alignMap.setdefault(s, []).append(t)
     return alignMap
 
+cpdef long lastField(list names, object fields) except -2:
+    '''index of the last field to be parsed in the names of the fields (all the fields if fields is None)'''
+    if fields is None:
+        return len(names) - 1
+    for name in fields:
+        if name not in names:
+            raise ValueError("unknown field: %s" % name)
+    if not fields:
+        return -1
+    return max([names.index(name) for name in fields])
+
 def getAlignSet(strField):
     return set(strField.strip().split())
 
@@ -244,7 +749,7 @@ def getRevAlignSet(aligns):
 
 
 def getMosesFeatures(field):
-    features = {}
+    features = Features()
     scores = map(getNumber, field.split())
     features[intern('fgep')] = scores[0]
     features[intern('fgel')] = scores[1]
@@ -265,10 +770,10 @@ def getStrMosesFeatures(dicFeatures):
 cdef class TravatarRecord(Record):
     cdef str delim
 
-    def __cinit__(self, object line="", str delim='|||'):
+    def __cinit__(self, object line="", str delim='|||', object fields=None):
         Record.__init__(self)
         self.delim = delim
-        self.loadLine(compat.to_str(line), delim)
+        self.loadLine(compat.to_str(line), delim, fields)
 
 #    cpdef getSrcSymbols(self):
 #      return getTravatarSymbols(self.src)
@@ -305,13 +810,13 @@ cdef class TravatarRecord(Record):
 
     cpdef TravatarRecord getReversed(self):
       cdef TravatarRecord recRev = TravatarRecord()
-      cdef dict revFeatures
+      cdef Features revFeatures
       recRev.src = self.trg
       recRev.trg = self.src
       recRev.counts = self.counts.getReversed()
   #    recRev.aligns = record.getRevAligns(self.aligns)
-      recRev.aligns = getRevAlignSet(self.aligns)
-      revFeatures = {}
+      recRev.aligns = self.align_set.reversed()
+      revFeatures = Features()
       if 'egfp' in self.features:
         revFeatures['fgep'] = self.features['egfp']
       if 'egfl' in self.features:
@@ -328,21 +833,28 @@ cdef class TravatarRecord(Record):
 
 #    cpdef loadLine(self, str line, str delim = '|||'):
     #def loadLine(self, line, delim = '|||'):
-    cpdef loadLine(self, str line, str delim = '|||'):
-        cdef list fields
+    cpdef loadLine(self, str line, str delim = '|||', object fields = None):
+        '''parse the line (only the fields of the given names in TRAVATAR_FIELDS if fields is given)'''
+        cdef list values
         cdef list listCounts
+        cdef long last = lastField(TRAVATAR_FIELDS, fields)
         if line:
-            fields = line.strip().split(delim)
-            self.src = fields[0].strip()
-            self.trg = fields[1].strip()
+            values = line.strip().split(delim, last + 1)
+            if fields is None or 'src' in fields:
+                self.src = values[0].strip()
+            if fields is None or 'trg' in fields:
+                self.trg = values[1].strip()
             #self.src = vocab.phrase2id(fields[0])
             #self.trg = vocab.phrase2id(fields[1])
-            self.features = getTravatarFeatures(fields[2])
-            listCounts = getCounts(fields[3])
-            if len(listCounts) == 3:
-                self.counts.setCounts(cooc = listCounts[0], src = listCounts[1], trg = listCounts[2])
+            if fields is None or 'features' in fields:
+                self.features = getTravatarFeatures(values[2])
+            if fields is None or 'counts' in fields:
+                listCounts = getCounts(values[3])
+                if len(listCounts) == 3:
+                    self.counts.setCounts(cooc = listCounts[0], src = listCounts[1], trg = listCounts[2])
             #self.aligns = fields[4].strip().split()
-            self.aligns = getAlignSet( fields[4] )
+            if fields is None or 'aligns' in fields:
+                self.align_set = AlignSet( values[4] )
             #self.data = pd.DataFrame()
             #self.data = pd.Series()
 
@@ -411,9 +923,10 @@ cdef class TravatarRecord(Record):
       if self.counts.cooc > 0:
           #self.counts.cooc = round(self.counts.cooc, 6)
           #strCounts = "%s %s %s" % (self.counts.cooc, self.counts.src, self.counts.trg)
-          strCounts = "%s %s %s" % (round(self.counts.cooc,6), round(self.counts.src,6), round(self.counts.trg,6))
+          #strCounts = "%s %s %s" % (round(self.counts.cooc,6), round(self.counts.src,6), round(self.counts.trg,6))
+          strCounts = "%s %s %s" % (formatRound(self.counts.cooc), formatRound(self.counts.src), formatRound(self.counts.trg))
   #    strAligns = str.join(' ', self.aligns)
-      strAligns = str.join(' ', sorted(self.aligns))
+      strAligns = self.align_set.to_str()
       #buf = str.join(s, [self.src, self.trg, strFeatures, strCounts, strAligns]) + "\n"
       buf = str.join(s, [self.src, self.trg, strFeatures, strCounts, strAligns])
       return buf
@@ -475,6 +988,60 @@ cdef class TravatarRecord(Record):
           terms.append(s[1:-1])
       return terms
 
+cdef class RecordView(object):
+    '''read-only view of a record line, decoding the fields only on first access
+
+    src and trg are split out of the line without parsing the other fields,
+    the other attributes are taken from the record parsed by RecordClass when accessed'''
+    cdef readonly str line
+    cdef readonly object RecordClass
+    cdef str delim
+    cdef list fields
+    cdef object parsed
+
+    def __init__(self, str line, object RecordClass, str delim = '|||'):
+        self.line = line
+        self.RecordClass = RecordClass
+        self.delim = delim
+        self.fields = None
+        self.parsed = None
+
+    cdef str field(self, long index):
+        if self.fields is None:
+            self.fields = self.line.strip().split(self.delim, 2)
+        return self.fields[index].strip()
+
+    property src:
+        def __get__(self): return self.field(0)
+
+    property trg:
+        def __get__(self): return self.field(1)
+
+    property src_symbols:
+        def __get__(self): return self.RecordClass.getSymbols(self.src)
+
+    property srcTerms:
+        def __get__(self): return self.RecordClass.getTerms(self.src)
+
+    property trgSymbols:
+        def __get__(self): return self.RecordClass.getSymbols(self.trg)
+
+    property trgTerms:
+        def __get__(self): return self.RecordClass.getTerms(self.trg)
+
+    property record:
+        '''the record fully parsed by RecordClass'''
+        def __get__(self):
+            if self.parsed is None:
+                self.parsed = self.RecordClass(self.line)
+            return self.parsed
+
+    def __getattr__(self, name):
+        return getattr(self.record, name)
+
+    def __str__(self):
+        return self.line
+
 def getFlattenSymbols(symbols, grammar = 'scfg'):
     if isTree(symbols):
         # strSymbols is tree (S-expression)
@@ -497,23 +1064,47 @@ def getFlattenSymbols(symbols, grammar = 'scfg'):
         symbols = newSymbols
     return symbols
 
-cpdef str getStrTravatarFeatures(dict dict_features):
-    '''convert features dict into string in format of 'key=val' list'''
+cpdef str getStrTravatarFeatures(object dict_features):
+    '''convert features (dict or Features) into string in format of 'key=val' list'''
     cdef list featureList = []
     cdef str key
     cdef object val
+    if isinstance(dict_features, Features):
+        return (<Features>dict_features).to_travatar()
     for key, val in dict_features.items():
-        if key.find('egf') >= 0 or key.find('fge') >= 0:
-            try:
-                #val = math.log(val)
-                val = round(math.log(val), 6)
-            except:
-                logging.warn( (key,val) )
-        featureList.append( "%s=%s" % (key, val) )
+        if isLogFeature(key):
+            featureList.append( "%s=%s" % (key, formatLogFeature(key, val)) )
+        else:
+            featureList.append( "%s=%s" % (key, val) )
     return str.join(' ', sorted(featureList))
 
+cdef inline bint isLogFeature(str key):
+    '''features written in log scale'''
+    return key.find('egf') >= 0 or key.find('fge') >= 0
+
+cdef str formatLogFeature(str key, object val):
+    '''log of the feature value rounded in 6 digits (raw value if failed)'''
+    try:
+        #val = math.log(val)
+        val = round(math.log(val), 6)
+    except:
+        logging.warn( (key,val) )
+    return str(val)
+
+cdef str formatRound(double val):
+    '''str(round(val, 6)) without creating python floats'''
+    cdef char buf[32]
+    cdef int length
+    if not isfinite(val) or fabs(val) >= 1e9 or (val != 0 and fabs(val) < 1e-4):
+        # python float repr uses exponent or more digits than %.6f
+        return str(round(val, 6))
+    length = snprintf(buf, sizeof(buf), "%.6f", val)
+    while buf[length-1] == c'0' and buf[length-2] != c'.':
+        length -= 1
+    return buf[:length].decode('ascii')
+
 def getTravatarFeatures(field):
-  features = {}
+  features = Features()
   for strKeyVal in field.split():
     #debug.log(strKeyVal)
     (key, val) = strKeyVal.split('=')
@@ -580,3 +1171,245 @@ def syncTags(src_symbols, trgSymbols, sync):
 #    print(trgSymbols)
     return src_symbols, trgSymbols
 
+
+cdef class RecordBatch(object):
+    '''records of a table in columnar arrays
+
+    src_ids/trg_ids: IDs of the phrases in phrases
+    features: float64 matrix of the records and the feature slots of schema (NaN for missing features),
+              decoded in the same way as Record.features (e.g. exponentiated probabilities of travatar)
+    counts: float64 matrix of the records and COUNT_COLUMNS
+    aligns: alignment points packed as (src << 16 | trg), aligns[align_offsets[i]:align_offsets[i+1]] for i-th record'''
+    cdef readonly str table_format
+    cdef readonly StringEnumerator phrases
+    cdef readonly FeatureSchema schema
+    cdef readonly np.ndarray src_ids
+    cdef readonly np.ndarray trg_ids
+    cdef readonly np.ndarray features
+    cdef readonly np.ndarray counts
+    cdef readonly np.ndarray align_offsets
+    cdef readonly np.ndarray aligns
+
+    def __init__(self, str table_format, StringEnumerator phrases, FeatureSchema schema):
+        self.table_format = table_format
+        self.phrases = phrases
+        self.schema = schema
+
+    cpdef np.ndarray feature(self, str name):
+        '''column of the feature (NaN for all the records if the feature is not in the batch)'''
+        cdef long slot = self.schema.slot(name, False)
+        if 0 <= slot < self.features.shape[1]:
+            return self.features[:, slot]
+        return np.full(len(self), np.nan)
+
+    cpdef RecordBatch select(self, object index):
+        '''batch of the records selected by boolean mask or indices'''
+        cdef RecordBatch batch = RecordBatch(self.table_format, self.phrases, self.schema)
+        cdef np.ndarray indices = np.arange(len(self))[index]
+        cdef np.ndarray begins = self.align_offsets[indices]
+        cdef np.ndarray lengths = self.align_offsets[indices+1] - begins
+        batch.src_ids = self.src_ids[indices]
+        batch.trg_ids = self.trg_ids[indices]
+        batch.features = self.features[indices]
+        batch.counts = self.counts[indices]
+        batch.align_offsets = np.zeros(len(indices) + 1, np.int64)
+        np.cumsum(lengths, out=batch.align_offsets[1:])
+        batch.aligns = self.aligns[np.repeat(begins - batch.align_offsets[:-1], lengths) + np.arange(batch.align_offsets[-1])]
+        return batch
+
+    def __len__(self):
+        return len(self.src_ids)
+
+cpdef RecordBatch parse_batch(list lines, str table_format = 'travatar', StringEnumerator phrases = None, FeatureSchema schema = None):
+    '''parse the lines of travatar/moses table into columnar arrays'''
+    cdef RecordBatch batch
+    cdef long i, j, slot
+    cdef long num_records = len(lines)
+    cdef bint travatar = (table_format == 'travatar')
+    cdef str line, key_val, key, val, align
+    cdef list fields, values
+    cdef list aligns = []
+    cdef list moses_slots
+    cdef np.ndarray features
+    cdef np.ndarray counts
+    cdef list exp_slots
+    cdef double[:, :] feature_view
+    cdef double base = math.e
+    if table_format not in TABLE_FORMATS:
+        raise ValueError("unknown table format: %s" % table_format)
+    if phrases is None:
+        phrases = StringEnumerator()
+    if schema is None:
+        schema = FeatureSchema()
+    if not travatar:
+        moses_slots = [schema.slot(key) for key in MOSES_FEATURES]
+    batch = RecordBatch(table_format, phrases, schema)
+    batch.src_ids = np.empty(num_records, np.int32)
+    batch.trg_ids = np.empty(num_records, np.int32)
+    batch.align_offsets = np.zeros(num_records + 1, np.int64)
+    features = np.full((num_records, max(len(schema), 1)), np.nan)
+    counts = np.zeros((num_records, len(COUNT_COLUMNS)))
+    for i, line in enumerate(lines):
+        fields = line.strip().split('|||')
+        batch.src_ids[i] = phrases.str2id(fields[0].strip())
+        batch.trg_ids[i] = phrases.str2id(fields[1].strip())
+        if travatar:
+            for key_val in fields[2].split():
+                key, val = key_val.split('=')
+                slot = schema.slot(key)
+                if slot >= features.shape[1]:
+                    features = np.hstack([features, np.full((num_records, features.shape[1]), np.nan)])
+                features[i, slot] = float(val)
+            values = fields[3].split()
+            if len(values) == 3:
+                counts[i] = [float(values[0]), float(values[1]), float(values[2])]
+            align_field = fields[4]
+        else:
+            values = fields[2].split()
+            for j in range(len(MOSES_FEATURES)):
+                features[i, moses_slots[j]] = float(values[j])
+            values = fields[4].split()
+            counts[i] = [float(values[2]), float(values[1]), float(values[0])]
+            align_field = fields[3]
+        for align in align_field.split():
+            key, val = align.split('-')
+            aligns.append(pack_align(int(key), int(val)))
+        batch.align_offsets[i+1] = len(aligns)
+    if travatar:
+        # the same as getTravatarFeatures(), the features of long names are exponentiated
+        # (by scalar pow() like math.e ** val, vectorized np.power may differ in the last bit)
+        exp_slots = [slot for slot in range(features.shape[1]) if slot < len(schema) and len(schema.names[slot]) >= 4]
+        feature_view = features
+        for slot in exp_slots:
+            for i in range(num_records):
+                feature_view[i, slot] = pow(base, feature_view[i, slot])
+    batch.features = features[:, :len(schema)]
+    batch.counts = counts
+    batch.aligns = np.array(aligns, np.int32)
+    return batch
+
+def iter_batches(source, str table_format = 'travatar', long batch_size = BATCH_SIZE, StringEnumerator phrases = None, FeatureSchema schema = None):
+    '''parse the table (path or iterable of lines) into batches of batch_size records sharing the phrases and the schema'''
+    cdef list lines = []
+    if phrases is None:
+        phrases = StringEnumerator()
+    if schema is None:
+        schema = FeatureSchema()
+    if isinstance(source, str):
+        source = files.open(source, 'rt')
+    for line in source:
+        lines.append(line)
+        if len(lines) >= batch_size:
+            yield parse_batch(lines, table_format, phrases, schema)
+            lines = []
+    if lines:
+        yield parse_batch(lines, table_format, phrases, schema)
+
+cdef inline double as_float32(double value):
+    '''value stored in CoOccurrence (single precision)'''
+    return <float> value
+
+cdef str format_count(double value):
+    '''count written by to_str() after CoOccurrence.round()'''
+    return formatRound(as_float32(round(as_float32(value), 6)))
+
+cdef str format_number(double value):
+    '''value parsed by getNumber() as str'''
+    if value == int(round(value)):
+        return str(int(round(value)))
+    return str(value)
+
+cpdef list batch_lines(RecordBatch batch):
+    '''lines of the records in the batch, formatted in the same way as to_str() of the records'''
+    cdef long i, j, slot
+    cdef long num_slots = batch.features.shape[1]
+    cdef bint travatar = (batch.table_format == 'travatar')
+    cdef list lines = []
+    cdef list feature_list
+    cdef list slots = [slot for slot in batch.schema.sorted_slots() if slot < num_slots]
+    cdef list moses_slots
+    cdef list log_slots = [slot for slot in range(num_slots) if isLogFeature(batch.schema.names[slot])]
+    cdef list exp_slots = [slot for slot in range(num_slots) if len(batch.schema.names[slot]) >= 4]
+    cdef double[:, :] features = batch.features
+    cdef double[:, :] counts = batch.counts
+    cdef np.int64_t[:] align_offsets = batch.align_offsets
+    cdef str str_features, str_counts, str_aligns
+    cdef object val
+    if not travatar:
+        moses_slots = [batch.schema.slot(key) for key in MOSES_FEATURES]
+    for i in range(len(batch)):
+        str_aligns = str.join(' ', sorted(set([unpack_align(packed) for packed in batch.aligns[align_offsets[i]:align_offsets[i+1]]])))
+        if travatar:
+            feature_list = []
+            for slot in slots:
+                if features[i, slot] != features[i, slot]:
+                    # missing feature (NaN)
+                    continue
+                if slot in log_slots:
+                    val = formatLogFeature(batch.schema.names[slot], features[i, slot])
+                elif slot in exp_slots:
+                    val = features[i, slot]
+                else:
+                    val = format_number(features[i, slot])
+                feature_list.append( "%s=%s" % (batch.schema.names[slot], val) )
+            str_features = str.join(' ', feature_list)
+            str_counts = ""
+            if as_float32(round(as_float32(counts[i, 0]), 6)) > 0:
+                str_counts = "%s %s %s" % (format_count(counts[i, 0]), format_count(counts[i, 1]), format_count(counts[i, 2]))
+            lines.append( str.join(' ||| ', [batch.phrases.id2str(batch.src_ids[i]), batch.phrases.id2str(batch.trg_ids[i]), str_features, str_counts, str_aligns]) )
+        else:
+            str_features = str.join(' ', [format_number(features[i, slot]) if features[i, slot] == features[i, slot] else '0' for slot in moses_slots])
+            str_counts = "%s %s %s" % (format_count(counts[i, 2]), format_count(counts[i, 1]), format_count(counts[i, 0]))
+            lines.append( str.join(' ||| ', [batch.phrases.id2str(batch.src_ids[i]), batch.phrases.id2str(batch.trg_ids[i]), str_features, str_aligns, str_counts]) )
+    return lines
+
+def write_batches(fobj, batches):
+    '''write the records in the batches into the table file'''
+    cdef RecordWriter writer = RecordWriter(fobj)
+    for batch in batches:
+        for line in batch_lines(batch):
+            writer.write_line(line)
+    writer.close()
+
+cdef class RecordWriter(object):
+    '''writer of records (or lines) into a table file, buffering the lines and writing them in large blocks'''
+    cdef readonly object fobj
+    cdef readonly long buffer_size
+    cdef readonly long count
+    cdef list buf
+    cdef long buffered
+
+    def __init__(self, fobj, long buffer_size = WRITE_BUFFER):
+        self.fobj = fobj
+        self.buffer_size = buffer_size
+        self.count = 0
+        self.buf = []
+        self.buffered = 0
+
+    cpdef write(self, record):
+        '''write the record formatted by its to_str()'''
+        self.write_line(record.to_str())
+
+    cpdef write_line(self, str line):
+        self.buf.append(line)
+        self.buf.append("\n")
+        self.buffered += len(line) + 1
+        self.count += 1
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    cpdef flush(self):
+        '''write the buffered lines into the file'''
+        if self.buf:
+            self.fobj.write(str.join('', self.buf))
+            del self.buf[:]
+            self.buffered = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -6,14 +6,24 @@
 from libcpp cimport bool
 
 # Standard libraries
+import argparse
+import array
+import json
+import os
+import random
+import shutil
 import sys
+import tempfile
 import time
+from collections import OrderedDict
 
 # 3rd party library
-import pycedar
+import numpy as np
+cimport numpy as np
 
 # Local libraries
 from nlputils.common import compat
+from nlputils.common.vocab cimport StringEnumerator
 from nlputils.common import files
 from nlputils.common import logging
 from nlputils.common import progress
@@ -21,282 +31,366 @@ from nlputils.smt.trans_models import records
 
 key_types = ['src', 'src_hiero', 'src_symbols', 'src_tree']
 
-#cdef get_track_str(object trie, str key):
-#    return str(trie.get_node(key)).replace(' ', '')
-    #return str(node.track()).replace(' ', '')
-cdef get_track_str(object node):
-    return str(node.track()).replace(' ', '')
+# version of the index format written by Table.build_index()
+INDEX_VERSION = 1
+# field ID padding the records with less fields than the widest record
+NO_FIELD = -2
+
+# memory budget of the cache of found records in bytes (0 for disabling the cache)
+CACHE_MEMORY = 0
+# rough memory usage of a parsed record in addition to its line
+RECORD_OVERHEAD = 1024
+
+BENCHMARK_RECORDS = 100000
+BENCHMARK_VOCAB_SIZE = 5000
+
+cpdef str format_key(object RecordClass, str key_type, str phrase):
+    '''key of the phrase for given key type'''
+    if key_type == 'src':
+        #return phrase + ' ||| '
+        return phrase
+    elif key_type == 'src_hiero':
+        #return str.join(' ', RecordClass.getSymbols(phrase,hiero=True)) + ' ||| '
+        return str.join(' ', RecordClass.getSymbols(phrase,hiero=True))
+    elif key_type == 'src_symbols':
+        #return str.join(' ', RecordClass.getSymbols(phrase,hiero=False)) + ' ||| '
+        return str.join(' ', RecordClass.getSymbols(phrase,hiero=False))
+
+cdef np.ndarray record_matrix(StringEnumerator record_enum):
+    '''matrix of field IDs from the enumerator of records (padded with NO_FIELD)'''
+    cdef long num_records = record_enum.count
+    cdef np.ndarray offsets = record_enum.offsets_array[:num_records+1] // 4
+    cdef np.ndarray data = record_enum.pool_array[:offsets[num_records] * 4].view(np.int32)
+    cdef np.ndarray widths = np.diff(offsets)
+    cdef np.ndarray matrix = np.full((num_records, widths.max() if num_records > 0 else 1), NO_FIELD, np.int32)
+    rows = np.repeat(np.arange(num_records), widths)
+    matrix[rows, np.arange(len(data)) - offsets[rows]] = data
+    return matrix
+
+cdef class Postings(object):
+    '''IDs of the records grouped by field ID of their key (-1 for the empty key)'''
+    cdef readonly np.ndarray offsets
+    cdef readonly np.ndarray record_ids
+
+    def __init__(self, np.ndarray offsets, np.ndarray record_ids):
+        self.offsets = offsets
+        self.record_ids = record_ids
+
+    @staticmethod
+    def build(np.ndarray key_ids, long num_fields):
+        '''group the record IDs by key IDs (the records of key ID below -1 have no key)'''
+        cdef np.ndarray record_ids = np.flatnonzero(key_ids >= -1)
+        cdef np.ndarray offsets = np.zeros(num_fields + 2, np.int64)
+        key_ids = key_ids[record_ids]
+        np.cumsum(np.bincount(key_ids + 1, minlength=num_fields + 1), out=offsets[1:])
+        return Postings(offsets, record_ids[np.argsort(key_ids, kind='stable')].astype(np.int32))
+
+    cpdef np.ndarray find(self, long key_id):
+        '''IDs of the records having the key'''
+        return self.record_ids[self.offsets[key_id+1]:self.offsets[key_id+2]]
+
+    def save(self, str path, str name):
+        np.save(os.path.join(path, '%s_offsets.npy' % name), self.offsets)
+        np.save(os.path.join(path, '%s_records.npy' % name), self.record_ids)
+
+    @staticmethod
+    def load(str path, str name, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        return Postings(np.load(os.path.join(path, '%s_offsets.npy' % name), mmap_mode=mmap_mode),
+                        np.load(os.path.join(path, '%s_records.npy' % name), mmap_mode=mmap_mode))
+
+cdef class LookupCache(object):
+    '''least recently used lists of records found by the keys, bounded by estimated memory usage'''
+    cdef object entries
+    cdef readonly long budget
+    cdef readonly long memory
+    cdef readonly long hits
+    cdef readonly long misses
+    cdef readonly long evictions
+
+    def __init__(self, long budget):
+        self.entries = OrderedDict()
+        self.budget = budget
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    cpdef list get(self, object key):
+        '''cached records of the key (None if not cached)'''
+        cdef tuple entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    cpdef put(self, object key, list records, long size):
+        '''cache the records of estimated size in bytes, evicting the least recently used ones over the budget'''
+        cdef tuple entry
+        if size > self.budget:
+            return
+        self.entries[key] = (records, size)
+        self.memory += size
+        while self.memory > self.budget:
+            entry = self.entries.popitem(last=False)[1]
+            self.memory -= entry[1]
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.memory = 0
+
+    def stats(self):
+        return {'entries': len(self.entries), 'memory': self.memory,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
 
-cdef track2key(object trie_dict, str track):
-    cdef list numbers
-    cdef size_t node_id, length
-    numbers = track[1:-1].split(',')
-    node_id = int(numbers[0])
-    length  = int(numbers[1])
-    return trie_dict.trie.suffix(node_id, length)
+    def __len__(self):
+        return len(self.entries)
+
+def check_index(dict meta, str table_path=None, key_type=None, trg_key=False):
+    '''raise ValueError if the index described by meta can not be used for the table'''
+    if meta.get('version') != INDEX_VERSION:
+        raise ValueError("unsupported index version: %s" % meta.get('version'))
+    if table_path and os.path.abspath(table_path) != meta['table_path']:
+        raise ValueError("index was built from other table: %s" % meta['table_path'])
+    if key_type and key_type != meta['key_type']:
+        raise ValueError("index was built with key type '%s', but '%s' is required" % (meta['key_type'], key_type))
+    if trg_key and not meta['trg_key']:
+        raise ValueError("index was built without target keys")
+    if os.path.exists(meta['table_path']):
+        stat = os.stat(meta['table_path'])
+        if stat.st_size != meta['size'] or stat.st_mtime != meta['mtime']:
+            raise ValueError("table was modified after building index: %s" % meta['table_path'])
+    else:
+        logging.warn("can not validate index, table is not found: %s" % meta['table_path'])
 
 cdef class Table(object):
+    '''phrase/rule table indexed by integer IDs
+
+    each distinct record is a row of field IDs in record_fields (-1 for empty field, NO_FIELD for padding),
+    and the records having each source/target key are listed in Postings'''
     cdef readonly object RecordClass
     cdef str table_path
-    cdef object table_file
     cdef str key_type
-    cdef readonly object field_dict
-    #cdef object record_dict
-    cdef readonly object record_dict
-    #cdef readonly object trg_record_dict
-    #cdef readonly object key_record_dict
-    cdef readonly object src_record_dict
-    cdef readonly object trg_record_dict
-    cdef readonly object trg_field_record_dicts
     cdef bool trg_key_enabled
+    cdef readonly StringEnumerator field_enum
+    cdef readonly np.ndarray record_fields
+    cdef readonly Postings src_postings
+    cdef readonly Postings trg_postings
+    cdef readonly list trg_field_postings
+    cdef readonly LookupCache cache
 
     def __init__(self, table_path, RecordClass, trg_key = False, **options):
+        self.setup(table_path, RecordClass, trg_key, options)
+        self.__load()
+
+    cdef setup(self, str table_path, object RecordClass, bool trg_key, dict options):
         self.key_type = options.get('key_type', 'src')
         self.RecordClass = RecordClass
         self.table_path = table_path
-        self.field_dict  = pycedar.dict(str)
-        self.record_dict = pycedar.dict(str)
-        #self.key_record_dict    = pycedar.dict(str)
-        self.src_record_dict    = pycedar.dict(str)
-        #if trg_key:
-        #    self.trg_record_dict = pycedar.dict(str)
-        #else:
-        #    self.trg_record_dict = None
         self.trg_key_enabled = trg_key
-        if trg_key:
-            self.trg_record_dict = pycedar.dict(str)
-            self.trg_field_record_dicts = []
-        self.__load()
-
-    #cdef add_key_and_node(self, str key, object record_node):
-    #    cdef str key_track, pair_tracks
-    #    key_track = get_track_str(self.field_dict.get_node(key))
-    #    pair_tracks = "%s | %s" % (key_track, get_track_str(record_node))
-    #    self.key_record_dict.update(pair_tracks, 1)
-
-    cdef add_key_and_node(self, object key_record_dict, str key, object record_node):
-        cdef str key_track, pair_tracks
-        key_track = get_track_str(self.field_dict.get_node(key))
-        pair_tracks = "%s | %s" % (key_track, get_track_str(record_node))
-        #self.key_record_dict.update(pair_tracks, 1)
-        key_record_dict.update(pair_tracks, 1)
+        if options.get('cache_memory', CACHE_MEMORY) > 0:
+            self.cache = LookupCache(options.get('cache_memory', CACHE_MEMORY))
+        else:
+            self.cache = None
 
-    cdef add_fields(self, str line):
-        cdef str field
-        for field in line.split('|||'):
-            field = field.strip()
-            if field:
-                try:
-                    self.field_dict.update(field, 1)
-                except Exception as e:
-                    logging.debug(e)
-                    logging.debug(field)
+    cdef long intern_key(self, StringEnumerator field_enum, str key):
+        if key:
+            return field_enum.str2id(key)
+        else:
+            return -1
 
     cpdef str format_src_key(self, str src):
-        if self.key_type == 'src':
-            #return src + ' ||| '
-            return src
-        elif self.key_type == 'src_hiero':
-            #return str.join(' ', self.RecordClass.getSymbols(src,hiero=True)) + ' ||| '
-            return str.join(' ', self.RecordClass.getSymbols(src,hiero=True))
-        elif self.key_type == 'src_symbols':
-            #return str.join(' ', self.RecordClass.getSymbols(src,hiero=False)) + ' ||| '
-            return str.join(' ', self.RecordClass.getSymbols(src,hiero=False))
-
-    cpdef str line2tracks(self, str line):
-        cdef list track_list = []
-        cdef str str_track
-        for field in line.split('|||'):
-            field = field.strip()
-            if len(field) == 0:
-                track_list.append('')
-            elif field in self.field_dict:
-                #str_track = get_track_str(self.field_dict, field)
-                str_track = get_track_str( self.field_dict.get_node(field) )
-                #str_track = str( self.field_dict.get_node(field).track() ).replace(' ', '')
-                track_list.append( str_track )
-            else:
-                #logging.warn("'%s' is not in self.field_dict" % field)
-                track_list.append( "(-1,-1)" )
-        return str.join(' | ', track_list)
-
-    cpdef str tracks2line(self, str tracks):
-    #cpdef str tracks2line(self, str tracks):
-        cdef list field_list = []
-        #cdef (int,int) numbers
-        cdef list numbers
-        cdef size_t node_id, length
-        for track in tracks.split('|'):
-            track = track.strip()
-            if track:
-                #field is form of "(id,length)")
-                #numbers = ( field[1:-1].split(',') )
-                #node_id = int(numbers[0])
-                #length  = int(numbers[1])
-                #field_list.append( self.field_dict.trie.suffix(node_id,length) )
-                field_list.append( track2key(self.field_dict, track) )
-            else:
-                field_list.append( '' )
-        return str.join(' ||| ', field_list)
+        return format_key(self.RecordClass, self.key_type, src)
 
     cdef __load(self):
-        cdef long i
+        cdef long i, j, num_records
         cdef str line
-        #cdef object rec
         cdef str src, trg
-        cdef str srcKey
-        #print(self.table_file)
-        cdef str line_tracks
-        cdef str src_tracks
-        cdef str trg_tracks
-        cdef str str_track_pair
-        cdef str pair_tracks
-        #cdef list rec_tracks
-        cdef object node
         cdef str field
-
-        for i, line in enumerate(progress.view(self.table_path, 'building trie of all fields')):
-            #if i > 200000:
-            #    break
+        cdef list fields
+        cdef bytes record
+        cdef tuple column_ids
+        cdef dict src_key_ids = {}
+        cdef dict trg_column_ids = {}
+        cdef object src_keys = array.array('q')
+        cdef object trg_keys = array.array('q')
+        cdef list column_keys = []
+        cdef StringEnumerator field_enum = StringEnumerator()
+        # distinct records as byte strings of their field IDs
+        cdef StringEnumerator record_enum = StringEnumerator()
+
+        for i, line in enumerate(progress.view(files.open(self.table_path, 'rt'), 'loading table')):
             try:
-                src = line.split('|||',1)[0].strip()
-                self.add_fields(line)
-                self.add_fields(self.format_src_key(src))
+                fields = [field.strip() for field in line.strip().split('|||')]
+                record = array.array('i', [self.intern_key(field_enum, field) for field in fields]).tobytes()
+                num_records = record_enum.count
+                if record_enum.lookup(record, len(record), True, -1) < num_records:
+                    # duplicated record
+                    continue
+                src = fields[0]
+                if src not in src_key_ids:
+                    src_key_ids[src] = self.intern_key(field_enum, self.format_src_key(src))
+                src_keys.append(src_key_ids[src])
                 if self.trg_key_enabled:
-                    trg = line.split('|||',2)[1].strip()
-                    self.add_fields(trg)
-                    if trg.find('|COL|') >= 0:
-                        for field in trg.split('|COL|'):
-                            self.add_fields(field.strip())
+                    trg = fields[1]
+                    if trg not in trg_column_ids:
+                        if trg.find('|COL|') >= 0:
+                            trg_column_ids[trg] = tuple([self.intern_key(field_enum, field.strip()) for field in trg.split('|COL|')])
+                        else:
+                            trg_column_ids[trg] = ()
+                    trg_keys.append(self.intern_key(field_enum, trg))
+                    column_ids = trg_column_ids[trg]
+                    for j in range(max(len(column_ids), len(column_keys))):
+                        if j >= len(column_keys):
+                            column_keys.append( array.array('q', [NO_FIELD]) * num_records )
+                        column_keys[j].append(column_ids[j] if j < len(column_ids) else NO_FIELD)
             except Exception as e:
                 logging.warn("file: %s, line: %s" % (self.table_path, i+1))
                 logging.warn(e)
                 raise e
-
-        for i, line in enumerate(progress.view(self.table_path, 'building trie of all records')):
-            try:
-                line_tracks = self.line2tracks(line.strip())
-                self.record_dict.update(line_tracks, 1)
-            except Exception as e:
-                logging.warn("file: %s, line: %s" % (self.table_path, i+1))
-                logging.warn(e)
-                raise e
-
-        for node in progress.view(self.record_dict.nodes(), 'registering pair of (key,record)', max_count=len(self.record_dict)):
-            try:
-                line_tracks = node.key()
-                line = self.tracks2line(line_tracks)
-                src = line.split('|||',1)[0].strip()
-                src_key = self.format_src_key(src)
-                #self.add_key_and_node(src_key, node)
-                self.add_key_and_node(self.src_record_dict, src_key, node)
-                if self.trg_key_enabled:
-                    trg = line.split('|||', 2)[1].strip()
-                    #self.add_key_and_node(trg, node)
-                    self.add_key_and_node(self.trg_record_dict, trg, node)
-                    if trg.find('|COL|') >= 0:
-                        for i, field in enumerate(trg.split('|COL|')):
-                            if i >= len(self.trg_field_record_dicts):
-                                self.trg_field_record_dicts.append( pycedar.dict(str) )
-                            #self.add_key_and_node(field.strip(), node)
-                            self.add_key_and_node(self.trg_field_record_dicts[i], field.strip(), node)
-            except Exception as e:
-                logging.warn("line_tracks: %s" % line_tracks)
-                logging.warn("line: %s" % line)
-                #logging.warn("src_key: %s" % src_key)
-                logging.warn(e)
-                raise e
-
-    def __find_key(self, object key_record_dict, str key, bool force=True):
-        cdef str line
-        cdef str key_track
-        cdef str pair_tracks
-        cdef str record_track
-        cdef str line_tracks
-
-        key_track = self.line2tracks(key)
-        if key_track.find('(-1,-1)') >= 0:
-            return
-        for pair_tracks in key_record_dict.find_keys(key_track,force=force):
-            record_track = pair_tracks.split('|',1)[1].strip()
-            line_tracks = track2key(self.record_dict, record_track)
-            line = self.tracks2line(line_tracks)
-            yield self.RecordClass(line)
+        self.field_enum = field_enum
+        self.record_fields = record_matrix(record_enum)
+        self.src_postings = Postings.build(np.array(src_keys, np.int64), len(field_enum))
+        if self.trg_key_enabled:
+            self.trg_postings = Postings.build(np.array(trg_keys, np.int64), len(field_enum))
+            self.trg_field_postings = [Postings.build(np.array(keys, np.int64), len(field_enum)) for keys in column_keys]
+
+    @staticmethod
+    def build_index(str table_path, str index_path, RecordClass, trg_key = False, **options):
+        '''load the table and store its fields, records and postings of keys into index_path directory for Table.open()'''
+        cdef Table table
+        cdef long j
+        stat = os.stat(table_path)
+        table = Table(table_path, RecordClass, trg_key, **options)
+        if not os.path.isdir(index_path):
+            os.makedirs(index_path)
+        table.field_enum.save(os.path.join(index_path, 'fields.bin'))
+        np.save(os.path.join(index_path, 'records.npy'), table.record_fields)
+        table.src_postings.save(index_path, 'src')
+        if trg_key:
+            table.trg_postings.save(index_path, 'trg')
+            for j in range(len(table.trg_field_postings)):
+                table.trg_field_postings[j].save(index_path, 'trg%d' % j)
+        meta = {
+            'version': INDEX_VERSION,
+            'table_path': os.path.abspath(table_path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'key_type': table.key_type,
+            'trg_key': table.trg_key_enabled,
+            'trg_fields': len(table.trg_field_postings) if trg_key else 0,
+        }
+        # written at last, an index without this file is incomplete
+        with files.open(os.path.join(index_path, 'index.json'), 'wt') as fobj:
+            json.dump(meta, fobj)
+        logging.log("saved index of %s records: %s" % (len(table), index_path))
+
+    @staticmethod
+    def open(str index_path, RecordClass, str table_path=None, trg_key = False, mmap=True, **options):
+        '''table stored by build_index() (memory-mapped by default, so processes share the pages)
+
+        raise ValueError if the table was modified after building the index, or the index does not fit the options'''
+        cdef Table table = Table.__new__(Table)
+        cdef long j
+        with files.open(os.path.join(index_path, 'index.json'), 'rt') as fobj:
+            meta = json.load(fobj)
+        check_index(meta, table_path, options.get('key_type', 'src'), trg_key)
+        options['key_type'] = meta['key_type']
+        table.setup(meta['table_path'], RecordClass, meta['trg_key'], options)
+        table.field_enum = StringEnumerator.load(os.path.join(index_path, 'fields.bin'), mmap)
+        table.record_fields = np.load(os.path.join(index_path, 'records.npy'), mmap_mode='r' if mmap else None)
+        table.src_postings = Postings.load(index_path, 'src', mmap)
+        if meta['trg_key']:
+            table.trg_postings = Postings.load(index_path, 'trg', mmap)
+            table.trg_field_postings = [Postings.load(index_path, 'trg%d' % j, mmap) for j in range(meta['trg_fields'])]
+        return table
+
+    cpdef str record_line(self, long rec_id):
+        '''line of the record'''
+        cdef list fields = []
+        for field_id in self.record_fields[rec_id]:
+            if field_id == NO_FIELD:
+                break
+            elif field_id >= 0:
+                fields.append(self.field_enum.id2str(field_id))
+            else:
+                fields.append('')
+        return str.join(' ||| ', fields)
+
+    cdef np.ndarray key_records(self, Postings postings, str key):
+        cdef long key_id
+        if not key:
+            # empty key matches with every key
+            return postings.record_ids
+        key_id = self.field_enum.get(key)
+        if key_id < 0:
+            return postings.record_ids[:0]
+        return postings.find(key_id)
+
+    cdef np.ndarray prefix_records(self, str prefix):
+        cdef str field
+        cdef list fields = [field.strip() for field in prefix.split('|||')]
+        cdef list field_ids = []
+        cdef np.ndarray candidates
+        if not fields[-1]:
+            # trailing empty field matches with any field
+            fields.pop()
+        if not fields:
+            # records of the same source are kept together for the callers grouping them by source
+            return np.argsort(self.record_fields[:, 0], kind='stable')
+        if len(fields) > self.record_fields.shape[1]:
+            return np.zeros(0, np.int64)
+        for field in fields:
+            field_ids.append( self.field_enum.get(field) if field else -1 )
+            if field and field_ids[-1] < 0:
+                return np.zeros(0, np.int64)
+        if self.key_type == 'src' and field_ids[0] >= 0:
+            candidates = self.src_postings.find(field_ids[0])
+            return candidates[(self.record_fields[candidates, :len(field_ids)] == field_ids).all(axis=1)]
+        return np.flatnonzero((self.record_fields[:, :len(field_ids)] == field_ids).all(axis=1))
+
+    def iter_records(self, record_ids):
+        '''lazy views of the records (see records.RecordView)'''
+        for rec_id in record_ids:
+            yield records.RecordView(self.record_line(rec_id), self.RecordClass)
+
+    cdef find_key(self, Postings postings, tuple cache_key, str key):
+        '''records of the key, through the cache if enabled
+
+        the cached records are shared by the lookups of the same key, so they should not be modified'''
+        cdef list recs
+        cdef list lines
+        if self.cache is None:
+            return self.iter_records(self.key_records(postings, key))
+        recs = self.cache.get(cache_key)
+        if recs is None:
+            lines = [self.record_line(rec_id) for rec_id in self.key_records(postings, key)]
+            recs = [records.RecordView(line, self.RecordClass) for line in lines]
+            self.cache.put(cache_key, recs, sum([len(line) for line in lines]) + RECORD_OVERHEAD * len(lines))
+        return iter(recs)
 
     def find(self, str prefix, bool force=True):
-        cdef str prefix_tracks
-        cdef str line_tracks
-        cdef str line
-
-        prefix_tracks = self.line2tracks(prefix)
-        for line_tracks in self.record_dict.find_keys(prefix_tracks, force=force):
-            line = self.tracks2line(line_tracks)
-            yield self.RecordClass(line)
-
-    #def find(self, str key):
-    #    cdef str line
-    #    #cdef str str_tracks
-    #    cdef str key_track
-    #    cdef str pair_tracks
-    #    cdef str record_track
-    #    cdef str line_tracks
-
-    #    if key:
-    #        #str_tracks = self.line2tracks(key)
-    #        key_track = self.line2tracks(key)
-    #        if key_track.find('(-1,-1)') >= 0:
-    #            return
-    #        #for line in self.record_dict.find_keys(str_tracks, force=True):
-    #        #    main_tracks = line.split('|||', 1)[1]
-    #        #    yield self.RecordClass( self.tracks2line(main_tracks) )
-    #        #for pair_tracks in self.key_record_dict.find_keys(key_track, force=True):
-    #        for pair_tracks in self.src_record_dict.find_keys(key_track, force=True):
-    #            record_track = pair_tracks.split('|',1)[1].strip()
-    #            line_tracks  = track2key(self.record_dict, record_track)
-    #            line = self.tracks2line(line_tracks)
-    #            yield self.RecordClass( line )
-    #    else:
-    #        # empty key, find all records (without key)
-    #        for line_tracks in self.record_dict.find_keys('', force=True):
-    #            line = self.tracks2line(line_tracks)
-    #            yield self.RecordClass( line )
-
-    #cpdef find_src(self, str src):
-        #return self.find(self.format_src_key(src))
+        return self.iter_records(self.prefix_records(prefix))
 
     cpdef find_src(self, str src, force=True):
-        return self.__find_key(self.src_record_dict, self.format_src_key(src), force=force)
-
-    #cpdef find_trg(self, str trg):
-    #    if not trg:
-    #        raise KeyError("trg should not be empty")
-    #    return self.find(trg)
+        cdef str src_key = self.format_src_key(src)
+        return self.find_key(self.src_postings, ('src', src_key), src_key)
 
     cpdef find_trg(self, str trg, object target_index=None, force=True):
         #if target_number >= 0:
         if isinstance(target_index,int):
-            return self.__find_key(self.trg_field_record_dicts[target_index], trg, force=force)
+            return self.find_key(self.trg_field_postings[target_index], ('trg', target_index, trg), trg)
         else:
-            return self.__find_key(self.trg_record_dict, trg, force=force)
-
-    #def find_trg(self, str trg):
-    #    if self.trg_record_dict is None:
-    #        raise LookupError('target key is not enabled, please init with Table(..., trg_key=True)')
-    #    cdef str line
-    #    cdef str str_tracks
-    #    str_tracks = self.line2tracks(trg)
-
-    #    if str_tracks == '(-1,-1)':
-    #        return
-    #    for line in self.trg_record_dict.find_keys(str_tracks, force=True):
-    #        main_tracks = line.split('|||', 1)[1]
-    #        yield self.RecordClass( self.tracks2line(main_tracks) )
+            return self.find_key(self.trg_postings, ('trg', None, trg), trg)
 
     def __iter__(self):
         return self.find('')
 
     def __len__(self):
-        return len(self.record_dict)
+        return len(self.record_fields)
 
 class MosesTable(Table):
     def __init__(self, table_path, **options):
@@ -306,3 +400,53 @@ class TravatarTable(Table):
     def __init__(self, table_path, **options):
         Table.__init__(self, table_path, records.TravatarRecord, **options)
 
+def open_table(table_path, RecordClass, index_path=None, **options):
+    '''load the table, or open its index if index_path is given (the index is built when missing or stale)'''
+    if not index_path:
+        return Table(table_path, RecordClass, **options)
+    try:
+        return Table.open(index_path, RecordClass, table_path, **options)
+    except (IOError, ValueError) as e:
+        logging.log("building index of %s: %s (%s)" % (table_path, index_path, e))
+    Table.build_index(table_path, index_path, RecordClass, **options)
+    return Table.open(index_path, RecordClass, table_path, **options)
+
+def write_synthetic_table(str table_path, long num_records, long vocab_size, long max_length=4, long seed=0):
+    '''write a random phrase table in moses format'''
+    cdef long i
+    cdef list src, trg
+    rand = random.Random(seed)
+    with files.open(table_path, 'wt') as fobj:
+        for i in range(num_records):
+            src = ['s%d' % rand.randrange(vocab_size) for j in range(rand.randint(1,max_length))]
+            trg = ['t%d' % rand.randrange(vocab_size) for j in range(rand.randint(1,max_length))]
+            fobj.write("%s ||| %s ||| %s ||| %s ||| %d %d %d\n" % (
+                str.join(' ', src), str.join(' ', trg),
+                str.join(' ', ['%.6g' % rand.random() for j in range(4)]),
+                str.join(' ', ['%d-%d' % (j, min(j,len(trg)-1)) for j in range(len(src))]),
+                rand.randint(1,100), rand.randint(1,100), rand.randint(1,100)))
+
+def benchmark_load(num_records=BENCHMARK_RECORDS, vocab_size=BENCHMARK_VOCAB_SIZE, trg_key=False, seed=0):
+    '''measure the time of loading Table from generated gzipped table'''
+    cdef str work_dir = tempfile.mkdtemp(prefix='bench_tables.')
+    cdef str table_path = os.path.join(work_dir, 'table.gz')
+    try:
+        logging.log("generating %s synthetic records" % num_records)
+        write_synthetic_table(table_path, num_records, vocab_size, seed=seed)
+        start = time.time()
+        table = MosesTable(table_path, trg_key=trg_key)
+        load_time = time.time() - start
+        logging.log("loaded %s distinct records in %.3f [sec] (%.1f lines/sec, %s bytes compressed)"
+            % (len(table), load_time, num_records / load_time, os.path.getsize(table_path)))
+        return load_time
+    finally:
+        shutil.rmtree(work_dir)
+
+def benchmark_main():
+    parser = argparse.ArgumentParser(description='benchmark loading of phrase table on synthetic data')
+    parser.add_argument('--num-records', '-n', help='number of synthetic records (default: %(default)s)', type=int, default=BENCHMARK_RECORDS)
+    parser.add_argument('--vocab-size', '-V', help='vocabulary size of each side (default: %(default)s)', type=int, default=BENCHMARK_VOCAB_SIZE)
+    parser.add_argument('--trg-key', help='index target phrases as well', action='store_true')
+    parser.add_argument('--seed', help='random seed (default: %(default)s)', type=int, default=0)
+    args = parser.parse_args()
+    benchmark_load(args.num_records, args.vocab_size, args.trg_key, args.seed)
@@ -6,16 +6,21 @@ by combining source-pivot and pivot-target for common pivot phrase'''
 
 # Standarde libraries
 import argparse
+import heapq
+import itertools
 import math
+import os
 import sys
+import tempfile
+from operator import itemgetter
 
 # Local libraries
 from nlputils.common import compat
 from nlputils.common import files
 from nlputils.common import logging
 from nlputils.common import progress
-from nlputils.smt.trans_models.records import MosesRecord, TravatarRecord
-from nlputils.smt.trans_models.tables import Table
+from nlputils.smt.trans_models.records import MosesRecord, TravatarRecord, RecordWriter, FEATURE_SCHEMA
+from nlputils.smt.trans_models.tables import Table, open_table, format_key
 
 from nlputils.data_structs import trees
 
@@ -29,6 +34,10 @@ MINPROB = 10 ** -10
 # limit number of records for the same source phrase
 NBEST = 20
 
+# feature slots marginalized over pivot phrases
+PRODPROB_SLOTS = FEATURE_SCHEMA.slots_of(['egfl', 'egfp', 'fgel', 'fgep'])
+LEX_SLOTS = FEATURE_SCHEMA.slots_of(['egfl', 'fgel'])
+
 # methods to estimate trans probs (countmin/prodprob/bidirmin/bidirgmean/bidirmax/bidiravr)
 method_list = ['countmin', 'prodprob', 'bidirmin', 'bidirgmean', 'bidirmax', 'bidiravr']
 #METHOD = 'counts'
@@ -52,6 +61,11 @@ NULLS = 10**4
 
 NOPREFILTER = False
 
+# number of items sorted in memory at once by streaming pivot
+SORT_BUFFER = 10**6
+# delimiter of the fields in the sorted runs (table lines containing it are rejected by sortItems)
+SORT_DELIM = '\t'
+
 class WorkSet:
     '''data set for multi-processing'''
     def __init__(self, savefile, workdir, method, **options):
@@ -69,6 +83,7 @@ class WorkSet:
         self.threshold = THRESHOLD
         self.workdir = workdir
         self.foutPivot = files.open(savefile, 'wt')
+        self.writer = RecordWriter(self.foutPivot)
         #self.pivotProc = multiprocessing.Process( target = pivotRecPairs, args = (self,) )
         #self.recordProc = multiprocessing.Process( target = writeRecordQueue, args = (self,) )
         self.numRecSrcPvt = 0
@@ -86,6 +101,7 @@ class WorkSet:
 
     def close(self):
         if self.foutPivot:
+            self.writer.close()
             self.foutPivot.close()
             self.foutPivot = None
 #        if self.pivotProc.pid:
@@ -125,34 +141,28 @@ def updateFeatures(recPivot, recPair, workset, multi_target = False):
     if workset.method.find('prodprob') >= 0:
         # multiplying scores and marginalizing
         if not multi_target:
-            for key in ['egfl', 'egfp', 'fgel', 'fgep']:
-                features.setdefault(key, 0)
-                if workset.matchMethod == 'hiero':
-                    features[key] += (srcFeatures[key] * trgFeatures[key])
-                elif workset.matchMethod == 'symbols':
-                    features[key] += (srcFeatures[key] * trgFeatures[key])
-                elif workset.matchMethod == 'treecomp':
-                    features[key] += (srcFeatures[key] * trgFeatures[key])
-                elif workset.matchMethod == 'treedist':
-                    elems1 = recPair[0].trg.split(' ')[0:-1]
-                    elems2 = recPair[1].src.split(' ')[0:-1]
-                    tree1 = trees.parseSExpression('(' + str.join(' ', elems1) + ')')[0]
-                    tree2 = trees.parseSExpression('(' + str.join(' ', elems2) + ')')[0]
-                    dist = trees.calcTreeEditDistance(tree1, tree2)
-                    numTerms = len(recPair[0].trgTerms)
-                    numElems = max(trees.countElements(tree1), trees.countElements(tree2))
-                    rate = max(1, 1 + numElems - numTerms - dist) / float(max(1, 1 + numElems - numTerms))
-                    features[key] += (rate * srcFeatures[key] * trgFeatures[key])
-                elif workset.matchMethod == 'treedistexp':
-                    elems1 = recPair[0].trg.split(' ')[0:-1]
-                    elems2 = recPair[1].src.split(' ')[0:-1]
-                    tree1 = trees.parseSExpression('(' + str.join(' ', elems1) + ')')[0]
-                    tree2 = trees.parseSExpression('(' + str.join(' ', elems2) + ')')[0]
-                    dist = trees.calcTreeEditDistance(tree1, tree2)
-                    rate = math.exp(-dist)
-                    features[key] += (rate * srcFeatures[key] * trgFeatures[key])
-                else:
-                    assert False, 'Invalid Match Method'
+            if workset.matchMethod in ['hiero', 'symbols', 'treecomp']:
+                features.add_products(PRODPROB_SLOTS, srcFeatures, trgFeatures)
+            elif workset.matchMethod == 'treedist':
+                elems1 = recPair[0].trg.split(' ')[0:-1]
+                elems2 = recPair[1].src.split(' ')[0:-1]
+                tree1 = trees.parseSExpression('(' + str.join(' ', elems1) + ')')[0]
+                tree2 = trees.parseSExpression('(' + str.join(' ', elems2) + ')')[0]
+                dist = trees.calcTreeEditDistance(tree1, tree2)
+                numTerms = len(recPair[0].trgTerms)
+                numElems = max(trees.countElements(tree1), trees.countElements(tree2))
+                rate = max(1, 1 + numElems - numTerms - dist) / float(max(1, 1 + numElems - numTerms))
+                features.add_products(PRODPROB_SLOTS, srcFeatures, trgFeatures, rate)
+            elif workset.matchMethod == 'treedistexp':
+                elems1 = recPair[0].trg.split(' ')[0:-1]
+                elems2 = recPair[1].src.split(' ')[0:-1]
+                tree1 = trees.parseSExpression('(' + str.join(' ', elems1) + ')')[0]
+                tree2 = trees.parseSExpression('(' + str.join(' ', elems2) + ')')[0]
+                dist = trees.calcTreeEditDistance(tree1, tree2)
+                rate = math.exp(-dist)
+                features.add_products(PRODPROB_SLOTS, srcFeatures, trgFeatures, rate)
+            else:
+                assert False, 'Invalid Match Method'
         if multi_target:
             # p(trg,pvt|src) ~ p(trg|pvt) * p(pvt|src)
             features['egfp'] =  srcFeatures['egfp'] * trgFeatures['egfp']
@@ -172,9 +182,7 @@ def updateFeatures(recPivot, recPair, workset, multi_target = False):
                 features['1'+key] = srcFeatures[key]
     else:
         # multiplying only lexical weights and marginalizing
-        for key in ['egfl', 'fgel']:
-            features.setdefault(key, 0)
-            features[key] += (srcFeatures[key] * trgFeatures[key])
+        features.add_products(LEX_SLOTS, srcFeatures, trgFeatures)
     # using 'p' and 'w' of target
     if 'p' in trgFeatures:
         features['p'] = trgFeatures['p']
@@ -239,18 +247,8 @@ def updateCounts(recPivot, recPair, method):
 
 def mergeAligns(recPivot, recPair):
     '''merge word alignments'''
-#    if recPivot.aligns:
-#      return
-#    alignSet = set()
-    alignMapSrcPvt = recPair[0].alignMap
-    alignMapPvtTrg = recPair[1].alignMap
-    for srcIndex, pvtIndices in alignMapSrcPvt.items():
-        for pvtIndex in pvtIndices:
-            for trgIndex in alignMapPvtTrg.get(pvtIndex, []):
-              align = '%d-%d' % (srcIndex, trgIndex)
-#              alignSet.add(align)
-              recPivot.aligns.add(align)
-#    recPivot.aligns = sorted(alignSet)
+    # composing source-pivot and pivot-target alignment points
+    recPivot.aligns.add_composed(recPair[0].aligns, recPair[1].aligns)
 
 
 def filterByCountRatioToMax(records, div = 100):
@@ -513,9 +511,7 @@ def writeRecord(rec, workset):
     '''write the pivoted records in the queue into the table file'''
     if rec:
         if rec.counts.cooc > 0:
-            workset.foutPivot.write( rec.to_str() )
-            workset.foutPivot.write( "\n" )
-            workset.foutPivot.flush()
+            workset.writer.write(rec)
             workset.numRecSrcTrg += 1
             workset.setPhrasesSrcTrg.add(rec.src)
             for term in rec.srcTerms:
@@ -581,6 +577,127 @@ def calcLexWeights(table_path, lexCounts, savePath, RecordClass = MosesRecord):
     table_file.close()
 
 
+def writeSortRun(items, workdir):
+    '''write the sorted items into a temporary file and return its path'''
+    fd, path = tempfile.mkstemp(prefix='pivot-sort.', suffix='.txt', dir=workdir)
+    os.close(fd)
+    with files.open(path, 'wt') as fobj:
+        for item in items:
+            fobj.write(str.join(SORT_DELIM, item))
+            fobj.write("\n")
+    return path
+
+def readSortRun(path):
+    with files.open(path, 'rt') as fobj:
+        for line in fobj:
+            yield tuple(line.rstrip("\n").split(SORT_DELIM))
+
+def sortItems(items, workdir, bufferSize = SORT_BUFFER):
+    '''sort the tuples of strings with bounded memory
+
+    every bufferSize items are sorted in memory and written into a temporary run file,
+    then the runs are merged lazily (the strings must not contain SORT_DELIM)'''
+    runPaths = []
+    buf = []
+    try:
+        for item in items:
+            for field in item:
+                if SORT_DELIM in field:
+                    raise ValueError("streaming pivot cannot sort the line containing %r: %s" % (SORT_DELIM, field))
+            buf.append(item)
+            if len(buf) >= bufferSize:
+                buf.sort()
+                runPaths.append( writeSortRun(buf, workdir) )
+                buf = []
+        buf.sort()
+        if not runPaths:
+            for item in buf:
+                yield item
+        else:
+            for item in heapq.merge(buf, *[readSortRun(path) for path in runPaths]):
+                yield item
+    finally:
+        for path in runPaths:
+            if os.path.exists(path):
+                os.remove(path)
+
+def uniqueItems(items):
+    '''drop the duplicated lines of the same key from the (key, seq, line) items sorted by key'''
+    for key, group in itertools.groupby(items, itemgetter(0)):
+        lines = set()
+        for item in group:
+            if item[2] not in lines:
+                lines.add(item[2])
+                yield item
+
+def joinPivots(itemsSrcPvt, itemsPvtTrg):
+    '''merge-join the (pivot key, seq, line) items of source-pivot and pivot-target tables sorted by pivot key
+
+    yield (src, seqSrcPvt, seqPvtTrg, lineSrcPvt, linePvtTrg) for each pair of records with common pivot key,
+    only the pivot-target records of the current pivot are held in memory'''
+    groupsSrcPvt = itertools.groupby(itemsSrcPvt, itemgetter(0))
+    groupsPvtTrg = itertools.groupby(itemsPvtTrg, itemgetter(0))
+    keySrcPvt, groupSrcPvt = next(groupsSrcPvt, (None, None))
+    keyPvtTrg, groupPvtTrg = next(groupsPvtTrg, (None, None))
+    while keySrcPvt is not None and keyPvtTrg is not None:
+        if keySrcPvt < keyPvtTrg:
+            keySrcPvt, groupSrcPvt = next(groupsSrcPvt, (None, None))
+        elif keySrcPvt > keyPvtTrg:
+            keyPvtTrg, groupPvtTrg = next(groupsPvtTrg, (None, None))
+        else:
+            itemsPvtTrg = list(groupPvtTrg)
+            for _, seqSrcPvt, lineSrcPvt in groupSrcPvt:
+                src = lineSrcPvt.split('|||', 1)[0].strip()
+                for _, seqPvtTrg, linePvtTrg in itemsPvtTrg:
+                    yield (src, seqSrcPvt, seqPvtTrg, lineSrcPvt, linePvtTrg)
+            keySrcPvt, groupSrcPvt = next(groupsSrcPvt, (None, None))
+            keyPvtTrg, groupPvtTrg = next(groupsPvtTrg, (None, None))
+
+def pivotStreaming(table1, table2, workset, key_type, bufferSize = SORT_BUFFER, collectStats = False):
+    '''pivot without loading the whole tables into memory
+
+    both the tables are sorted by pivot key with bounded memory and merge-joined on the pivot,
+    then the joined pairs are sorted by source (keeping the order of the tables for each source)
+    and the pairs of each source are processed by pivotRecPairs()'''
+    RecordClass = workset.Record
+
+    def itemsSrcPvt():
+        for i, line in enumerate(progress.view(files.open(table1, 'rt'), 'sorting: %s' % table1)):
+            line = line.strip()
+            yield (format_key(RecordClass, key_type, line.split('|||', 2)[1].strip()), '%012d' % i, line)
+
+    def countSrcPvt(items):
+        for item in items:
+            workset.numRecSrcPvt += 1
+            if collectStats:
+                recSrcPvt = RecordClass(item[2])
+                workset.setPhrasesSrcPvt.add(recSrcPvt.src)
+                for term in recSrcPvt.srcTerms:
+                    workset.setWordsSrcPvt.add(term)
+            yield item
+
+    def itemsPvtTrg():
+        for i, line in enumerate(progress.view(files.open(table2, 'rt'), 'sorting: %s' % table2)):
+            line = line.strip()
+            yield (format_key(RecordClass, key_type, line.split('|||', 1)[0].strip()), '%012d' % i, line)
+
+    pairs = joinPivots(countSrcPvt(uniqueItems(sortItems(itemsSrcPvt(), workset.workdir, bufferSize))),
+                       uniqueItems(sortItems(itemsPvtTrg(), workset.workdir, bufferSize)))
+    for src, group in itertools.groupby(sortItems(pairs, workset.workdir, bufferSize), itemgetter(0)):
+        rows = []
+        recordsSrcPvt = {}
+        for _, seqSrcPvt, _, lineSrcPvt, linePvtTrg in group:
+            if seqSrcPvt not in recordsSrcPvt:
+                recordsSrcPvt[seqSrcPvt] = RecordClass(lineSrcPvt)
+            recPvtTrg = RecordClass(linePvtTrg)
+            workset.numRecPvtTrg += 1
+            if collectStats:
+                workset.setPhrasesPvtTrg.add(recPvtTrg.src)
+                for term in recPvtTrg.srcTerms:
+                    workset.setWordsPvtTrg.add(term)
+            rows.append( (recordsSrcPvt[seqSrcPvt], recPvtTrg) )
+        pivotRecPairs(rows, workset)
+
 def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
     '''find pair of source-pivot and pivot-target records for common pivot phrase'''
     try:
@@ -598,6 +715,11 @@ def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
         multi_target = options.get('multitarget', False)
         logFile = options.get('log', '')
         showProgress = options.get('progress', True)
+        index1 = options.get('index1', None)
+        index2 = options.get('index2', None)
+        cacheMemory = int(options.get('cache_mb', 0) * 1024 * 1024)
+        streaming = options.get('streaming', False)
+        sortBuffer = options.get('sort_buffer', SORT_BUFFER)
 
         if lexMethod not in ('prodweight', 'table'):
             if alignLexPath == None:
@@ -608,11 +730,12 @@ def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
             key_type = 'src_hiero'
         else:
             key_type = 'src_symbols'
-        logging.log("loading: %s" % table1)
-        #tableSrcPvt = Table(table1, RecordClass, key_type=key_type, showProgress=showProgress)
-        tableSrcPvt = Table(table1, RecordClass, showProgress=showProgress)
-        logging.log("loading: %s" % table2)
-        tablePvtTrg = Table(table2, RecordClass, key_type=key_type, showProgress=showProgress)
+        if not streaming:
+            logging.log("loading: %s" % table1)
+            #tableSrcPvt = Table(table1, RecordClass, key_type=key_type, showProgress=showProgress)
+            tableSrcPvt = open_table(table1, RecordClass, index1, showProgress=showProgress)
+            logging.log("loading: %s" % table2)
+            tablePvtTrg = open_table(table2, RecordClass, index2, key_type=key_type, showProgress=showProgress, cache_memory=cacheMemory)
 
         workOptions = {}
         workOptions['RecordClass'] = RecordClass
@@ -624,38 +747,43 @@ def pivot(table1, table2, savefile="phrase-table.gz", workdir=".", **options):
         workset.threshold = threshold
         workset.nbest = nbest
 
-        rows = []
-        lastSrc = ''
         logging.log("beginning pivot\n")
-        #for recSrcPvt in progress.view(tableSrcPvt.find(''),maxCount=len(tableSrcPvt)):
-        for recSrcPvt in progress.view(tableSrcPvt.find(''),'processing',max_count=len(tableSrcPvt)):
-            src = recSrcPvt.src
-            workset.numRecSrcPvt += 1
-            workset.setPhrasesSrcPvt.add(recSrcPvt.src)
-            for term in recSrcPvt.srcTerms:
-                workset.setWordsSrcPvt.add(term)
-            if src != lastSrc:
-                if len(rows) > 0:
-                    pivotRecPairs(rows, workset)
-                    rows = []
-            #pvtKey = str.join(' ', recSrcPvt.trgSymbols)
-            #if key_type == 'src_hiero':
-            #    pvtKey = str.join(' ', RecordClass.getSymbols(recSrcPvt.trg,hiero=True))
-            #elif key_type == 'src_symbols':
-            #    pvtKey = str.join(' ', RecordClass.getSymbols(recSrcPvt.trg,hiero=False))
-            #logging.log("pvt key: %s" % (pvtKey,))
-            #for recPvtTrg in tablePvtTrg.find(pvtKey):
-            #for recPvtTrg in tablePvtTrg.find_src(pvtKey):
-            for recPvtTrg in tablePvtTrg.find_src(recSrcPvt.trg):
-                workset.numRecPvtTrg += 1
-                workset.setPhrasesPvtTrg.add(recPvtTrg.src)
-                for term in recPvtTrg.srcTerms:
-                    workset.setWordsPvtTrg.add(term)
-                rows.append( (recSrcPvt, recPvtTrg) )
-            lastSrc = src
-        if len(rows) > 0:
-            pivotRecPairs(rows, workset)
+        if streaming:
+            pivotStreaming(table1, table2, workset, key_type, sortBuffer, bool(logFile))
+        else:
             rows = []
+            lastSrc = ''
+            #for recSrcPvt in progress.view(tableSrcPvt.find(''),maxCount=len(tableSrcPvt)):
+            for recSrcPvt in progress.view(tableSrcPvt.find(''),'processing',max_count=len(tableSrcPvt)):
+                src = recSrcPvt.src
+                workset.numRecSrcPvt += 1
+                workset.setPhrasesSrcPvt.add(recSrcPvt.src)
+                for term in recSrcPvt.srcTerms:
+                    workset.setWordsSrcPvt.add(term)
+                if src != lastSrc:
+                    if len(rows) > 0:
+                        pivotRecPairs(rows, workset)
+                        rows = []
+                #pvtKey = str.join(' ', recSrcPvt.trgSymbols)
+                #if key_type == 'src_hiero':
+                #    pvtKey = str.join(' ', RecordClass.getSymbols(recSrcPvt.trg,hiero=True))
+                #elif key_type == 'src_symbols':
+                #    pvtKey = str.join(' ', RecordClass.getSymbols(recSrcPvt.trg,hiero=False))
+                #logging.log("pvt key: %s" % (pvtKey,))
+                #for recPvtTrg in tablePvtTrg.find(pvtKey):
+                #for recPvtTrg in tablePvtTrg.find_src(pvtKey):
+                for recPvtTrg in tablePvtTrg.find_src(recSrcPvt.trg):
+                    workset.numRecPvtTrg += 1
+                    workset.setPhrasesPvtTrg.add(recPvtTrg.src)
+                    for term in recPvtTrg.srcTerms:
+                        workset.setWordsPvtTrg.add(term)
+                    rows.append( (recSrcPvt, recPvtTrg) )
+                lastSrc = src
+            if len(rows) > 0:
+                pivotRecPairs(rows, workset)
+                rows = []
+            if tablePvtTrg.cache is not None:
+                logging.log("pivot-target lookup cache: %s" % tablePvtTrg.cache.stats())
         if logFile:
             with open(logFile, 'w') as fobj:
                 fobj.write("%s = %s\n" % ('numRecSrcPvt', workset.numRecSrcPvt))
@@ -766,6 +894,11 @@ def main():
     parser.add_argument('--multitarget', help = 'enabling multi target model', action='store_true')
     parser.add_argument('--progress', '-p', help = 'show progress', type = bool, default=True)
     parser.add_argument('--log', help = 'log file (optional)', type = str, default='')
+    parser.add_argument('--index1', help = 'index directory of rule table 1 (built if missing or stale)', type = str, default=None)
+    parser.add_argument('--index2', help = 'index directory of rule table 2 (built if missing or stale)', type = str, default=None)
+    parser.add_argument('--streaming', help = 'pivot by sorting and merging the tables on disk instead of loading them into memory', action='store_true')
+    parser.add_argument('--sort-buffer', help = 'number of records sorted in memory at once in streaming mode (default: %(default)s)', type = int, default=SORT_BUFFER)
+    parser.add_argument('--cache-mb', help = 'memory budget in MB for caching pivot-target records of frequent pivot phrases (default: disabled)', type = float, default=0)
     args = vars(parser.parse_args())
 
     args['RecordClass'] = TravatarRecord
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''tests of formatting travatar records (run by pytest from the parent directory of nlputils)'''
+
+# Standard libraries
+import io
+import random
+
+# Common Initialization
+import nlputils.init
+# Local libraries
+from nlputils.smt.trans_models import records
+from nlputils.smt.trans_models.records import TravatarRecord
+
+# pairs of travatar table line and the line written by to_str() (the same as the former dict-based records)
+TRAVATAR_LINES = [
+    # log features
+    ('"a" ||| "b" ||| egfl=-1.5 egfp=-0.693147 fgel=-2.302585 fgep=0 ||| 1 2 3 ||| 0-0',
+     '"a" ||| "b" ||| egfl=-1.5 egfp=-0.693147 fgel=-2.302585 fgep=0.0 ||| 1.0 2.0 3.0 ||| 0-0'),
+    # exponentiated features of long names
+    ('"a" "c" ||| "b" ||| lfreq=0.5 count=2 tiny=-20 ||| 4 4 4 ||| 0-0 1-0',
+     '"a" "c" ||| "b" ||| count=7.3890560989306495 lfreq=1.6487212707001282 tiny=2.06115362243856e-09 ||| 4.0 4.0 4.0 ||| 0-0 1-0'),
+    # empty counts
+    ('x0:X "c" ||| x0:X "d" ||| egfp=-0.1 p=2.718 |||  ||| 1-1',
+     'x0:X "c" ||| x0:X "d" ||| egfp=-0.1 p=2.718 |||  ||| 1-1'),
+    # integer-valued features
+    ('"e" ||| "f" ||| p=1 w=3 d=2.0 unk=-1 ||| 1 1 1 ||| 0-0',
+     '"e" ||| "f" ||| d=2 p=1 unk=-1 w=3 ||| 1.0 1.0 1.0 ||| 0-0'),
+    # unsorted and duplicated alignment points
+    ('"g" "h" ||| "i" "j" "k" ||| egfp=-0.5 ||| 0.5 1.25 3 ||| 1-2 0-1 0-1 10-3 2-1 0-0',
+     '"g" "h" ||| "i" "j" "k" ||| egfp=-0.5 ||| 0.5 1.25 3.0 ||| 0-0 0-1 1-2 10-3 2-1'),
+    # rounding of log features and counts, no alignment
+    ('"l" ||| "m" ||| egfl=-0.1234567 fgep=-3 lex=1.5 p=0.25 w=-2 ||| 0.1234567 2.0000001 1e-05 ||| ',
+     '"l" ||| "m" ||| egfl=-0.123457 fgep=-3.0 lex=1.5 p=0.25 w=-2 ||| 0.123457 2.0 1e-05 ||| '),
+]
+
+def random_travatar_lines(num_lines, seed = 0):
+    '''travatar table lines with random log, exponentiated and integer features, and unsorted alignments'''
+    r = random.Random(seed)
+    lines = []
+    for i in range(num_lines):
+        features = ['egfp=%.6f' % r.uniform(-10, 0), 'fgel=%.6f' % r.uniform(-10, 0), 'lfreq=%.6f' % r.uniform(-10, 5),
+                    'count=%d' % r.randint(-5, 5), 'p=2.718', 'w=%d' % r.randint(1, 5)]
+        aligns = ['%d-%d' % (r.randint(0, 3), r.randint(0, 3)) for j in range(r.randint(0, 4))]
+        lines.append('"s%d" ||| "t%d" ||| %s ||| %d %d %d ||| %s'
+            % (r.randrange(50), r.randrange(50), ' '.join(r.sample(features, r.randint(1, len(features)))),
+               r.randint(1, 5), r.randint(5, 9), r.randint(5, 9), ' '.join(aligns)))
+    return lines
+
+def test_batch_lines_match_records():
+    '''batch_lines(parse_batch(lines)) gives the same lines as TravatarRecord(line).to_str()'''
+    lines = random_travatar_lines(300)
+    expected = [TravatarRecord(line).to_str() for line in lines]
+    assert records.batch_lines(records.parse_batch(lines)) == expected
+
+def test_iter_batches_match_records():
+    '''the batches sharing the phrases and the schema give the same lines as the records'''
+    lines = random_travatar_lines(300, seed = 1)
+    expected = [TravatarRecord(line).to_str() for line in lines]
+    result = []
+    for batch in records.iter_batches(iter(lines), 'travatar', 37):
+        result.extend(records.batch_lines(batch))
+    assert result == expected
+
+def test_travatar_to_str():
+    '''TravatarRecord(line).to_str() writes exactly the expected line'''
+    for line, expected in TRAVATAR_LINES:
+        assert TravatarRecord(line).to_str() == expected
+
+def test_travatar_round_trip():
+    '''the written lines are written again as they are (except the exponentiated features of long names)'''
+    for line, expected in TRAVATAR_LINES:
+        record = TravatarRecord(expected)
+        if any(len(key) >= 4 and not key.startswith(('egf', 'fge')) for key in record.features.keys()):
+            continue
+        assert record.to_str() == expected
+
+def test_record_writer():
+    '''RecordWriter writes exactly the expected lines, across flushes of small buffer'''
+    pairs = TRAVATAR_LINES * 20
+    fobj = io.StringIO()
+    with records.RecordWriter(fobj, 64) as writer:
+        for line, expected in pairs:
+            writer.write(TravatarRecord(line))
+    assert writer.count == len(pairs)
+    assert fobj.getvalue().encode('utf-8') == str.join('', [expected + "\n" for line, expected in pairs]).encode('utf-8')
+
+def test_batch_lines_match_expected():
+    '''the columnar batch path writes the same lines for the special cases'''
+    lines = [line for line, expected in TRAVATAR_LINES]
+    assert records.batch_lines(records.parse_batch(lines)) == [expected for line, expected in TRAVATAR_LINES]